@@ -31,29 +31,32 @@ class AdminInterface:
     def format_statistics(self, days=30):
         try:
             conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            # Пользователи
-            cursor.execute('SELECT COUNT(*) FROM users')
-            users = cursor.fetchone()[0]
-            
-            # Сообщения
-            cursor.execute('SELECT COUNT(*) FROM conversations')
-            messages = cursor.fetchone()[0]
+            try:
+                cursor = conn.cursor()
+
+                # Пользователи
+                cursor.execute('SELECT COUNT(*) FROM users')
+                users = cursor.fetchone()[0]
             
-            # Лиды
-            cursor.execute('SELECT COUNT(*) FROM leads')
-            total_leads = cursor.fetchone()[0]
+                # Сообщения
+                cursor.execute('SELECT COUNT(*) FROM conversations')
+                messages = cursor.fetchone()[0]
             
-            cursor.execute('SELECT COUNT(*) FROM leads WHERE temperature="hot"')
-            hot = cursor.fetchone()[0]
+                # Лиды
+                cursor.execute('SELECT COUNT(*) FROM leads')
+                total_leads = cursor.fetchone()[0]
             
-            cursor.execute('SELECT COUNT(*) FROM leads WHERE temperature="warm"')
-            warm = cursor.fetchone()[0]
+                cursor.execute('SELECT COUNT(*) FROM leads WHERE temperature="hot"')
+                hot = cursor.fetchone()[0]
             
-            cursor.execute('SELECT COUNT(*) FROM leads WHERE temperature="cold"')
-            cold = cursor.fetchone()[0]
+                cursor.execute('SELECT COUNT(*) FROM leads WHERE temperature="warm"')
+                warm = cursor.fetchone()[0]
             
+                cursor.execute('SELECT COUNT(*) FROM leads WHERE temperature="cold"')
+                cold = cursor.fetchone()[0]
+            finally:
+                conn.close()
+
             message = (
                 f"📊 СТАТИСТИКА\n\n"
                 f"👥 Пользователей: {users}\n"
@@ -1,72 +1,342 @@
 """
 AI Brain - интеграция с OpenAI GPT + RAG
 """
+import asyncio
 import logging
-from typing import List, Dict, Optional, AsyncGenerator
+import time
+from collections import deque
+from typing import Any, List, Dict, Optional, AsyncGenerator, Tuple
 import json
-from openai import OpenAI
+import numpy as np
+from openai import OpenAI, AsyncOpenAI
 from config import Config
 config = Config()
 import prompts
 import database
 import knowledge_engine
+import context_builder
+import usage_tracker
+import openai_guard
 
 logger = logging.getLogger(__name__)
 
 
+class LatencyStats:
+    """Скользящее окно замеров задержки (последние max_samples значений)"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def get_stats(self) -> Dict:
+        if not self.samples:
+            return {'count': 0, 'p50': 0.0, 'p95': 0.0}
+        values = np.fromiter(self.samples, dtype=float)
+        return {
+            'count': len(values),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+        }
+
+
 class AIBrain:
     """Класс для работы с OpenAI API"""
 
     def __init__(self):
-        self.client = OpenAI(api_key=config.OPENAI_API_KEY)
+        # Повторы и сроки запросов - в openai_guard, встроенные повторы клиента отключены
+        self.client = OpenAI(api_key=config.OPENAI_API_KEY, max_retries=0)
+        # Асинхронный клиент для обработчиков бота - не блокирует event loop
+        self.async_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, max_retries=0)
         self.model = config.OPENAI_MODEL
         self.max_tokens = config.MAX_TOKENS
         self.temperature = config.TEMPERATURE
+        # Ограничение одновременных запросов к OpenAI
+        self.request_semaphore = asyncio.Semaphore(config.OPENAI_MAX_CONCURRENCY)
+
+        # Время до первого токена в потоковых ответах: с примерами RAG и без них
+        self.ttft = {'rag': LatencyStats(), 'no_rag': LatencyStats()}
+        # Поиски RAG, не уложившиеся в RAG_STREAM_DEADLINE
+        self.rag_deadline_misses = 0
+        # Время от отправки потокового запроса до первого токена - по нему считается задержка дублирования
+        self.first_token_latency = LatencyStats()
+        # Дублирующие запросы (OPENAI_HEDGE_ENABLED): сколько отправлено и сколько ответили первыми
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        # Кэширование промпта у провайдера по типам запросов (из поля usage ответов)
+        self.prompt_cache: Dict[str, Dict[str, int]] = {}
+
+    def _build_messages(
+        self,
+        conversation_history: List[Dict[str, str]],
+        rag_context: str = "",
+        summary: str = ""
+    ) -> List[Dict[str, str]]:
+        """
+        Формирование списка сообщений для OpenAI
+
+        Системный промпт, краткое содержание, примеры RAG и последние реплики
+        укладываются в бюджет CONTEXT_MAX_INPUT_TOKENS (см. context_builder).
+
+        Args:
+            conversation_history: История диалога
+            rag_context: Примеры успешных диалогов (опционально)
+            summary: Краткое содержание ранней части диалога (опционально)
+
+        Returns:
+            Сообщения в формате OpenAI
+        """
+        return context_builder.context_builder.build(
+            prompts.SYSTEM_PROMPT, conversation_history, rag_context, summary=summary
+        )
+
+    def _find_rag_context(self, conversation_history: List[Dict[str, str]]) -> str:
+        """
+        Поиск похожих успешных диалогов для последнего сообщения клиента
+
+        Args:
+            conversation_history: История диалога
+
+        Returns:
+            Текст с примерами для промпта или пустая строка
+        """
+        # Получаем последнее сообщение клиента
+        last_user_message = next(
+            (msg['message'] for msg in reversed(conversation_history[-20:]) if msg['role'] == 'user'),
+            None
+        )
+        return self._search_rag_context(last_user_message)
+
+    def _search_rag_context(self, query: Optional[str]) -> str:
+        """
+        Поиск похожих успешных диалогов по сообщению клиента
+
+        Args:
+            query: Сообщение клиента
+
+        Returns:
+            Текст с примерами для промпта или пустая строка
+        """
+        try:
+            if not query or len(query) <= 10:
+                return ""
+
+            # Ищем похожие через семантический поиск по готовому индексу
+            similar = knowledge_engine.knowledge_engine.search_similar(
+                query=query,
+                top_k=2,  # Топ-2 похожих примера
+                min_similarity=0.6  # Минимальное сходство 60%
+            )
+
+            if not similar:
+                return ""
+
+            logger.info(f"📚 RAG: Found {len(similar)} similar conversations, adding to context")
+            return knowledge_engine.knowledge_engine.format_similar_examples_for_prompt(similar)
+
+        except Exception as e:
+            # Продолжаем без RAG если что-то пошло не так
+            logger.warning(f"RAG search failed (non-critical): {e}")
+            return ""
+
+    def start_rag_search(self, user_message: str, deadline: float = None) -> asyncio.Task:
+        """
+        Запуск поиска RAG в фоне - параллельно с загрузкой истории диалога
+
+        Поиск идет в отдельном потоке, срок отсчитывается от запуска. Задачу
+        передают в generate_response_stream: если поиск не уложился в срок,
+        ответ генерируется без примеров (а результат поиска все равно
+        попадет в кэш запросов для следующих сообщений).
+
+        Args:
+            user_message: Сообщение клиента
+            deadline: Срок в секундах (по умолчанию RAG_STREAM_DEADLINE)
+
+        Returns:
+            Задача, возвращающая текст с примерами или пустую строку
+        """
+        deadline = config.RAG_STREAM_DEADLINE if deadline is None else deadline
 
-    async def generate_response_stream(self, conversation_history: List[Dict[str, str]]) -> AsyncGenerator[str, None]:
+        # to_thread вызывается внутри задачи: при отмене до ее запуска не остается корутины, которую никто не ждал
+        async def search() -> str:
+            return await asyncio.wait_for(asyncio.to_thread(self._search_rag_context, user_message), deadline)
+
+        return asyncio.create_task(search())
+
+    @staticmethod
+    def discard_rag_search(rag_task: Optional[asyncio.Task]):
+        """
+        Фоновый поиск RAG больше не нужен (ответ не генерировался или уже сгенерирован)
+
+        Незавершенная задача отменяется, ошибка завершенной забирается - иначе
+        asyncio пишет в лог "exception was never retrieved".
+        """
+        if rag_task is None:
+            return
+        rag_task.cancel()
+        rag_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def _wait_rag_context(self, rag_task: Optional[asyncio.Task]) -> str:
+        """Результат фонового поиска RAG или пустая строка, если срок истек"""
+        if rag_task is None:
+            return ""
+        try:
+            return await rag_task
+        except asyncio.TimeoutError:
+            self.rag_deadline_misses += 1
+            logger.info("RAG search missed the streaming deadline, answering without examples")
+            return ""
+        except Exception as e:
+            logger.warning(f"RAG search failed (non-critical): {e}")
+            return ""
+
+    def _build_extraction_messages(
+        self,
+        conversation_history: List[Dict[str, str]],
+        previous_lead_data: Optional[Dict] = None
+    ) -> List[Dict[str, str]]:
+        """
+        Формирование запроса на извлечение данных лида
+
+        Статические инструкции идут первыми и совпадают во всех запросах
+        (в инкрементальном режиме к ним добавляется EXTRACT_DATA_INCREMENTAL_PROMPT),
+        диалог и прошлые данные - в последнем сообщении: так начало запроса
+        попадает в кэш промпта у провайдера.
+
+        Args:
+            conversation_history: История диалога (при previous_lead_data - только новые сообщения)
+            previous_lead_data: Ранее извлеченные данные (инкрементальный режим)
+        """
+        conversation_text = "\n".join([
+            f"{msg['role']}: {msg['message']}"
+            for msg in conversation_history
+        ])
+
+        if previous_lead_data is None:
+            return [
+                {"role": "system", "content": prompts.EXTRACT_DATA_PROMPT},
+                {"role": "user", "content": f"Диалог:\n{conversation_text}"}
+            ]
+
+        previous_text = json.dumps(previous_lead_data, ensure_ascii=False)
+        return [
+            {"role": "system", "content": prompts.EXTRACT_DATA_PROMPT},
+            {"role": "system", "content": prompts.EXTRACT_DATA_INCREMENTAL_PROMPT},
+            {"role": "user", "content": (
+                f"Ранее извлеченные данные:\n{previous_text}\n\n"
+                f"Новые сообщения:\n{conversation_text}"
+            )}
+        ]
+
+    def _record_usage(self, kind: str, usage, user_id: Optional[int] = None) -> None:
+        """
+        Учет токенов запроса по полю usage ответа
+
+        Args:
+            kind: Тип запроса (chat, extraction, summary)
+            usage: usage из ответа OpenAI (None - провайдер его не вернул)
+            user_id: ID пользователя в БД (None - запрос не от диалога)
+        """
+        if usage is None:
+            return
+        usage_tracker.usage_tracker.record(usage, user_id)
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+        prompt = usage.prompt_tokens or 0
+
+        stats = self.prompt_cache.setdefault(kind, {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0})
+        stats['requests'] += 1
+        stats['prompt_tokens'] += prompt
+        stats['cached_tokens'] += cached
+        logger.debug(f"Prompt usage ({kind}): {prompt} tokens, {cached} cached")
+
+    def _parse_lead_data(self, response_text: str) -> Optional[Dict]:
+        """
+        Разбор JSON ответа модели с данными лида
+
+        Args:
+            response_text: Ответ модели
+
+        Returns:
+            Словарь с данными лида или None если JSON некорректен
+        """
+        logger.debug(f"Received extraction response: {response_text[:100]}")
+
+        # Убираем возможные markdown блоки
+        response_text = response_text.strip()
+        if response_text.startswith("```"):
+            # Убираем markdown обертку
+            lines = response_text.split("\n")
+            response_text = "\n".join(lines[1:-1])
+
+        try:
+            lead_data = json.loads(response_text)
+        except json.JSONDecodeError as e:
+            logger.error(f"Error parsing JSON response: {e}, response: {response_text}")
+            return None
+
+        # ДЕТАЛЬНОЕ ЛОГИРОВАНИЕ для отладки
+        logger.info(f"✅ Lead data extracted: temperature={lead_data.get('lead_temperature')}")
+        logger.info(f"📊 Service: category={lead_data.get('service_category')}, need={lead_data.get('specific_need')}")
+        logger.info(f"🔍 Full lead data: {json.dumps(lead_data, ensure_ascii=False)}")
+
+        return lead_data
+
+    async def generate_response_stream(
+        self,
+        conversation_history: List[Dict[str, str]],
+        rag_task: Optional[asyncio.Task] = None,
+        summary: str = "",
+        user_id: Optional[int] = None
+    ) -> AsyncGenerator[str, None]:
         """
         Генерация ответа с потоковой передачей (streaming) от OpenAI
 
         Args:
             conversation_history: История диалога в формате [{"role": "user"/"assistant", "message": "..."}]
+            rag_task: Фоновый поиск RAG из start_rag_search (опционально)
+            summary: Краткое содержание ранней части диалога (история - только сообщения после него)
+            user_id: ID пользователя в БД для учета токенов
 
         Yields:
             Части ответа ассистента по мере их генерации
         """
+        started = time.perf_counter()
         try:
-            # Преобразуем историю в формат OpenAI
-            messages = [{"role": "system", "content": prompts.SYSTEM_PROMPT}]
-
-            # Ограничиваем контекст последними 20 сообщениями для избежания обрывов
-            limited_history = conversation_history[-20:] if len(conversation_history) > 20 else conversation_history
-            
-            for msg in limited_history:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg.get("content") or msg.get("message")
-                })
-
-            logger.debug(f"Sending streaming request to OpenAI with {len(messages)} messages")
-
-            # Запрос к OpenAI с включенным streaming
-            # ВАЖНО: max_completion_tokens = лимит ТОЛЬКО на ответ (не включает prompt и историю!)
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_completion_tokens=config.MAX_COMPLETION_TOKENS,
-                temperature=self.temperature,
-                stream=True  # Включаем потоковую передачу!
-            )
-
-            # Отдаем части ответа по мере их поступления
-            finish_reason = None
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
-
-                # Проверяем причину завершения
-                if chunk.choices[0].finish_reason:
-                    finish_reason = chunk.choices[0].finish_reason
+            rag_context = await self._wait_rag_context(rag_task)
+            messages = self._build_messages(conversation_history, rag_context, summary)
+            ttft = self.ttft['rag' if rag_context else 'no_rag']
+
+            logger.debug(f"Sending streaming request to OpenAI with {len(messages)} messages (RAG: {bool(rag_context)})")
+
+            # Семафор ограничивает число одновременных потоков к OpenAI,
+            # ожидание сети не блокирует остальные чаты
+            async with self.request_semaphore:
+                response, iterator, buffered = await self._open_stream_hedged(messages)
+
+                # Отдаем части ответа по мере их поступления
+                finish_reason = None
+                first_token = True
+                try:
+                    async for chunk in self._chain_chunks(buffered, iterator):
+                        usage = getattr(chunk, 'usage', None)
+                        if usage is not None:
+                            self._record_usage('chat', usage, user_id)
+                        if not chunk.choices:
+                            continue
+
+                        if chunk.choices[0].delta.content:
+                            if first_token:
+                                ttft.add(time.perf_counter() - started)
+                                first_token = False
+                            yield chunk.choices[0].delta.content
+
+                        # Проверяем причину завершения
+                        if chunk.choices[0].finish_reason:
+                            finish_reason = chunk.choices[0].finish_reason
+                finally:
+                    await self._close_stream(response)
 
             # Логируем причину завершения
             if finish_reason == "length":
@@ -80,9 +350,126 @@ class AIBrain:
             logger.error(f"Error generating streaming response: {e}")
             yield "Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз или свяжитесь с нашей командой напрямую."
 
+    async def _open_stream(self, messages: List[Dict[str, str]]) -> Tuple[Any, Any, List]:
+        """
+        Потоковый запрос до первого чанка с текстом
+
+        Срок OPENAI_TIMEOUT - на весь путь до первого токена: openai_guard
+        ограничивает только открытие потока, поток без текста дольше
+        оставшегося срока обрывается с asyncio.TimeoutError.
+
+        Returns:
+            (поток, итератор чанков, прочитанные чанки включая первый с текстом)
+        """
+        sent = time.perf_counter()
+        # ВАЖНО: max_completion_tokens = лимит ТОЛЬКО на ответ (не включает prompt и историю!)
+        response = await openai_guard.openai_guard.call_async(
+            self.async_client.chat.completions.create,
+            timeout=config.OPENAI_TIMEOUT,
+            model=self.model,
+            messages=messages,
+            max_completion_tokens=config.MAX_COMPLETION_TOKENS,
+            temperature=self.temperature,
+            stream=True,  # Включаем потоковую передачу!
+            stream_options={"include_usage": True}  # usage приходит последним чанком
+        )
+        iterator = response.__aiter__()
+        buffered = []
+
+        async def read_first_token():
+            async for chunk in iterator:
+                buffered.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    self.first_token_latency.add(time.perf_counter() - sent)
+                    break
+
+        try:
+            remaining = config.OPENAI_TIMEOUT - (time.perf_counter() - sent)
+            await asyncio.wait_for(read_first_token(), max(remaining, 0))
+        except asyncio.TimeoutError:
+            logger.warning(f"No first token within {config.OPENAI_TIMEOUT}s, closing stream")
+            await self._close_stream(response)
+            raise
+        except BaseException:
+            # В том числе отмена проигравшего дублирующего запроса - закрываем соединение
+            await self._close_stream(response)
+            raise
+        return response, iterator, buffered
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Через сколько секунд без первого токена отправлять дублирующий запрос (None - не дублировать)"""
+        if not config.OPENAI_HEDGE_ENABLED:
+            return None
+        stats = self.first_token_latency.get_stats()
+        if stats['count'] < config.OPENAI_HEDGE_MIN_SAMPLES:
+            return config.OPENAI_HEDGE_DELAY
+        return max(config.OPENAI_HEDGE_MIN_DELAY, stats['p95'] * config.OPENAI_HEDGE_P95_FACTOR)
+
+    async def _open_stream_hedged(self, messages: List[Dict[str, str]]) -> Tuple[Any, Any, List]:
+        """
+        Открытие потока с дублированием медленного запроса
+
+        Если первый токен не пришел за _hedge_delay, отправляется такой же
+        второй запрос: ответ берется из потока, первым выдавшего текст,
+        другой отменяется. Дублирующий запрос идет в слоте семафора
+        исходного и не отправляется, пока предохранитель OpenAI разомкнут.
+        """
+        delay = self._hedge_delay()
+        if delay is None:
+            return await self._open_stream(messages)
+
+        primary = asyncio.create_task(self._open_stream(messages))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not openai_guard.openai_guard.is_available():
+            return await primary
+
+        self.hedges_fired += 1
+        logger.info(f"No first token after {delay:.2f}s, sending hedged streaming request")
+        hedge = asyncio.create_task(self._open_stream(messages))
+
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # При одновременном завершении предпочитаем исходный запрос
+                for task in sorted(done, key=lambda t: t is not primary):
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    for other in done - {task}:
+                        if other.exception() is None:
+                            await self._close_stream(other.result()[0])
+                    if task is hedge:
+                        self.hedges_won += 1
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    async def _chain_chunks(buffered: List, iterator):
+        """Уже прочитанные чанки, затем остаток потока"""
+        for chunk in buffered:
+            yield chunk
+        async for chunk in iterator:
+            yield chunk
+
+    @staticmethod
+    async def _close_stream(response):
+        """Закрытие HTTP-соединения потока (ответ прочитан или больше не нужен)"""
+        close = getattr(response, 'close', None)
+        if close is None:
+            return
+        try:
+            await close()
+        except Exception as e:
+            logger.debug(f"Error closing stream: {e}")
+
     def generate_response(self, conversation_history: List[Dict[str, str]]) -> str:
         """
-        Генерация ответа на основе истории диалога + RAG
+        Генерация ответа на основе истории диалога + RAG (синхронная версия для скриптов)
 
         Args:
             conversation_history: История диалога в формате [{"role": "user"/"assistant", "message": "..."}]
@@ -91,86 +478,82 @@ class AIBrain:
             Ответ ассистента
         """
         try:
-            # Преобразуем историю в формат OpenAI
-            messages = [{"role": "system", "content": prompts.SYSTEM_PROMPT}]
-
-            # Ограничиваем контекст последними 20 сообщениями для избежания обрывов
-            limited_history = conversation_history[-20:] if len(conversation_history) > 20 else conversation_history
-            
             # === RAG: ИЩЕМ ПОХОЖИЕ УСПЕШНЫЕ ДИАЛОГИ ===
-            rag_context = ""
-            try:
-                # Получаем последнее сообщение клиента
-                last_user_message = next(
-                    (msg['message'] for msg in reversed(limited_history) if msg['role'] == 'user'),
-                    None
-                )
-                
-                if last_user_message and len(last_user_message) > 10:
-                    # Получаем успешные диалоги из БД
-                    successful_convos = database.db.get_successful_conversations(limit=30)
-                    
-                    if successful_convos:
-                        # Ищем похожие через семантический поиск
-                        similar = knowledge_engine.knowledge_engine.find_similar_conversations(
-                            query=last_user_message,
-                            conversations=successful_convos,
-                            top_k=2,  # Топ-2 похожих примера
-                            min_similarity=0.6  # Минимальное сходство 60%
-                        )
-                        
-                        if similar:
-                            # Форматируем примеры для промпта
-                            rag_context = knowledge_engine.knowledge_engine.format_similar_examples_for_prompt(similar)
-                            logger.info(f"📚 RAG: Found {len(similar)} similar conversations, adding to context")
-            
-            except Exception as e:
-                logger.warning(f"RAG search failed (non-critical): {e}")
-                # Продолжаем без RAG если что-то пошло не так
-            
-            # ДОБАВЛЯЕМ RAG КОНТЕКСТ ЕСЛИ НАШЛИ
-            if rag_context:
-                messages.append({
-                    "role": "system",
-                    "content": rag_context
-                })
-            
-            # Добавляем историю диалога
-            for msg in limited_history:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg.get("content") or msg.get("message")
-                })
+            rag_context = self._find_rag_context(conversation_history)
+            messages = self._build_messages(conversation_history, rag_context)
 
             logger.debug(f"Sending request to OpenAI with {len(messages)} messages (RAG: {bool(rag_context)})")
 
-            # Запрос к OpenAI
             # ВАЖНО: max_completion_tokens = лимит ТОЛЬКО на ответ (не включает prompt!)
-            response = self.client.chat.completions.create(
+            response = openai_guard.openai_guard.call(
+                self.client.chat.completions.create,
                 model=self.model,
                 messages=messages,
                 max_completion_tokens=config.MAX_COMPLETION_TOKENS,
                 temperature=self.temperature
             )
 
-            assistant_message = response.choices[0].message.content
-            finish_reason = response.choices[0].finish_reason
+            self._record_usage('chat', getattr(response, 'usage', None))
+            return self._log_completion(response, rag_context)
 
-            # Предупреждение если ответ обрезан
-            if finish_reason == "length":
-                logger.warning(f"⚠️ Response truncated! ({len(assistant_message)} chars, finish_reason: length)")
-            else:
-                logger.info(f"Received response from OpenAI: {len(assistant_message)} chars (finish_reason: {finish_reason}, RAG: {bool(rag_context)})")
+        except Exception as e:
+            logger.error(f"Error generating response: {e}")
+            return "Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз или свяжитесь с Андреем напрямую."
+
+    async def generate_response_async(
+        self,
+        conversation_history: List[Dict[str, str]],
+        user_id: Optional[int] = None
+    ) -> str:
+        """
+        Генерация ответа на основе истории диалога + RAG без блокировки event loop
+
+        Args:
+            conversation_history: История диалога в формате [{"role": "user"/"assistant", "message": "..."}]
+            user_id: ID пользователя в БД для учета токенов
+
+        Returns:
+            Ответ ассистента
+        """
+        try:
+            # Поиск по базе знаний синхронный (SQLite + эмбеддинги) - выносим в поток
+            rag_context = await asyncio.to_thread(self._find_rag_context, conversation_history)
+            messages = self._build_messages(conversation_history, rag_context)
+
+            logger.debug(f"Sending async request to OpenAI with {len(messages)} messages (RAG: {bool(rag_context)})")
+
+            async with self.request_semaphore:
+                response = await openai_guard.openai_guard.call_async(
+                    self.async_client.chat.completions.create,
+                    model=self.model,
+                    messages=messages,
+                    max_completion_tokens=config.MAX_COMPLETION_TOKENS,
+                    temperature=self.temperature
+                )
 
-            return assistant_message
+            self._record_usage('chat', getattr(response, 'usage', None), user_id)
+            return self._log_completion(response, rag_context)
 
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             return "Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз или свяжитесь с Андреем напрямую."
 
+    def _log_completion(self, response, rag_context: str) -> str:
+        """Логирование результата запроса и извлечение текста ответа"""
+        assistant_message = response.choices[0].message.content
+        finish_reason = response.choices[0].finish_reason
+
+        # Предупреждение если ответ обрезан
+        if finish_reason == "length":
+            logger.warning(f"⚠️ Response truncated! ({len(assistant_message)} chars, finish_reason: length)")
+        else:
+            logger.info(f"Received response from OpenAI: {len(assistant_message)} chars (finish_reason: {finish_reason}, RAG: {bool(rag_context)})")
+
+        return assistant_message
+
     def extract_lead_data(self, conversation_history: List[Dict[str, str]]) -> Optional[Dict]:
         """
-        Извлечение данных лида из истории диалога
+        Извлечение данных лида из истории диалога (синхронная версия для скриптов)
 
         Args:
             conversation_history: История диалога
@@ -179,54 +562,159 @@ class AIBrain:
             Словарь с данными лида или None в случае ошибки
         """
         try:
-            # Формируем контекст диалога
-            conversation_text = "\n".join([
-                f"{msg['role']}: {msg['message']}"
-                for msg in conversation_history
-            ])
-
-            messages = [
-                {"role": "system", "content": prompts.EXTRACT_DATA_PROMPT},
-                {"role": "user", "content": f"Диалог:\n{conversation_text}"}
-            ]
+            messages = self._build_extraction_messages(conversation_history)
 
             logger.debug("Extracting lead data from conversation")
 
-            # Запрос к OpenAI
-            response = self.client.chat.completions.create(
+            response = openai_guard.openai_guard.call(
+                self.client.chat.completions.create,
                 model=self.model,
                 messages=messages,
                 max_tokens=500,
                 temperature=0.3  # Низкая температура для более точного извлечения
             )
 
-            response_text = response.choices[0].message.content
-            logger.debug(f"Received extraction response: {response_text[:100]}")
+            self._record_usage('extraction', getattr(response, 'usage', None))
+            return self._parse_lead_data(response.choices[0].message.content)
 
-            # Парсим JSON ответ
-            # Убираем возможные markdown блоки
-            response_text = response_text.strip()
-            if response_text.startswith("```"):
-                # Убираем markdown обертку
-                lines = response_text.split("\n")
-                response_text = "\n".join(lines[1:-1])
+        except Exception as e:
+            logger.error(f"Error extracting lead data: {e}")
+            return None
 
-            lead_data = json.loads(response_text)
-            
-            # ДЕТАЛЬНОЕ ЛОГИРОВАНИЕ для отладки
-            logger.info(f"✅ Lead data extracted: temperature={lead_data.get('lead_temperature')}")
-            logger.info(f"📊 Service: category={lead_data.get('service_category')}, need={lead_data.get('specific_need')}")
-            logger.info(f"🔍 Full lead data: {json.dumps(lead_data, ensure_ascii=False)}")
+    async def extract_lead_data_async(
+        self,
+        conversation_history: List[Dict[str, str]],
+        previous_lead_data: Optional[Dict] = None,
+        user_id: Optional[int] = None
+    ) -> Optional[Dict]:
+        """
+        Извлечение данных лида из истории диалога без блокировки event loop
+
+        Args:
+            conversation_history: История диалога (при previous_lead_data - только новые сообщения)
+            previous_lead_data: Ранее извлеченные данные - модель их обновляет
+            user_id: ID пользователя в БД для учета токенов
+
+        Returns:
+            Словарь с данными лида или None в случае ошибки
+        """
+        try:
+            messages = self._build_extraction_messages(conversation_history, previous_lead_data)
+
+            logger.debug("Extracting lead data from conversation (async)")
+
+            async with self.request_semaphore:
+                response = await openai_guard.openai_guard.call_async(
+                    self.async_client.chat.completions.create,
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=500,
+                    temperature=0.3  # Низкая температура для более точного извлечения
+                )
 
+            self._record_usage('extraction', getattr(response, 'usage', None), user_id)
+            lead_data = self._parse_lead_data(response.choices[0].message.content)
+            if lead_data is not None and previous_lead_data:
+                # Поля, которые модель не вернула или обнулила, берем из прошлого извлечения
+                lead_data = {
+                    **previous_lead_data,
+                    **{key: value for key, value in lead_data.items() if value is not None}
+                }
             return lead_data
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing JSON response: {e}, response: {response_text}")
-            return None
         except Exception as e:
             logger.error(f"Error extracting lead data: {e}")
             return None
 
+    async def summarize_conversation_async(
+        self,
+        previous_summary: str,
+        messages: List[Dict[str, str]],
+        user_id: Optional[int] = None
+    ) -> Optional[str]:
+        """
+        Краткое содержание диалога: предыдущее содержание + новые сообщения
+
+        Args:
+            previous_summary: Предыдущее краткое содержание (или пустая строка)
+            messages: Сообщения, которые нужно добавить в содержание
+            user_id: ID пользователя в БД для учета токенов
+
+        Returns:
+            Новое краткое содержание или None в случае ошибки
+        """
+        try:
+            conversation_text = "\n".join(f"{msg['role']}: {msg['message']}" for msg in messages)
+            content = f"Новые сообщения:\n{conversation_text}"
+            if previous_summary:
+                content = f"Предыдущее краткое содержание:\n{previous_summary}\n\n{content}"
+
+            async with self.request_semaphore:
+                response = await openai_guard.openai_guard.call_async(
+                    self.async_client.chat.completions.create,
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": prompts.SUMMARY_PROMPT},
+                        {"role": "user", "content": content}
+                    ],
+                    max_tokens=config.CONVERSATION_SUMMARY_MAX_TOKENS,
+                    temperature=0.3
+                )
+
+            self._record_usage('summary', getattr(response, 'usage', None), user_id)
+            return (response.choices[0].message.content or "").strip() or None
+
+        except Exception as e:
+            logger.error(f"Error summarizing conversation: {e}")
+            return None
+
+    def get_stream_stats(self) -> Dict:
+        """Статистика времени до первого токена (секунды) с RAG и без"""
+        return {
+            'rag': self.ttft['rag'].get_stats(),
+            'no_rag': self.ttft['no_rag'].get_stats(),
+            'rag_deadline_misses': self.rag_deadline_misses,
+            'first_token': self.first_token_latency.get_stats(),
+            'hedges_fired': self.hedges_fired,
+            'hedges_won': self.hedges_won,
+        }
+
+    def format_stream_stats(self) -> str:
+        """Статистика потоковых ответов для админ-панели"""
+        stats = self.get_stream_stats()
+        lines = ["⚡ Время до первого токена"]
+        for key, title in (('rag', 'С примерами RAG'), ('no_rag', 'Без RAG')):
+            item = stats[key]
+            lines.append(
+                f"{title}: p50 {item['p50']:.2f}с, p95 {item['p95']:.2f}с ({item['count']} ответов)"
+            )
+        lines.append(f"⏱ RAG не успел к сроку: {stats['rag_deadline_misses']}")
+        if config.OPENAI_HEDGE_ENABLED:
+            lines.append(
+                f"🔀 Дублирующих запросов: {stats['hedges_fired']}, ответили первыми: {stats['hedges_won']}"
+            )
+        return "\n".join(lines)
+
+    def get_prompt_cache_stats(self) -> Dict[str, Dict]:
+        """Доля закэшированных входных токенов по типам запросов"""
+        return {
+            kind: {**stats, 'hit_rate': stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0}
+            for kind, stats in self.prompt_cache.items()
+        }
+
+    def format_prompt_cache_stats(self) -> str:
+        """Статистика кэша промптов для админ-панели"""
+        stats = self.get_prompt_cache_stats()
+        if not stats:
+            return "🗄 Кэш промптов: нет данных"
+        lines = ["🗄 Кэш промптов"]
+        for kind, item in sorted(stats.items()):
+            lines.append(
+                f"{kind}: {item['hit_rate']:.0%} из кэша "
+                f"({item['cached_tokens']}/{item['prompt_tokens']} токенов, {item['requests']} запросов)"
+            )
+        return "\n".join(lines)
+
     def check_handoff_trigger(self, user_message: str) -> bool:
         """
         Проверка триггеров передачи админу
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк приближенного поиска (IVF) против точного: полнота recall@k и задержка
+
+Запуск:
+    python bench_ann.py --size 100000 --dim 1536 --lists 0 256 --probes 1 4 8 16 32
+
+Корпус синтетический: нормализованные векторы вокруг --clusters тематических
+центров (как у реальных диалогов, похожих по тематике). Запросы - зашумленные
+строки корпуса. recall@k - доля точных топ-K соседей, найденных индексом.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from vector_index import ExactIndex, IVFIndex, normalize_rows
+
+
+def make_corpus(size: int, dim: int, clusters: int, noise: float, rng) -> np.ndarray:
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=size)
+    return normalize_rows(centers[labels] + noise * rng.normal(size=(size, dim)).astype(np.float32))
+
+
+def run_queries(index, queries: np.ndarray, top_k: int):
+    """Результаты и задержки (мс) по каждому запросу"""
+    results = []
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        results.append({i for i, _ in index.search(query, top_k, -1)})
+        latencies.append((time.perf_counter() - started) * 1000)
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=50000, help="Векторов в корпусе")
+    parser.add_argument("--dim", type=int, default=1536, help="Размерность эмбеддингов")
+    parser.add_argument("--clusters", type=int, default=200, help="Тематических центров в корпусе")
+    parser.add_argument("--noise", type=float, default=1.5, help="Разброс векторов вокруг центра")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--lists", type=int, nargs="+", default=[0], help="RAG_IVF_LISTS (0 - sqrt(N))")
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64], help="RAG_IVF_PROBES")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrix = make_corpus(args.size, args.dim, args.clusters, args.noise, rng)
+    rows = rng.choice(args.size, args.queries, replace=False)
+    queries = normalize_rows(matrix[rows] + 0.1 * rng.normal(size=(args.queries, args.dim)).astype(np.float32))
+
+    exact = ExactIndex()
+    exact.build(matrix)
+    truth, exact_latencies = run_queries(exact, queries, args.top_k)
+
+    print(f"size={args.size}, dim={args.dim}, clusters={args.clusters}, queries={args.queries}, k={args.top_k}")
+    print(f"{'backend':<8} | {'lists':>5} | {'probes':>6} | {'build':>9} | {'p50':>8} | {'p99':>8} | {'recall@k':>8}")
+    print(
+        f"{'exact':<8} | {'-':>5} | {'-':>6} | {'-':>9} | {np.percentile(exact_latencies, 50):>6.2f}ms | "
+        f"{np.percentile(exact_latencies, 99):>6.2f}ms | {1.0:>8.3f}"
+    )
+
+    for n_lists in args.lists:
+        trained = None
+        for n_probe in args.probes:
+            index = IVFIndex(n_lists=n_lists, n_probe=n_probe)
+            started = time.perf_counter()
+            # Центроиды обучаются один раз на n_lists, для остальных n_probe переиспользуются
+            index.build(matrix, previous=trained)
+            build_time = time.perf_counter() - started
+            trained = index
+
+            found, latencies = run_queries(index, queries, args.top_k)
+            recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+            print(
+                f"{'ivf':<8} | {index.centroids.shape[0]:>5} | {n_probe:>6} | {build_time * 1000:>7.0f}ms | "
+                f"{np.percentile(latencies, 50):>6.2f}ms | {np.percentile(latencies, 99):>6.2f}ms | {recall:>8.3f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
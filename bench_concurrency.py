@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест: параллельные диалоги через AIBrain против локального fake-сервера OpenAI
+
+Запуск:
+    python bench_concurrency.py --users 50 --ttft 0.3 --tokens 40
+
+Сравнивает старый путь (синхронный клиент внутри event loop) и новый (AsyncOpenAI)
+и печатает p50/p99 времени до первого токена и полного ответа. Сценарии rag
+добавляют поиск RAG длительностью --rag-delay со сроком RAG_STREAM_DEADLINE.
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from typing import List, Tuple
+
+from openai import OpenAI, AsyncOpenAI
+
+import ai_brain
+
+
+# === FAKE СЕРВЕР ===
+
+class FakeCompletionServer:
+    """Минимальный OpenAI-совместимый HTTP сервер (chat.completions, stream и без)"""
+
+    def __init__(self, ttft: float, tokens: int, token_delay: float):
+        self.ttft = ttft
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.port = None
+        self._loop = None
+        self._ready = threading.Event()
+
+    def start(self):
+        """Запуск сервера в отдельном потоке со своим event loop"""
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, '127.0.0.1', 0)
+        )
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            content_length = 0
+            for line in head.decode().split("\r\n"):
+                if line.lower().startswith("content-length:"):
+                    content_length = int(line.split(":", 1)[1])
+            body = json.loads(await reader.readexactly(content_length)) if content_length else {}
+
+            if body.get("stream"):
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                    b"Connection: close\r\n\r\n"
+                )
+                await writer.drain()
+                await asyncio.sleep(self.ttft)
+                for i in range(self.tokens):
+                    finish = "stop" if i == self.tokens - 1 else None
+                    writer.write(self._sse_chunk("слово ", finish))
+                    await writer.drain()
+                    await asyncio.sleep(self.token_delay)
+                writer.write(b"data: [DONE]\n\n")
+            else:
+                await asyncio.sleep(self.ttft + self.tokens * self.token_delay)
+                payload = json.dumps({
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": 0, "model": "fake",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "{}"}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                }).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _sse_chunk(content: str, finish_reason) -> bytes:
+        chunk = {
+            "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": "fake",
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+
+
+# === КЛИЕНТЫ ===
+
+async def legacy_stream(brain: ai_brain.AIBrain, history):
+    """Старое поведение: синхронный клиент итерируется внутри event loop"""
+    response = brain.client.chat.completions.create(
+        model=brain.model,
+        messages=brain._build_messages(history),
+        stream=True
+    )
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def simulate_user(stream_factory, history, started: float) -> Tuple[float, float]:
+    """
+    Один пользователь: возвращает (время до первого токена, время полного ответа)
+
+    Время считается от общего старта - все пользователи пишут одновременно,
+    поэтому ожидание своей очереди тоже входит в задержку ответа.
+    """
+    first_token = None
+    async for _ in stream_factory(history):
+        if first_token is None:
+            first_token = time.perf_counter() - started
+    return first_token or 0.0, time.perf_counter() - started
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_scenario(name: str, stream_factory, users: int):
+    history = [{"role": "user", "message": "Здравствуйте, интересует автоматизация договоров"}]
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[simulate_user(stream_factory, history, started) for _ in range(users)])
+    wall = time.perf_counter() - started
+
+    ttft = [r[0] for r in results]
+    total = [r[1] for r in results]
+    print(
+        f"{name:<10} | TTFT p50={percentile(ttft, 50):6.2f}s p99={percentile(ttft, 99):6.2f}s | "
+        f"reply p50={percentile(total, 50):6.2f}s p99={percentile(total, 99):6.2f}s | wall={wall:6.2f}s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Число одновременных пользователей")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Задержка до первого токена, сек")
+    parser.add_argument("--tokens", type=int, default=40, help="Токенов в ответе")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Пауза между токенами, сек")
+    parser.add_argument("--limit", type=int, default=None, help="OPENAI_MAX_CONCURRENCY (по умолчанию = users)")
+    parser.add_argument("--rag-delay", type=float, nargs="+", default=[0.1, 1.0],
+                        help="Длительность поиска RAG, сек (для сценариев rag)")
+    parser.add_argument("--skip-legacy", action="store_true", help="Не запускать старый синхронный вариант")
+    args = parser.parse_args()
+
+    server = FakeCompletionServer(args.ttft, args.tokens, args.token_delay)
+    server.start()
+    base_url = f"http://127.0.0.1:{server.port}/v1"
+
+    brain = ai_brain.AIBrain()
+    brain.client = OpenAI(api_key="sk-fake", base_url=base_url, max_retries=0)
+    brain.async_client = AsyncOpenAI(api_key="sk-fake", base_url=base_url, max_retries=0)
+    brain.request_semaphore = asyncio.Semaphore(args.limit or args.users)
+
+    print(f"Fake server: {base_url}, users={args.users}, ttft={args.ttft}s, "
+          f"tokens={args.tokens}x{args.token_delay}s, limit={args.limit or args.users}")
+
+    if not args.skip_legacy:
+        await run_scenario("sync", lambda h: legacy_stream(brain, h), args.users)
+    await run_scenario("async", brain.generate_response_stream, args.users)
+
+    for rag_delay in args.rag_delay:
+        def slow_search(query, delay=rag_delay):
+            time.sleep(delay)
+            return "Примеры успешных диалогов"
+
+        brain._search_rag_context = slow_search
+
+        async def rag_stream(history):
+            rag_task = brain.start_rag_search(history[-1]["message"])
+            async for part in brain.generate_response_stream(history, rag_task):
+                yield part
+
+        await run_scenario(f"rag {rag_delay:.1f}s", rag_stream, args.users)
+
+    stats = brain.get_stream_stats()
+    print(
+        f"TTFT with RAG p50={stats['rag']['p50']:.2f}s ({stats['rag']['count']}), "
+        f"without RAG p50={stats['no_rag']['p50']:.2f}s ({stats['no_rag']['count']}), "
+        f"deadline misses={stats['rag_deadline_misses']}"
+    )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк обращений к SQLite на одно сообщение клиента: подключение на вызов против пула
+
+Запуск:
+    python bench_database.py --users 200 --messages 2000
+
+Последовательность повторяет handle_message: пользователь, лид, история,
+сообщение клиента, история, ответ бота, обновление лида и времени
+последнего сообщения. "before" - Database(pool_size=0): новое подключение
+на каждый вызов без PRAGMA (как было), "after" - пул подключений с WAL.
+Каждый вариант работает со своей временной БД.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from database import Database
+
+
+def message_sequence(db: Database, telegram_id: int, text: str):
+    """Обращения к БД при обработке одного сообщения"""
+    user = db.get_user_by_telegram_id(telegram_id)
+    db.get_lead_by_user_id(user['id'])
+    db.get_conversation_history(user['id'])
+    db.add_message(user['id'], 'user', text)
+    db.get_conversation_history(user['id'])
+    db.add_message(user['id'], 'assistant', "Ответ: " + text)
+    db.create_or_update_lead(user['id'], {'name': f"User{telegram_id}", 'temperature': 'warm'})
+    db.update_lead_last_message_time(user['id'])
+
+
+def run(db: Database, users: int, messages: int, seed: int) -> np.ndarray:
+    for telegram_id in range(1, users + 1):
+        db.create_or_update_user(telegram_id=telegram_id, first_name=f"User{telegram_id}")
+
+    rng = random.Random(seed)
+    timings = np.empty(messages)
+    for i in range(messages):
+        started = time.perf_counter()
+        message_sequence(db, rng.randint(1, users), f"Сообщение {i}: интересует автоматизация договоров")
+        timings[i] = time.perf_counter() - started
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"users={args.users}, messages={args.messages}")
+    print(f"{'variant':<8} {'total s':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, pool_size in (("before", 0), ("after", None)):
+            db = Database(os.path.join(tmp, f"{name}.db"), pool_size=pool_size)
+            timings = run(db, args.users, args.messages, args.seed)
+            db.close()
+            results[name] = timings.sum()
+            print(f"{name:<8} {timings.sum():>9.2f} {timings.mean() * 1000:>9.2f} "
+                  f"{np.percentile(timings, 50) * 1000:>9.2f} {np.percentile(timings, 95) * 1000:>9.2f}")
+    print(f"speedup: x{results['before'] / results['after']:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк записи сообщений диалогов: транзакция на сообщение против группового коммита
+
+Запуск:
+    python bench_group_commit.py --exchanges 3000 --concurrency 1 10 100
+
+Каждый "пользователь" - корутина, которая по очереди обрабатывает свои
+сообщения как handle_message: сообщение клиента, история диалога, ответ
+бота, время последнего сообщения лида (все через AsyncDatabase). "before" -
+без журнала (DB_GROUP_COMMIT_MS=0, каждая запись - своя транзакция),
+"after" - журнал с групповым коммитом. Число обменов делится поровну между
+пользователями; результат - записанных сообщений в секунду до полной записи
+журнала. Каждый прогон работает со своей временной БД.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from config import Config
+from database import AsyncDatabase, Database
+
+
+async def user_loop(adb: AsyncDatabase, user_id: int, exchanges: int):
+    for i in range(exchanges):
+        await adb.add_message(user_id, 'user', f"Сообщение {i}: интересует автоматизация договоров")
+        await adb.get_conversation_history(user_id)
+        await adb.add_message(user_id, 'assistant', f"Ответ {i}")
+        await adb.update_lead_last_message_time(user_id)
+
+
+async def run(db_path: str, concurrency: int, exchanges: int, group_commit_ms: float):
+    db = Database(db_path)
+    adb = AsyncDatabase(db)
+    adb.journal.delay = group_commit_ms / 1000
+
+    user_ids = []
+    for telegram_id in range(1, concurrency + 1):
+        user_id = await adb.create_or_update_user(telegram_id=telegram_id, first_name=f"User{telegram_id}")
+        await adb.create_or_update_lead(user_id, {'name': f"User{telegram_id}"})
+        user_ids.append(user_id)
+
+    per_user = max(1, exchanges // concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(*(user_loop(adb, user_id, per_user) for user_id in user_ids))
+    await adb.drain()
+    elapsed = time.perf_counter() - started
+
+    stats = adb.journal.get_stats()
+    await asyncio.to_thread(adb.close)
+    db.close()
+    return per_user * concurrency * 2 / elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--exchanges", type=int, default=3000, help="Обменов (клиент + бот) на прогон")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--group-commit-ms", type=float, default=Config().DB_GROUP_COMMIT_MS or 5)
+    args = parser.parse_args()
+
+    print(f"exchanges={args.exchanges}, group commit {args.group_commit_ms} ms")
+    print(f"{'users':>6} {'before msg/s':>13} {'after msg/s':>12} {'speedup':>8} {'avg batch':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for concurrency in args.concurrency:
+            before, _ = asyncio.run(run(
+                os.path.join(tmp, f"before_{concurrency}.db"), concurrency, args.exchanges, 0
+            ))
+            after, stats = asyncio.run(run(
+                os.path.join(tmp, f"after_{concurrency}.db"), concurrency, args.exchanges, args.group_commit_ms
+            ))
+            print(f"{concurrency:>6} {before:>13.0f} {after:>12.0f} {after / before:>7.1f}x {stats['avg_batch']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
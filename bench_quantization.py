@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сжатого хранения векторов RAG: память, задержка и полнота против float32
+
+Запуск:
+    python bench_quantization.py --size 100000 --dim 1536
+
+Сравнивает списки float (как возвращает get_embedding), float32, float16
+и int8 с масштабом на вектор. recall@k - доля точных float32 топ-K соседей,
+найденных по сжатой матрице. Память списков считается на выборке и
+экстраполируется на весь корпус.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from vector_index import CompactMatrix, normalize_rows, top_k_similar
+
+
+def list_vector_size(vector: list) -> int:
+    """Размер вектора-списка Python вместе с объектами float"""
+    return sys.getsizeof(vector) + sum(sys.getsizeof(x) for x in vector)
+
+
+def make_corpus(size: int, dim: int, clusters: int, rng, chunk: int = 10000) -> np.ndarray:
+    """Кластеризованный корпус, генерируется блоками (без float64 копии целиком)"""
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    matrix = np.empty((size, dim), dtype=np.float32)
+    for start in range(0, size, chunk):
+        end = min(start + chunk, size)
+        labels = rng.integers(0, clusters, size=end - start)
+        noise = rng.standard_normal(size=(end - start, dim), dtype=np.float32)
+        matrix[start:end] = normalize_rows(centers[labels] + 1.5 * noise)
+    return matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=50000, help="Векторов в корпусе")
+    parser.add_argument("--dim", type=int, default=1536, help="Размерность эмбеддингов")
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrix = make_corpus(args.size, args.dim, args.clusters, rng)
+    queries = matrix[rng.choice(args.size, args.queries, replace=False)]
+
+    sample = [row.tolist() for row in matrix[:100]]
+    lists_mb = np.mean([list_vector_size(v) for v in sample]) * args.size / 2**20
+
+    truth = [{i for i, _ in top_k_similar(matrix, q, args.top_k, -1)} for q in queries]
+
+    print(f"size={args.size}, dim={args.dim}, queries={args.queries}, k={args.top_k}")
+    print(f"{'storage':<10} | {'memory':>10} | {'per 100k':>10} | {'p50':>8} | {'recall@k':>8} | {'max err':>8}")
+    print(f"{'lists':<10} | {lists_mb:>8.0f}MB | {lists_mb * 100000 / args.size:>8.0f}MB | {'-':>8} | {'-':>8} | {'-':>8}")
+
+    for dtype in CompactMatrix.DTYPES:
+        compact = CompactMatrix.from_float(matrix, dtype)
+        latencies = []
+        hits = 0
+        max_error = 0.0
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            found = top_k_similar(compact, query, args.top_k, -1)
+            latencies.append((time.perf_counter() - started) * 1000)
+            rows = [i for i, _ in found]
+            hits += len(expected & set(rows))
+            # Ошибка сходства относительно float32
+            error = np.abs(matrix[rows] @ query - np.array([score for _, score in found])).max()
+            max_error = max(max_error, float(error))
+
+        memory_mb = compact.nbytes / 2**20
+        print(
+            f"{dtype:<10} | {memory_mb:>8.0f}MB | {memory_mb * 100000 / args.size:>8.0f}MB | "
+            f"{np.percentile(latencies, 50):>6.2f}ms | {hits / (args.queries * args.top_k):>8.3f} | {max_error:>8.4f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк поиска похожих диалогов: цикл cosine_similarity против матричного top-K
+
+Запуск:
+    python bench_similarity.py --sizes 30 1000 10000 100000 --dim 1536
+
+Цикл повторяет старую реализацию find_similar_conversations (векторы-списки,
+cosine_similarity на каждую пару, сортировка). Для больших корпусов цикл
+меряется на --loop-max строках и экстраполируется линейно (помечено "*").
+"""
+import argparse
+import time
+
+import numpy as np
+
+from knowledge_engine import KnowledgeEngine, normalize_rows, top_k_similar
+
+
+def bench_loop(engine: KnowledgeEngine, query: list, vectors: list, top_k: int) -> float:
+    """Старый путь: Python-цикл по всем диалогам"""
+    started = time.perf_counter()
+    similarities = []
+    for i, vector in enumerate(vectors):
+        similarity = engine.cosine_similarity(query, vector)
+        if similarity >= -1:
+            similarities.append((i, similarity))
+    similarities.sort(key=lambda x: x[1], reverse=True)
+    similarities[:top_k]
+    return time.perf_counter() - started
+
+
+def bench_matrix(matrix: np.ndarray, query: np.ndarray, top_k: int, repeats: int) -> float:
+    """Новый путь: одно умножение матрицы на вектор + argpartition"""
+    started = time.perf_counter()
+    for _ in range(repeats):
+        top_k_similar(matrix, normalize_rows(query.reshape(1, -1))[0], top_k, -1)
+    return (time.perf_counter() - started) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[30, 1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=1536, help="Размерность эмбеддингов")
+    parser.add_argument("--top-k", type=int, default=2)
+    parser.add_argument("--loop-max", type=int, default=2000, help="Макс. строк для замера цикла")
+    parser.add_argument("--repeats", type=int, default=20, help="Повторов матричного поиска")
+    args = parser.parse_args()
+
+    engine = KnowledgeEngine()
+    rng = np.random.default_rng(0)
+    query = rng.normal(size=args.dim).astype(np.float32)
+
+    print(f"dim={args.dim}, top_k={args.top_k}")
+    print(f"{'rows':>8} | {'loop':>12} | {'matrix':>10} | {'build':>10} | {'speedup':>8}")
+
+    for size in args.sizes:
+        corpus = rng.normal(size=(size, args.dim)).astype(np.float32)
+
+        loop_rows = min(size, args.loop_max)
+        loop_time = bench_loop(engine, query.tolist(), [row.tolist() for row in corpus[:loop_rows]], args.top_k)
+        loop_time *= size / loop_rows
+        loop_mark = "*" if loop_rows < size else " "
+
+        started = time.perf_counter()
+        matrix = normalize_rows(corpus)
+        build_time = time.perf_counter() - started
+
+        matrix_time = bench_matrix(matrix, query, args.top_k, args.repeats)
+
+        print(
+            f"{size:>8} | {loop_time * 1000:>10.2f}ms{loop_mark}| {matrix_time * 1000:>8.3f}ms | "
+            f"{build_time * 1000:>8.1f}ms | {loop_time / matrix_time:>7.0f}x"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,13 @@ from telegram.ext import (
 
 from config import Config
 from handlers import Handlers
+from handlers.admin import rebuild_rag_command
 from database import Database
+import database
+import knowledge_engine
+import lead_extraction
+import conversation_summary
+import usage_tracker
 
 # Настройка логирования
 logging.basicConfig(
@@ -112,6 +118,10 @@ class LegalAIBot:
         """Админская команда /view_conversation"""
         await self.handlers.admin_view_conversation(update, context)
 
+    async def admin_rebuild_rag(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Админская команда /rebuild_rag (доступ проверяет сам обработчик)"""
+        await rebuild_rag_command(update, context)
+
     def setup_handlers(self, application: Application):
         """Настройка обработчиков команд"""
 
@@ -125,6 +135,7 @@ class LegalAIBot:
         application.add_handler(CommandHandler("leads", self.admin_leads))
         application.add_handler(CommandHandler("export", self.admin_export))
         application.add_handler(CommandHandler("view_conversation", self.admin_view_conversation))
+        application.add_handler(CommandHandler("rebuild_rag", self.admin_rebuild_rag))
         # Chat management commands
         application.add_handler(CommandHandler("enable_chat", self.enable_chat_command))
         application.add_handler(CommandHandler("disable_chat", self.disable_chat_command))
@@ -138,15 +149,34 @@ class LegalAIBot:
 
         logger.info("Обработчики настроены")
 
+    async def post_shutdown(self, application: Application):
+        """Дорабатываем фоновые извлечения лидов и обновления содержания диалогов, записываем расход токенов перед остановкой"""
+        await lead_extraction.lead_extraction_queue.drain()
+        await conversation_summary.conversation_summarizer.drain()
+        await asyncio.to_thread(usage_tracker.usage_tracker.close)
+        # Записываем журнал сообщений и дожидаемся запросов, уже отправленных в потоки БД
+        await database.adb.drain()
+        await asyncio.to_thread(database.adb.close)
+
     async def run(self):
         """Запуск бота"""
         try:
             # Создаем приложение
-            application = Application.builder().token(self.config.TELEGRAM_BOT_TOKEN).build()
+            application = (
+                Application.builder()
+                .token(self.config.TELEGRAM_BOT_TOKEN)
+                .post_shutdown(self.post_shutdown)
+                .build()
+            )
 
             # Настраиваем обработчики
             self.setup_handlers(application)
 
+            # Загружаем RAG индекс с диска (или строим из БД) в фоне
+            knowledge_engine.knowledge_engine.rag_index.ensure_started()
+            # Фоновая запись расхода токенов в БД
+            usage_tracker.usage_tracker.ensure_started()
+
             # Запускаем бота
             logger.info("Бот запущен и готов к работе")
             await application.run_polling(allowed_updates=Update.ALL_TYPES)
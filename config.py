@@ -37,11 +37,76 @@ class Config:
         self.MAX_COMPLETION_TOKENS: int = self.MAX_TOKENS  # Для обратной совместимости
         self.TEMPERATURE: float = float(os.getenv('TEMPERATURE', '0.7'))
         self.MAX_HISTORY_MESSAGES: int = int(os.getenv('MAX_HISTORY_MESSAGES', '10'))
+        self.HISTORY_CACHE_MAX_USERS: int = int(os.getenv('HISTORY_CACHE_MAX_USERS', '5000'))  # окон истории в памяти, 0 - без кэша
+        self.HISTORY_CACHE_MAX_MB: float = float(os.getenv('HISTORY_CACHE_MAX_MB', '32'))  # потолок памяти кэша истории
+        # Бюджет входных токенов запроса: системный промпт + RAG + последние реплики
+        self.CONTEXT_MAX_INPUT_TOKENS: int = int(os.getenv('CONTEXT_MAX_INPUT_TOKENS', '8000'))
+        # Краткое содержание длинных диалогов (CONVERSATION_RECENT_MESSAGES + CONVERSATION_SUMMARY_EVERY
+        # не больше MAX_HISTORY_MESSAGES, иначе часть сообщений не попадет ни в содержание, ни в окно)
+        self.CONVERSATION_SUMMARY_EVERY: int = int(os.getenv('CONVERSATION_SUMMARY_EVERY', '4'))  # сообщений между обновлениями, 0 - выключено
+        self.CONVERSATION_RECENT_MESSAGES: int = int(os.getenv('CONVERSATION_RECENT_MESSAGES', '4'))  # последних сообщений всегда дословно
+        self.CONVERSATION_SUMMARY_MAX_TOKENS: int = int(os.getenv('CONVERSATION_SUMMARY_MAX_TOKENS', '300'))  # длина содержания
         self.RESPONSE_DELAY: float = float(os.getenv('RESPONSE_DELAY', '0.0'))
+        # Максимум одновременных запросов к OpenAI (остальные ждут в очереди)
+        self.OPENAI_MAX_CONCURRENCY: int = int(os.getenv('OPENAI_MAX_CONCURRENCY', '20'))
+
+        # Запросы к OpenAI: общий срок вызова с повторами, повторы при 429/5xx и предохранитель
+        self.OPENAI_TIMEOUT: float = float(os.getenv('OPENAI_TIMEOUT', '30'))  # сек на вызов (вместе с повторами)
+        self.OPENAI_MAX_RETRIES: int = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+        self.OPENAI_BACKOFF_BASE: float = float(os.getenv('OPENAI_BACKOFF_BASE', '0.5'))  # сек, удваивается с каждым повтором
+        self.OPENAI_BACKOFF_MAX: float = float(os.getenv('OPENAI_BACKOFF_MAX', '8'))
+        self.OPENAI_BREAKER_THRESHOLD: int = int(os.getenv('OPENAI_BREAKER_THRESHOLD', '5'))  # ошибок подряд до размыкания
+        self.OPENAI_BREAKER_RESET: float = float(os.getenv('OPENAI_BREAKER_RESET', '30'))  # сек до пробного запроса
+
+        # Дублирование потокового запроса, если первый токен задерживается
+        self.OPENAI_HEDGE_ENABLED: bool = os.getenv('OPENAI_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.OPENAI_HEDGE_P95_FACTOR: float = float(os.getenv('OPENAI_HEDGE_P95_FACTOR', '1.0'))  # задержка = p95 до первого токена * множитель
+        self.OPENAI_HEDGE_MIN_DELAY: float = float(os.getenv('OPENAI_HEDGE_MIN_DELAY', '0.5'))  # сек, не раньше
+        self.OPENAI_HEDGE_DELAY: float = float(os.getenv('OPENAI_HEDGE_DELAY', '3.0'))  # сек, пока замеров меньше OPENAI_HEDGE_MIN_SAMPLES
+        self.OPENAI_HEDGE_MIN_SAMPLES: int = int(os.getenv('OPENAI_HEDGE_MIN_SAMPLES', '50'))
+
+        # Фоновое извлечение данных лида
+        self.LEAD_EXTRACTION_WORKERS: int = int(os.getenv('LEAD_EXTRACTION_WORKERS', '4'))  # одновременных извлечений
+        self.LEAD_EXTRACTION_QUEUE_SIZE: int = int(os.getenv('LEAD_EXTRACTION_QUEUE_SIZE', '500'))  # пользователей в очереди, дальше - пропуск
+        self.LEAD_EXTRACTION_FULL_EVERY: int = int(os.getenv('LEAD_EXTRACTION_FULL_EVERY', '5'))  # каждое N-е извлечение - по полной истории, 0 - всегда полное
+        self.LEAD_EXTRACTION_DRAIN_TIMEOUT: float = float(os.getenv('LEAD_EXTRACTION_DRAIN_TIMEOUT', '30'))  # сек на доработку очереди при остановке
+
+        # Учет токенов: как часто счетчики из памяти записываются в БД (сек)
+        self.USAGE_FLUSH_INTERVAL: float = float(os.getenv('USAGE_FLUSH_INTERVAL', '60'))
 
         # Настройки базы данных
         self.DB_PATH: str = os.getenv('DB_PATH', 'data/bot.db')
         self.DATABASE_PATH: str = self.DB_PATH  # Для обратной совместимости
+        self.DB_POOL_SIZE: int = int(os.getenv('DB_POOL_SIZE', '8'))  # свободных подключений в пуле, 0 - подключение на каждый запрос
+        self.DB_BUSY_TIMEOUT: float = float(os.getenv('DB_BUSY_TIMEOUT', '5'))  # сек ожидания блокировки записи
+        self.DB_CACHE_SIZE_KB: int = int(os.getenv('DB_CACHE_SIZE_KB', '16384'))  # кэш страниц на подключение
+        self.DB_MMAP_SIZE: int = int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024)))  # байт файла БД, читаемых через mmap
+        self.DB_STATEMENT_CACHE: int = int(os.getenv('DB_STATEMENT_CACHE', '256'))  # подготовленных запросов на подключение
+        self.DB_READER_THREADS: int = int(os.getenv('DB_READER_THREADS', '4'))  # потоков чтения AsyncDatabase (запись - в одном потоке)
+        self.DB_GROUP_COMMIT_MS: float = float(os.getenv('DB_GROUP_COMMIT_MS', '5'))  # ожидание сообщений для общего коммита, 0 - без журнала
+        self.DB_GROUP_COMMIT_MAX: int = int(os.getenv('DB_GROUP_COMMIT_MAX', '500'))  # записей в пакете, больше - коммит сразу
+        self.DB_GROUP_COMMIT_RETRIES: int = int(os.getenv('DB_GROUP_COMMIT_RETRIES', '3'))  # повторов неудачного пакета, потом он отбрасывается
+
+        # Настройки RAG
+        self.EMBEDDING_CACHE_SIZE: int = int(os.getenv('EMBEDDING_CACHE_SIZE', '2000'))  # векторов в памяти
+        self.EMBEDDING_BATCH_SIZE: int = int(os.getenv('EMBEDDING_BATCH_SIZE', '512'))  # текстов в одном запросе (API: до 2048)
+        self.EMBEDDING_BATCH_MAX_TOKENS: int = int(os.getenv('EMBEDDING_BATCH_MAX_TOKENS', '200000'))  # токенов в запросе (API: до 300K)
+        self.RAG_INDEX_MAX_ITEMS: int = int(os.getenv('RAG_INDEX_MAX_ITEMS', '5000'))  # диалогов в индексе
+        self.RAG_INDEX_REFRESH_DELAY: float = float(os.getenv('RAG_INDEX_REFRESH_DELAY', '0.5'))  # сек, сбор пачки изменений
+        self.RAG_VECTOR_DTYPE: str = os.getenv('RAG_VECTOR_DTYPE', 'int8')  # float32 | float16 | int8 - хранение векторов индекса
+        self.RAG_HYBRID_CANDIDATES: int = int(os.getenv('RAG_HYBRID_CANDIDATES', '50'))  # кандидатов BM25 для переранжирования, 0 - только векторы
+        self.RAG_LEXICAL_MIN_COVERAGE: float = float(os.getenv('RAG_LEXICAL_MIN_COVERAGE', '0.5'))  # доля слов запроса для ответа без эмбеддингов
+        self.RAG_EMBEDDING_TIMEOUT: float = float(os.getenv('RAG_EMBEDDING_TIMEOUT', '3.0'))  # сек на эмбеддинг запроса, дальше - только BM25
+        self.RAG_STREAM_DEADLINE: float = float(os.getenv('RAG_STREAM_DEADLINE', '0.3'))  # сек на RAG в потоковом ответе, дальше - без примеров
+        self.RAG_QUERY_CACHE_SIZE: int = int(os.getenv('RAG_QUERY_CACHE_SIZE', '1000'))  # запросов в кэше эмбеддингов и результатов
+        self.RAG_QUERY_CACHE_TTL: float = float(os.getenv('RAG_QUERY_CACHE_TTL', '3600'))  # сек жизни записи кэша запросов
+        self.RAG_INDEX_BACKEND: str = os.getenv('RAG_INDEX_BACKEND', 'exact')  # exact | ivf (приближенный поиск)
+        self.RAG_IVF_LISTS: int = int(os.getenv('RAG_IVF_LISTS', '0'))  # кластеров IVF, 0 - около sqrt(N)
+        self.RAG_IVF_PROBES: int = int(os.getenv('RAG_IVF_PROBES', '8'))  # кластеров, просматриваемых при поиске
+        self.RAG_INDEX_PATH: str = os.getenv('RAG_INDEX_PATH', 'data/rag_index')  # префикс файлов индекса, пусто - только в памяти
+        self.RAG_INDEX_SAVE_INTERVAL: float = float(os.getenv('RAG_INDEX_SAVE_INTERVAL', '300'))  # сек между сохранениями состояния ANN
+        self.RAG_INDEX_SYNC_INTERVAL: float = float(os.getenv('RAG_INDEX_SYNC_INTERVAL', '5'))  # сек, проверка файлов индекса читателями
+        self.RAG_INDEX_RECONCILE_INTERVAL: float = float(os.getenv('RAG_INDEX_RECONCILE_INTERVAL', '600'))  # сек, сверка индекса с БД писателем
 
         # Настройки логирования
         self.LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
@@ -0,0 +1,178 @@
+"""
+Сборка контекста запроса к OpenAI в пределах бюджета входных токенов
+
+Системный промпт, краткое содержание ранней части диалога, блок RAG и
+последние реплики диалога укладываются в CONTEXT_MAX_INPUT_TOKENS: реплики
+берутся от новых к старым, не влезающая целиком старая реплика обрезается,
+остальные отбрасываются. Так задержка и
+стоимость запроса не зависят от длины сообщений клиента.
+
+Порядок сообщений рассчитан на кэширование промпта у провайдера (кэшируется
+только побайтово совпадающее начало запроса): сначала статический системный
+промпт, затем то, что меняется редко (краткое содержание, прошлые реплики),
+и в конце то, что меняется в каждом запросе (примеры RAG, последнее сообщение).
+
+Токены считаются через tiktoken, если он установлен, иначе - оценкой по
+числу символов (кириллица дороже латиницы), округленной в большую сторону.
+"""
+import logging
+import math
+import re
+from typing import Dict, List, Optional
+
+from config import Config
+config = Config()
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - зависит от окружения
+    tiktoken = None
+
+# Служебные токены на каждое сообщение в формате chat (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Оценка без tiktoken: символов на токен (с запасом для кириллицы)
+CYRILLIC_CHARS_PER_TOKEN = 2.5
+OTHER_CHARS_PER_TOKEN = 4.0
+
+# Остаток бюджета меньше - старую реплику не обрезаем, а отбрасываем
+MIN_TRUNCATED_TOKENS = 50
+
+TRUNCATION_MARK = "… "
+
+SUMMARY_HEADER = "Краткое содержание предыдущей части диалога:\n"
+
+_CYRILLIC_RE = re.compile(r'[а-яёА-ЯЁ]')
+
+
+class ContextBuilder:
+    """Упаковка промпта, краткого содержания, RAG и истории диалога в бюджет токенов"""
+
+    def __init__(self, max_input_tokens: int = None, model: str = None):
+        self.max_input_tokens = max_input_tokens or config.CONTEXT_MAX_INPUT_TOKENS
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model or config.OPENAI_MODEL)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("o200k_base")
+
+    def count_tokens(self, text: str) -> int:
+        """Количество токенов в тексте"""
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        cyrillic = len(_CYRILLIC_RE.findall(text))
+        other = len(text) - cyrillic
+        return math.ceil(cyrillic / CYRILLIC_CHARS_PER_TOKEN + other / OTHER_CHARS_PER_TOKEN)
+
+    def count_message_tokens(self, messages: List[Dict[str, str]]) -> int:
+        """Количество входных токенов запроса"""
+        return sum(self.count_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS for msg in messages)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Обрезка текста до max_tokens с начала (остается конец - самое свежее)
+
+        Returns:
+            Текст с пометкой об обрезке или исходный текст, если он влезает
+        """
+        if self.count_tokens(text) <= max_tokens:
+            return text
+        budget = max(0, max_tokens - self.count_tokens(TRUNCATION_MARK))
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text)
+            return TRUNCATION_MARK + self._encoding.decode(tokens[len(tokens) - budget:]) if budget else TRUNCATION_MARK
+
+        # Оценка: срезаем пропорционально и уточняем
+        keep = int(len(text) * budget / self.count_tokens(text))
+        while keep > 0 and self.count_tokens(text[-keep:]) > budget:
+            keep -= max(1, keep // 20)
+        return TRUNCATION_MARK + text[len(text) - keep:] if keep > 0 else TRUNCATION_MARK
+
+    def build(
+        self,
+        system_prompt: str,
+        conversation_history: List[Dict[str, str]],
+        rag_context: str = "",
+        max_input_tokens: Optional[int] = None,
+        summary: str = ""
+    ) -> List[Dict[str, str]]:
+        """
+        Формирование сообщений запроса в пределах бюджета
+
+        Args:
+            system_prompt: Системный промпт (включается всегда)
+            conversation_history: История диалога от старых к новым
+            rag_context: Примеры успешных диалогов (если влезают)
+            max_input_tokens: Бюджет (по умолчанию CONTEXT_MAX_INPUT_TOKENS)
+            summary: Краткое содержание ранней части диалога (важнее RAG, обрезается при нехватке места)
+
+        Returns:
+            Сообщения в формате OpenAI
+        """
+        budget = (max_input_tokens or self.max_input_tokens)
+        budget -= self.count_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+
+        turns = [
+            {"role": msg["role"], "content": msg.get("content") or msg.get("message") or ""}
+            for msg in conversation_history
+        ]
+
+        # Последнее сообщение клиента нужно всегда - при нехватке места обрезаем даже его
+        last_turn = []
+        if turns:
+            last = turns.pop()
+            content = self.truncate(last["content"], max(MIN_TRUNCATED_TOKENS, budget - MESSAGE_OVERHEAD_TOKENS))
+            last_turn = [{"role": last["role"], "content": content}]
+            budget -= self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+        summary_messages = []
+        if summary:
+            available = budget - MESSAGE_OVERHEAD_TOKENS - self.count_tokens(SUMMARY_HEADER)
+            if available >= MIN_TRUNCATED_TOKENS:
+                content = SUMMARY_HEADER + self.truncate(summary, available)
+                summary_messages = [{"role": "system", "content": content}]
+                budget -= self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+        rag_messages = []
+        if rag_context:
+            rag_tokens = self.count_tokens(rag_context) + MESSAGE_OVERHEAD_TOKENS
+            if rag_tokens <= budget:
+                rag_messages = [{"role": "system", "content": rag_context}]
+                budget -= rag_tokens
+            else:
+                logger.debug(f"RAG context ({rag_tokens} tokens) does not fit the input budget, skipping")
+
+        # Остальные реплики - от новых к старым, пока влезают
+        recent = []
+        for turn in reversed(turns):
+            tokens = self.count_tokens(turn["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if tokens <= budget:
+                recent.append(turn)
+                budget -= tokens
+                continue
+            if budget - MESSAGE_OVERHEAD_TOKENS >= MIN_TRUNCATED_TOKENS:
+                content = self.truncate(turn["content"], budget - MESSAGE_OVERHEAD_TOKENS)
+                recent.append({"role": turn["role"], "content": content})
+            break
+
+        dropped = len(turns) - len(recent)
+        if dropped:
+            logger.debug(f"Context budget: dropped {dropped} older turns")
+
+        # RAG меняется от запроса к запросу - после истории, чтобы не сбивать кэш ее префикса
+        return (
+            [{"role": "system", "content": system_prompt}]
+            + summary_messages
+            + list(reversed(recent))
+            + rag_messages
+            + last_turn
+        )
+
+
+# Глобальный экземпляр
+context_builder = ContextBuilder()
@@ -0,0 +1,110 @@
+"""
+Краткое содержание длинных диалогов для запросов к OpenAI
+
+Вместо полного окна истории в запрос идет краткое содержание ранней части
+диалога (таблица conversation_summaries) и сообщения после него. Содержание
+обновляется в фоне: когда после него накопилось
+CONVERSATION_RECENT_MESSAGES + CONVERSATION_SUMMARY_EVERY сообщений, все,
+кроме последних CONVERSATION_RECENT_MESSAGES, дописываются в содержание.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Set, Tuple
+
+from config import Config
+config = Config()
+import database
+import ai_brain
+import openai_guard
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    """Фоновое обновление краткого содержания диалогов (не больше одного на пользователя)"""
+
+    def __init__(self, every: int = None, recent: int = None):
+        self.every = every or config.CONVERSATION_SUMMARY_EVERY
+        self.recent = recent or config.CONVERSATION_RECENT_MESSAGES
+
+        self._running: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.refreshed = 0
+        self.failed = 0
+
+    def get_context(self, user_id: int, conversation_history: List[Dict]) -> Tuple[str, List[Dict]]:
+        """
+        Краткое содержание и сообщения после него
+
+        Args:
+            user_id: ID пользователя в БД
+            conversation_history: Окно истории из get_conversation_history
+
+        Returns:
+            (краткое содержание или пустая строка, сообщения для запроса)
+        """
+        if self.every <= 0:
+            return "", conversation_history
+
+        summary = database.db.get_conversation_summary(user_id)
+        if not summary:
+            return "", conversation_history
+
+        recent = [msg for msg in conversation_history if msg['id'] > summary['last_message_id']]
+        if not recent:
+            # Содержание новее окна (история очищалась) - отправляем окно как есть
+            return "", conversation_history
+        return summary['summary'], recent
+
+    def schedule_refresh(self, user_id: int):
+        """Запуск фонового обновления содержания, если накопилось достаточно сообщений"""
+        if self.every <= 0 or user_id in self._running:
+            return
+        if not openai_guard.openai_guard.is_available():
+            # Содержание обновится после восстановления OpenAI, пока в запрос идет окно истории
+            return
+        self._running.add(user_id)
+        task = asyncio.create_task(self._refresh(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, user_id: int):
+        try:
+            summary = await database.adb.get_conversation_summary(user_id)
+            after_id = summary['last_message_id'] if summary else 0
+            messages = await database.adb.get_messages_after(user_id, after_id)
+            if len(messages) < self.recent + self.every:
+                return
+
+            to_fold = messages[:-self.recent] if self.recent else messages
+            new_summary = await ai_brain.ai_brain.summarize_conversation_async(
+                summary['summary'] if summary else "", to_fold, user_id=user_id
+            )
+            if not new_summary:
+                self.failed += 1
+                return
+
+            await database.adb.save_conversation_summary(user_id, new_summary, to_fold[-1]['id'])
+            self.refreshed += 1
+            logger.info(f"Conversation summary updated for user {user_id}: +{len(to_fold)} messages")
+
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error updating conversation summary for user {user_id}: {e}")
+        finally:
+            self._running.discard(user_id)
+
+    async def drain(self, timeout: float = 10):
+        """Ожидание запущенных обновлений при остановке"""
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Conversation summary drain timed out, {len(pending)} updates cancelled")
+
+
+# Глобальный экземпляр
+conversation_summarizer = ConversationSummarizer()
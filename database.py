@@ -1,161 +1,174 @@
 """
 Работа с SQLite базой данных
 """
+import asyncio
+import functools
 import sqlite3
+import json
 import logging
-from datetime import datetime
-from typing import Optional, List, Dict, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Tuple, Callable, Iterable, Set
+import migrations
+from history_cache import ConversationCache
 from config import Config
 config = Config()
 
 logger = logging.getLogger(__name__)
 
-
-class Database:
-    """Класс для работы с SQLite базой данных"""
-
-    def __init__(self, db_path: str = None):
-        self.db_path = db_path or config.DB_PATH
-        self.init_database()
-
-    def get_connection(self) -> sqlite3.Connection:
-        """Получение подключения к БД"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # Доступ к колонкам по имени
+# Поля лида, от которых зависит пример в базе знаний RAG
+RAG_LEAD_FIELDS = ('temperature', 'service_category', 'specific_need', 'pain_point', 'industry')
+
+
+def _now_timestamp() -> str:
+    """Время записи в формате CURRENT_TIMESTAMP SQLite (UTC) - то же значение попадает в кэш истории"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих подключений к SQLite
+
+    Подключение открывается один раз (WAL, synchronous=NORMAL, кэш страниц,
+    mmap, кэш подготовленных запросов) и переиспользуется: get_connection
+    выдает его одному вызывающему, close() возвращает в пул. При нехватке
+    свободных открывается новое, лишние сверх size при возврате закрываются.
+    """
+
+    def __init__(self, db_path: str, size: int):
+        self.db_path = db_path
+        self.size = size
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=config.DB_BUSY_TIMEOUT,
+            check_same_thread=False,  # подключение переходит между потоками, но используется одним за раз
+            cached_statements=config.DB_STATEMENT_CACHE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")  # читатели не ждут писателя
+        conn.execute("PRAGMA synchronous=NORMAL")  # в WAL без fsync на каждый коммит, целостность сохраняется
+        conn.execute(f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={config.DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        self.opened += 1
         return conn
 
-    def init_database(self):
-        """Инициализация базы данных и создание таблиц"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
 
+    def release(self, conn: sqlite3.Connection):
         try:
-            # Таблица users
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER UNIQUE NOT NULL,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+            if conn.in_transaction:
+                # Вызывающий не закоммитил - как и при закрытии подключения, изменения откатываются
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
 
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)")
 
-            # Таблица conversations
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    role TEXT NOT NULL,
-                    message TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                )
-            """)
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул, остальное - как у sqlite3.Connection"""
 
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations(timestamp)")
+    def __init__(self, pool: ConnectionPool, conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
 
-            # Таблица leads
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS leads (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
 
-                    name TEXT,
-                    email TEXT,
-                    phone TEXT,
-                    company TEXT,
+    def __enter__(self):
+        return self._conn.__enter__()
 
-                    team_size TEXT,
-                    contracts_per_month TEXT,
-                    pain_point TEXT,
-                    budget TEXT,
-                    urgency TEXT,
-                    industry TEXT,
-                    service_category TEXT,
-                    specific_need TEXT,
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
 
-                    temperature TEXT DEFAULT 'cold',
-                    status TEXT DEFAULT 'new',
-                    notes TEXT,
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
 
-                    lead_magnet_type TEXT,
-                    lead_magnet_delivered BOOLEAN DEFAULT 0,
 
-                    notification_sent BOOLEAN DEFAULT 0,
+class Database:
+    """Класс для работы с SQLite базой данных"""
 
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    def __init__(self, db_path: str = None, pool_size: int = None):
+        self.db_path = db_path or config.DB_PATH
+        # 0 - без пула: новое подключение на каждый вызов (для сравнения в bench_database.py)
+        pool_size = config.DB_POOL_SIZE if pool_size is None else pool_size
+        self._pool = ConnectionPool(self.db_path, pool_size) if pool_size > 0 else None
+        # Подписчики на изменения лидов и диалогов: callback(event, user_id, lead_id)
+        self._change_listeners: List[Callable] = []
+        # Последние сообщения диалогов в памяти (обновляется при записи через Database)
+        self.history_cache = ConversationCache()
+        self.init_database()
 
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                )
-            """)
+    def add_change_listener(self, callback: Callable):
+        """
+        Подписка на изменения данных
 
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_user_id ON leads(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_temperature ON leads(temperature)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_status ON leads(status)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_created_at ON leads(created_at)")
+        События: 'lead_updated' (изменились поля RAG_LEAD_FIELDS лида),
+        'conversation_updated' (новое сообщение или очистка истории пользователя)
 
-            # Таблица admin_notifications
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS admin_notifications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    lead_id INTEGER NOT NULL,
-                    notification_type TEXT NOT NULL,
-                    message TEXT,
-                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    read_at TIMESTAMP,
-                    FOREIGN KEY (lead_id) REFERENCES leads(id) ON DELETE CASCADE
-                )
-            """)
+        Args:
+            callback: Функция callback(event, user_id, lead_id)
+        """
+        self._change_listeners.append(callback)
 
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_lead_id ON admin_notifications(lead_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_sent_at ON admin_notifications(sent_at)")
+    def _notify_change(self, event: str, user_id: int, lead_id: int = None):
+        """Уведомление подписчиков (ошибки подписчиков не влияют на запись)"""
+        for callback in self._change_listeners:
+            try:
+                callback(event, user_id, lead_id)
+            except Exception as e:
+                logger.warning(f"Change listener failed for {event}: {e}")
 
-            # Миграция: добавляем notification_sent если его нет
-            cursor.execute("PRAGMA table_info(leads)")
-            columns = [column[1] for column in cursor.fetchall()]
-            
-            if 'notification_sent' not in columns:
-                cursor.execute("ALTER TABLE leads ADD COLUMN notification_sent BOOLEAN DEFAULT 0")
-                logger.info("Added notification_sent column to leads table")
-            
-            # Миграция: добавляем service_category и specific_need
-            if 'service_category' not in columns:
-                cursor.execute("ALTER TABLE leads ADD COLUMN service_category TEXT")
-                logger.info("Added service_category column to leads table")
-            
-            if 'specific_need' not in columns:
-                cursor.execute("ALTER TABLE leads ADD COLUMN specific_need TEXT")
-                logger.info("Added specific_need column to leads table")
-            
-            # Миграция: добавляем last_message_at для отложенного уведомления
-            if 'last_message_at' not in columns:
-                cursor.execute("ALTER TABLE leads ADD COLUMN last_message_at TIMESTAMP")
-                logger.info("Added last_message_at column to leads table")
+    def get_connection(self) -> sqlite3.Connection:
+        """Получение подключения к БД (из пула; close() возвращает его в пул)"""
+        if self._pool is not None:
+            return PooledConnection(self._pool, self._pool.acquire())
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row  # Доступ к колонкам по имени
+        return conn
 
-            conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
-            logger.info("Database initialized successfully")
+    def close(self):
+        """Закрытие свободных подключений пула"""
+        if self._pool is not None:
+            self._pool.close_all()
+
+    def init_database(self):
+        """Инициализация базы данных: применение недостающих миграций схемы (migrations.py)"""
+        conn = self.get_connection()
+
+        try:
+            applied = migrations.apply_migrations(conn)
+            logger.info(
+                f"Database initialized successfully (schema version {migrations.LATEST_VERSION}, "
+                f"{applied} migrations applied)"
+            )
 
         except Exception as e:
             logger.error(f"Error initializing database: {e}")
-            conn.rollback()
             raise
         finally:
             conn.close()
@@ -180,17 +193,6 @@ class Database:
             """, (telegram_id, username, first_name, last_name))
 
             conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
 
             cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
             user_id = cursor.fetchone()[0]
@@ -245,24 +247,18 @@ class Database:
         cursor = conn.cursor()
 
         try:
+            timestamp = _now_timestamp()
             cursor.execute("""
-                INSERT INTO conversations (user_id, role, message)
-                VALUES (?, ?, ?)
-            """, (user_id, role, message))
+                INSERT INTO conversations (user_id, role, message, timestamp)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, role, message, timestamp))
 
             conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
+            self.history_cache.append(user_id, [
+                {'id': cursor.lastrowid, 'role': role, 'message': message, 'timestamp': timestamp}
+            ])
             logger.debug(f"Message added for user {user_id}, role {role}")
+            self._notify_change('conversation_updated', user_id)
 
         except Exception as e:
             logger.error(f"Error adding message: {e}")
@@ -271,25 +267,108 @@ class Database:
         finally:
             conn.close()
 
-    def get_conversation_history(self, user_id: int, limit: int = None) -> List[Dict]:
-        """Получение истории диалога"""
+    def add_messages(self, messages: List[Tuple[int, str, str]], touched_user_ids: Iterable[int] = ()):
+        """
+        Пакетная запись сообщений одной транзакцией (групповой коммит MessageJournal)
+
+        Args:
+            messages: (user_id, role, message) в порядке поступления
+            touched_user_ids: Пользователи, у лида которых обновить last_message_at
+        """
+        touched_user_ids = list(touched_user_ids)
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
-            limit = limit or config.MAX_HISTORY_MESSAGES
+            # По одному INSERT - нужны id сообщений для кэша истории (транзакция все равно одна)
+            timestamp = _now_timestamp()
+            written: Dict[int, List[Dict]] = {}
+            for user_id, role, message in messages:
+                cursor.execute("""
+                    INSERT INTO conversations (user_id, role, message, timestamp)
+                    VALUES (?, ?, ?, ?)
+                """, (user_id, role, message, timestamp))
+                written.setdefault(user_id, []).append(
+                    {'id': cursor.lastrowid, 'role': role, 'message': message, 'timestamp': timestamp}
+                )
+            cursor.executemany("""
+                UPDATE leads
+                SET last_message_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            """, [(user_id,) for user_id in touched_user_ids])
 
+            conn.commit()
+            logger.debug(f"Journal batch written: {len(messages)} messages, {len(touched_user_ids)} leads touched")
+
+        except Exception as e:
+            logger.error(f"Error writing message batch: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        for user_id, user_messages in written.items():
+            self.history_cache.append(user_id, user_messages)
+            self._notify_change('conversation_updated', user_id)
+
+    def get_conversation_history(self, user_id: int, limit: int = None) -> List[Dict]:
+        """Получение истории диалога (из кэша истории, если окно пользователя в нем)"""
+        limit = limit or config.MAX_HISTORY_MESSAGES
+        cached = self.history_cache.get(user_id, limit)
+        if cached is not None:
+            return cached
+        return self._load_conversation_history(user_id, limit)
+
+    def _load_conversation_history(self, user_id: int, limit: int) -> List[Dict]:
+        """Чтение истории из БД с заполнением кэша истории"""
+        token = self.history_cache.begin_load(user_id)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
             cursor.execute("""
-                SELECT role, message, timestamp
+                SELECT id, role, message, timestamp
                 FROM conversations
                 WHERE user_id = ?
-                ORDER BY timestamp DESC
+                ORDER BY timestamp DESC, id DESC
                 LIMIT ?
             """, (user_id, limit))
 
             rows = cursor.fetchall()
             # Возвращаем в обратном порядке (от старых к новым)
-            return [dict(row) for row in reversed(rows)]
+            history = [dict(row) for row in reversed(rows)]
+
+        except Exception:
+            self.history_cache.abort_load(user_id)
+            raise
+        finally:
+            conn.close()
+
+        self.history_cache.put(user_id, [dict(msg) for msg in history], limit, token)
+        return history
+
+    def get_messages_after(self, user_id: int, after_id: int, limit: int = 200) -> List[Dict]:
+        """
+        Сообщения диалога после указанного (от старых к новым)
+
+        Args:
+            user_id: ID пользователя
+            after_id: ID сообщения, после которого читать (0 - с начала)
+            limit: Максимум сообщений
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("""
+                SELECT id, role, message, timestamp
+                FROM conversations
+                WHERE user_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            """, (user_id, after_id, limit))
+
+            return [dict(row) for row in cursor.fetchall()]
 
         finally:
             conn.close()
@@ -301,19 +380,12 @@ class Database:
 
         try:
             cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM lead_extraction_state WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM conversation_summaries WHERE user_id = ?", (user_id,))
             conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
+            self.history_cache.reset(user_id)
             logger.info(f"Conversation history cleared for user {user_id}")
+            self._notify_change('conversation_updated', user_id)
 
         except Exception as e:
             logger.error(f"Error clearing conversation: {e}")
@@ -338,18 +410,22 @@ class Database:
             # Ищем существующий лид с ТЕМ ЖЕ company + email
             if company and email:
                 cursor.execute(
-                    "SELECT id FROM leads WHERE user_id = ? AND company = ? AND email = ?",
+                    "SELECT * FROM leads WHERE user_id = ? AND company = ? AND email = ?",
                     (user_id, company, email)
                 )
             else:
                 # Если нет компании или email, ищем по user_id
-                cursor.execute("SELECT id FROM leads WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", (user_id,))
+                cursor.execute("SELECT * FROM leads WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", (user_id,))
             
             existing = cursor.fetchone()
 
             if existing:
                 # Обновляем существующий лид
-                lead_id = existing[0]
+                lead_id = existing['id']
+                rag_changed = any(
+                    lead_data.get(field) is not None and lead_data[field] != existing[field]
+                    for field in RAG_LEAD_FIELDS
+                )
 
                 update_fields = []
                 values = []
@@ -376,20 +452,14 @@ class Database:
                 cursor.execute(query, values)
 
                 lead_id = cursor.lastrowid
+                rag_changed = any(lead_data.get(field) is not None for field in RAG_LEAD_FIELDS)
                 logger.info(f"Lead {lead_id} created for user {user_id}")
 
             conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
+
+            if rag_changed:
+                self._notify_change('lead_updated', user_id, lead_id)
+
             return lead_id
 
         except Exception as e:
@@ -428,17 +498,6 @@ class Database:
             """, (lead_id,))
 
             conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
             logger.info(f"Lead {lead_id} marked as notification sent")
 
         except Exception as e:
@@ -545,17 +604,6 @@ class Database:
             """, (user_id,))
             
             conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
             logger.debug(f"Updated last_message_at for user {user_id}")
             
         except Exception as e:
@@ -594,40 +642,78 @@ class Database:
             """, (limit,))
             
             leads = [dict(row) for row in cursor.fetchall()]
+            result = [self._build_rag_conversation(cursor, lead) for lead in leads]
+            
+            logger.info(f"Retrieved {len(result)} successful conversations for RAG")
+            return result
             
-            # Для каждого лида получаем историю диалога
+        finally:
+            conn.close()
+    
+    def get_successful_conversations_by_lead_ids(self, lead_ids: List[int]) -> List[Dict]:
+        """
+        Получение успешных диалогов только для указанных лидов
+        
+        Лиды, которые больше не подходят для RAG (остыли, удалены), в результат не попадают.
+        
+        Args:
+            lead_ids: ID лидов
+            
+        Returns:
+            Список словарей в формате get_successful_conversations
+        """
+        if not lead_ids:
+            return []
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
             result = []
-            for lead in leads:
-                user_id = lead['user_id']
-                
-                # Получаем сообщения диалога
-                cursor.execute("""
-                    SELECT role, message, timestamp
-                    FROM conversations
-                    WHERE user_id = ?
-                    ORDER BY timestamp ASC
-                """, (user_id,))
-                
-                messages = [dict(row) for row in cursor.fetchall()]
+            for i in range(0, len(lead_ids), 500):
+                chunk = list(lead_ids[i:i + 500])
+                placeholders = ', '.join(['?'] * len(chunk))
+                cursor.execute(f"""
+                    SELECT l.*
+                    FROM leads l
+                    WHERE l.id IN ({placeholders})
+                      AND l.temperature IN ('warm', 'hot')
+                      AND (l.service_category IS NOT NULL OR l.pain_point IS NOT NULL)
+                """, chunk)
                 
-                # Формируем полный объект
-                result.append({
-                    'lead_id': lead['id'],
-                    'user_id': user_id,
-                    'service_category': lead.get('service_category'),
-                    'specific_need': lead.get('specific_need'),
-                    'pain_point': lead.get('pain_point'),
-                    'industry': lead.get('industry'),
-                    'temperature': lead.get('temperature'),
-                    'messages': messages
-                })
+                leads = [dict(row) for row in cursor.fetchall()]
+                result.extend(self._build_rag_conversation(cursor, lead) for lead in leads)
             
-            logger.info(f"Retrieved {len(result)} successful conversations for RAG")
             return result
             
         finally:
             conn.close()
     
+    def _build_rag_conversation(self, cursor: sqlite3.Cursor, lead: Dict) -> Dict:
+        """Объект диалога для RAG: метаданные лида + сообщения"""
+        user_id = lead['user_id']
+        
+        # Получаем сообщения диалога
+        cursor.execute("""
+            SELECT role, message, timestamp
+            FROM conversations
+            WHERE user_id = ?
+            ORDER BY timestamp ASC
+        """, (user_id,))
+        
+        messages = [dict(row) for row in cursor.fetchall()]
+        
+        return {
+            'lead_id': lead['id'],
+            'user_id': user_id,
+            'service_category': lead.get('service_category'),
+            'specific_need': lead.get('specific_need'),
+            'pain_point': lead.get('pain_point'),
+            'industry': lead.get('industry'),
+            'temperature': lead.get('temperature'),
+            'messages': messages
+        }
+    
     def get_conversations_by_category(
         self, 
         service_category: str, 
@@ -697,235 +783,270 @@ class Database:
         finally:
             conn.close()
 
-    # === ADMIN NOTIFICATIONS ===
+    # === EMBEDDING CACHE ===
+
+    def get_cached_embeddings(self, content_hashes: List[str]) -> Dict[str, bytes]:
+        """
+        Получение сохраненных эмбеддингов по хэшам
+
+        Args:
+            content_hashes: Список хэшей (текст + модель)
+
+        Returns:
+            Словарь {хэш: сырые байты float32 вектора} только для найденных
+        """
+        if not content_hashes:
+            return {}
 
-    def create_notification(self, lead_id: int, notification_type: str,
-                            message: str) -> int:
-        """Создание уведомления для админа"""
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
-            cursor.execute("""
-                INSERT INTO admin_notifications (lead_id, notification_type, message)
-                VALUES (?, ?, ?)
-            """, (lead_id, notification_type, message))
-
-            conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            result = {}
+            # Ограничение SQLite на количество параметров - читаем пачками
+            for i in range(0, len(content_hashes), 500):
+                chunk = content_hashes[i:i + 500]
+                placeholders = ', '.join(['?'] * len(chunk))
+                cursor.execute(
+                    f"SELECT content_hash, vector FROM embedding_cache WHERE content_hash IN ({placeholders})",
+                    chunk
                 )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
-            notification_id = cursor.lastrowid
+                for row in cursor.fetchall():
+                    result[row['content_hash']] = row['vector']
 
-            logger.info(f"Notification {notification_id} created for lead {lead_id}")
-            return notification_id
+            return result
 
-        except Exception as e:
-            logger.error(f"Error creating notification: {e}")
-            conn.rollback()
-            raise
         finally:
             conn.close()
 
-    # === STATISTICS ===
+    def save_cached_embeddings(self, items: List[Tuple[str, str, int, bytes]]):
+        """
+        Сохранение эмбеддингов в кэш
+
+        Args:
+            items: Список кортежей (хэш, модель, размерность, байты float32 вектора)
+        """
+        if not items:
+            return
 
-    def get_statistics(self, days: int = 30) -> Dict:
-        """Получение статистики"""
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
-            stats = {}
-
-            # Общее количество пользователей
-            cursor.execute("SELECT COUNT(*) FROM users")
-            stats['total_users'] = cursor.fetchone()[0]
-
-            # Новые пользователи за период
-            cursor.execute("""
-                SELECT COUNT(*) FROM users
-                WHERE created_at >= datetime('now', '-' || ? || ' days')
-            """, (days,))
-            stats['new_users'] = cursor.fetchone()[0]
-
-            # Общее количество лидов
-            cursor.execute("SELECT COUNT(*) FROM leads")
-            stats['total_leads'] = cursor.fetchone()[0]
-
-            # Лиды по температуре
-            for temp in ['hot', 'warm', 'cold']:
-                cursor.execute("SELECT COUNT(*) FROM leads WHERE temperature = ?", (temp,))
-                stats[f'{temp}_leads'] = cursor.fetchone()[0]
-
-            # Общее количество сообщений
-            cursor.execute("SELECT COUNT(*) FROM conversations")
-            stats['total_messages'] = cursor.fetchone()[0]
+            cursor.executemany("""
+                INSERT OR REPLACE INTO embedding_cache (content_hash, model, dim, vector)
+                VALUES (?, ?, ?, ?)
+            """, items)
 
-            # Средняя длина диалога
-            cursor.execute("""
-                SELECT AVG(msg_count)
-                FROM (
-                    SELECT user_id, COUNT(*) as msg_count
-                    FROM conversations
-                    GROUP BY user_id
-                )
-            """)
-            result = cursor.fetchone()[0]
-            stats['avg_conversation_length'] = round(result, 1) if result else 0
+            conn.commit()
+            logger.debug(f"Saved {len(items)} embeddings to cache")
 
-            # Lead Magnets
-            cursor.execute("SELECT COUNT(*) FROM leads WHERE lead_magnet_type = 'consultation'")
-            stats['consultations'] = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"Error saving embeddings to cache: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
-            cursor.execute("SELECT COUNT(*) FROM leads WHERE lead_magnet_type = 'checklist'")
-            stats['checklists'] = cursor.fetchone()[0]
+    # === CONVERSATION SUMMARIES ===
 
-            cursor.execute("SELECT COUNT(*) FROM leads WHERE lead_magnet_type = 'demo_analysis'")
-            stats['demos'] = cursor.fetchone()[0]
+    def get_conversation_summary(self, user_id: int) -> Optional[Dict]:
+        """Краткое содержание диалога: summary и last_message_id (последнее учтенное сообщение)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
 
-            return stats
+        try:
+            cursor.execute(
+                "SELECT summary, last_message_id, updated_at FROM conversation_summaries WHERE user_id = ?",
+                (user_id,)
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
 
         finally:
             conn.close()
 
+    def save_conversation_summary(self, user_id: int, summary: str, last_message_id: int):
+        """Сохранение краткого содержания диалога"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
 
-# Создание глобального экземпляра базы данных
-db = Database()
+        try:
+            cursor.execute("""
+                INSERT INTO conversation_summaries (user_id, summary, last_message_id)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    last_message_id = excluded.last_message_id,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (user_id, summary, last_message_id))
 
+            conn.commit()
 
-if __name__ == '__main__':
-    # Инициализация логирования
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+        except Exception as e:
+            logger.error(f"Error saving conversation summary: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
-    print("Initializing database...")
-    db = Database()
-    print("Database initialized successfully!")
+    # === LEAD EXTRACTION STATE ===
 
-    # === CHAT STATES ===
+    def get_lead_extraction_state(self, user_id: int) -> Optional[Dict]:
+        """
+        Результат последнего извлечения данных лида по диалогу
 
-    def is_chat_enabled(self, chat_id: int) -> bool:
-        """Проверка, включен ли чат"""
+        Returns:
+            Словарь с lead_data (dict), last_message_id, incremental_runs и счетчиками токенов или None
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
-            cursor.execute("SELECT is_enabled FROM chat_states WHERE chat_id = ?", (chat_id,))
+            cursor.execute("SELECT * FROM lead_extraction_state WHERE user_id = ?", (user_id,))
             row = cursor.fetchone()
-            
-            # Если записи нет, считаем чат включенным (по умолчанию)
-            return row[0] if row else True
-            
+            if not row:
+                return None
+            state = dict(row)
+            state['lead_data'] = json.loads(state['lead_data'])
+            return state
+
         finally:
             conn.close()
 
-    def set_chat_enabled(self, chat_id: int, enabled: bool):
-        """Включение/отключение чата"""
+    def save_lead_extraction_state(self, user_id: int, lead_data: Dict, last_message_id: int,
+                                   incremental_runs: int, prompt_tokens: int, full_prompt_tokens: int):
+        """
+        Сохранение результата извлечения данных лида
+
+        Args:
+            user_id: ID пользователя
+            lead_data: Извлеченные данные
+            last_message_id: ID последнего учтенного сообщения
+            incremental_runs: Инкрементальных извлечений после последнего полного
+            prompt_tokens: Оценка токенов отправленного промпта (прибавляется к счетчику)
+            full_prompt_tokens: Оценка токенов промпта с полной историей (прибавляется к счетчику)
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
             cursor.execute("""
-                INSERT INTO chat_states (chat_id, is_enabled, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-                ON CONFLICT(chat_id) DO UPDATE SET
-                    is_enabled = excluded.is_enabled,
+                INSERT INTO lead_extraction_state
+                    (user_id, lead_data, last_message_id, incremental_runs, prompt_tokens, full_prompt_tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    lead_data = excluded.lead_data,
+                    last_message_id = excluded.last_message_id,
+                    incremental_runs = excluded.incremental_runs,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    full_prompt_tokens = full_prompt_tokens + excluded.full_prompt_tokens,
                     updated_at = CURRENT_TIMESTAMP
-            """, (chat_id, enabled))
-            
+            """, (user_id, json.dumps(lead_data, ensure_ascii=False), last_message_id,
+                  incremental_runs, prompt_tokens, full_prompt_tokens))
+
             conn.commit()
-            # Миграция: добавляем таблицу для состояний чатов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_states (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER UNIQUE NOT NULL,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
-            logger.info(f"Chat {chat_id} {'enabled' if enabled else 'disabled'}")
-            
+
         except Exception as e:
-            logger.error(f"Error setting chat enabled state: {e}")
+            logger.error(f"Error saving lead extraction state: {e}")
             conn.rollback()
             raise
         finally:
             conn.close()
 
-    def get_disabled_chats(self) -> list:
-        """Получение списка отключенных чатов"""
+    def get_lead_extraction_savings(self) -> Dict:
+        """Суммарные токены промптов извлечения: отправлено и сколько было бы с полной историей"""
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
-            cursor.execute("SELECT chat_id FROM chat_states WHERE is_enabled = 0")
-            return [row[0] for row in cursor.fetchall()]
-            
+            cursor.execute("""
+                SELECT COUNT(*) as conversations,
+                       COALESCE(SUM(prompt_tokens), 0) as prompt_tokens,
+                       COALESCE(SUM(full_prompt_tokens), 0) as full_prompt_tokens
+                FROM lead_extraction_state
+            """)
+            return dict(cursor.fetchone())
+
         finally:
             conn.close()
 
-    # === CHAT STATES ===
+    # === TOKEN USAGE ===
 
-    def is_chat_enabled(self, chat_id: int) -> bool:
-        """Проверка, включен ли чат"""
+    def add_token_usage(self, rows: List[Tuple[int, str, int, int, int, int]]):
+        """
+        Пакетное добавление расхода токенов
+
+        Args:
+            rows: (user_id, day, requests, prompt_tokens, completion_tokens, cached_tokens) -
+                прибавляются к уже записанным значениям
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
-            cursor.execute("SELECT is_enabled FROM chat_states WHERE chat_id = ?", (chat_id,))
-            row = cursor.fetchone()
-            
-            # Если записи нет, считаем чат включенным (по умолчанию)
-            return row[0] if row else True
-            
+            cursor.executemany("""
+                INSERT INTO token_usage (user_id, day, requests, prompt_tokens, completion_tokens, cached_tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, day) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    cached_tokens = cached_tokens + excluded.cached_tokens
+            """, rows)
+
+            conn.commit()
+
+        except Exception as e:
+            logger.error(f"Error saving token usage: {e}")
+            conn.rollback()
+            raise
         finally:
             conn.close()
 
-    def set_chat_enabled(self, chat_id: int, enabled: bool):
-        """Включение/отключение чата"""
+    def get_token_usage_totals(self, day: str) -> Dict:
+        """Суммарный расход токенов за день (YYYY-MM-DD) по всем пользователям"""
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
             cursor.execute("""
-                INSERT INTO chat_states (chat_id, is_enabled, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-                ON CONFLICT(chat_id) DO UPDATE SET
-                    is_enabled = excluded.is_enabled,
-                    updated_at = CURRENT_TIMESTAMP
-            """, (chat_id, enabled))
-            
-            conn.commit()
-            logger.info(f"Chat {chat_id} {'enabled' if enabled else 'disabled'}")
-            
-        except Exception as e:
-            logger.error(f"Error setting chat enabled state: {e}")
-            conn.rollback()
-            raise
+                SELECT COALESCE(SUM(requests), 0) as requests,
+                       COALESCE(SUM(prompt_tokens), 0) as prompt_tokens,
+                       COALESCE(SUM(completion_tokens), 0) as completion_tokens,
+                       COALESCE(SUM(cached_tokens), 0) as cached_tokens
+                FROM token_usage
+                WHERE day = ?
+            """, (day,))
+            return dict(cursor.fetchone())
+
         finally:
             conn.close()
 
-    def get_disabled_chats(self) -> list:
-        """Получение списка отключенных чатов"""
+    # === ADMIN NOTIFICATIONS ===
+
+    def create_notification(self, lead_id: int, notification_type: str,
+                            message: str) -> int:
+        """Создание уведомления для админа"""
         conn = self.get_connection()
         cursor = conn.cursor()
 
         try:
-            cursor.execute("SELECT chat_id FROM chat_states WHERE is_enabled = 0")
-            return [row[0] for row in cursor.fetchall()]
-            
+            cursor.execute("""
+                INSERT INTO admin_notifications (lead_id, notification_type, message)
+                VALUES (?, ?, ?)
+            """, (lead_id, notification_type, message))
+
+            conn.commit()
+            notification_id = cursor.lastrowid
+
+            logger.info(f"Notification {notification_id} created for lead {lead_id}")
+            return notification_id
+
+        except Exception as e:
+            logger.error(f"Error creating notification: {e}")
+            conn.rollback()
+            raise
         finally:
             conn.close()
 
@@ -981,3 +1102,363 @@ if __name__ == '__main__':
             
         finally:
             conn.close()
+
+    # === STATISTICS ===
+
+    def get_statistics(self, days: int = 30) -> Dict:
+        """Получение статистики"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            stats = {}
+
+            # Общее количество пользователей
+            cursor.execute("SELECT COUNT(*) FROM users")
+            stats['total_users'] = cursor.fetchone()[0]
+
+            # Новые пользователи за период
+            cursor.execute("""
+                SELECT COUNT(*) FROM users
+                WHERE created_at >= datetime('now', '-' || ? || ' days')
+            """, (days,))
+            stats['new_users'] = cursor.fetchone()[0]
+
+            # Общее количество лидов
+            cursor.execute("SELECT COUNT(*) FROM leads")
+            stats['total_leads'] = cursor.fetchone()[0]
+
+            # Лиды по температуре
+            for temp in ['hot', 'warm', 'cold']:
+                cursor.execute("SELECT COUNT(*) FROM leads WHERE temperature = ?", (temp,))
+                stats[f'{temp}_leads'] = cursor.fetchone()[0]
+
+            # Общее количество сообщений
+            cursor.execute("SELECT COUNT(*) FROM conversations")
+            stats['total_messages'] = cursor.fetchone()[0]
+
+            # Средняя длина диалога
+            cursor.execute("""
+                SELECT AVG(msg_count)
+                FROM (
+                    SELECT user_id, COUNT(*) as msg_count
+                    FROM conversations
+                    GROUP BY user_id
+                )
+            """)
+            result = cursor.fetchone()[0]
+            stats['avg_conversation_length'] = round(result, 1) if result else 0
+
+            # Lead Magnets
+            cursor.execute("SELECT COUNT(*) FROM leads WHERE lead_magnet_type = 'consultation'")
+            stats['consultations'] = cursor.fetchone()[0]
+
+            cursor.execute("SELECT COUNT(*) FROM leads WHERE lead_magnet_type = 'checklist'")
+            stats['checklists'] = cursor.fetchone()[0]
+
+            cursor.execute("SELECT COUNT(*) FROM leads WHERE lead_magnet_type = 'demo_analysis'")
+            stats['demos'] = cursor.fetchone()[0]
+
+            return stats
+
+        finally:
+            conn.close()
+
+
+class MessageJournal:
+    """
+    Отложенная запись сообщений диалогов с групповым коммитом
+
+    AsyncDatabase.add_message и update_lead_last_message_time не пишут сразу,
+    а кладут запись в журнал и возвращаются. Через DB_GROUP_COMMIT_MS после
+    первой записи (или при DB_GROUP_COMMIT_MAX записях) все накопленное от
+    всех пользователей уходит в поток записи одной транзакцией. Пока пакет
+    пишется, следующий копится и уходит сразу после него - чем выше нагрузка,
+    тем крупнее пакеты.
+
+    Неудачный пакет повторяется до DB_GROUP_COMMIT_RETRIES раз прямо в потоке
+    записи (остальная запись ждет за ним), потом отбрасывается с записью в
+    лог; ждущие его чтения получают ошибку.
+
+    Чтение своих записей: чтение истории и лида пользователя с записями в
+    журнале сначала отправляет журнал в БД и ждет коммита. Любая другая запись
+    через AsyncDatabase ставится в поток записи после журнала, так что порядок
+    (например, сообщение, затем очистка истории) сохраняется.
+    """
+
+    def __init__(self, adb: 'AsyncDatabase', delay_ms: float = None, max_batch: int = None, max_retries: int = None):
+        self._adb = adb
+        self.delay = (config.DB_GROUP_COMMIT_MS if delay_ms is None else delay_ms) / 1000
+        self.max_batch = max_batch or config.DB_GROUP_COMMIT_MAX
+        self.max_retries = config.DB_GROUP_COMMIT_RETRIES if max_retries is None else max_retries
+
+        self._messages: List[Tuple[int, str, str]] = []
+        self._touched: Set[int] = set()
+        self._batch_done: Optional[asyncio.Future] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Пакетов в потоке записи; пока он занят, следующий пакет копится
+        self._in_flight = 0
+        self._flush_requested = False
+        # user_id -> коммит пакета с последней записью пользователя (пока не записан)
+        self._unwritten: Dict[int, asyncio.Future] = {}
+
+        self.batches = 0
+        self.written = 0
+        self.largest_batch = 0
+        self.failed_batches = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.delay > 0
+
+    def append(self, user_id: int, role: str, message: str):
+        self._messages.append((user_id, role, message))
+        self._mark(user_id)
+        if len(self._messages) >= self.max_batch:
+            self.flush()
+
+    def touch(self, user_id: int):
+        self._touched.add(user_id)
+        self._mark(user_id)
+
+    def _mark(self, user_id: int):
+        if self._batch_done is None:
+            loop = asyncio.get_running_loop()
+            self._batch_done = loop.create_future()
+            self._timer = loop.call_later(self.delay, self.request_flush)
+        self._unwritten[user_id] = self._batch_done
+
+    def request_flush(self):
+        """Коммит при первой возможности: сразу, если поток записи не занят пакетом журнала, иначе после него"""
+        if self._in_flight:
+            self._flush_requested = True
+        else:
+            self.flush()
+
+    def flush(self):
+        """Отправка накопленного в поток записи сразу (не ждет коммита)"""
+        self._flush_requested = False
+        if self._batch_done is None:
+            return
+        self._timer.cancel()
+        messages, touched, done = self._messages, self._touched, self._batch_done
+        self._messages, self._touched, self._batch_done, self._timer = [], set(), None, None
+
+        self._in_flight += 1
+        written = self._adb._submit(self._adb._writer, self._write_batch, messages, touched)
+        written.add_done_callback(lambda future: self._on_written(future, messages, touched, done))
+
+    def _write_batch(self, messages, touched) -> None:
+        """
+        Запись пакета с повторами (в потоке записи)
+
+        Повторы идут здесь же, с паузой в потоке записи: пока пакет не
+        записан или не отброшен, поток не берет следующие пакеты и другую
+        запись (например, очистку истории) - порядок записи не меняется.
+        """
+        attempt = 0
+        while True:
+            try:
+                self._adb.db.add_messages(messages, touched)
+                return
+            except Exception as e:
+                self.failed_batches += 1
+                if attempt >= self.max_retries:
+                    raise
+                delay = max(self.delay, 0.05) * 2 ** attempt
+                attempt += 1
+                logger.warning(
+                    f"Message journal batch failed ({len(messages)} messages), "
+                    f"retry {attempt}/{self.max_retries} in {delay:.2f}s: {e}"
+                )
+                time.sleep(delay)
+
+    def _on_written(self, future: asyncio.Future, messages, touched, done: asyncio.Future):
+        self._in_flight -= 1
+        error = future.exception() if not future.cancelled() else asyncio.CancelledError()
+        for user_id, batch in list(self._unwritten.items()):
+            if batch is done:
+                del self._unwritten[user_id]
+
+        if error is None:
+            self.batches += 1
+            self.written += len(messages)
+            self.largest_batch = max(self.largest_batch, len(messages))
+            done.set_result(None)
+        else:
+            self.dropped += len(messages)
+            users = sorted({user_id for user_id, _, _ in messages} | set(touched))
+            logger.error(
+                f"Message journal batch dropped after {self.max_retries + 1} attempts: "
+                f"{len(messages)} messages, {len(touched)} lead touches, users {users}: {error}"
+            )
+            # Ждущие чтения получают ошибку записи вместо истории без своих сообщений
+            done.set_exception(error)
+            done.add_done_callback(lambda f: f.exception())  # без ждущих не логировать "never retrieved"
+
+        if self._flush_requested and not self._in_flight:
+            self.flush()
+
+    async def wait_for(self, user_id: int):
+        """Ожидание коммита записей пользователя (чтение своих записей)"""
+        batch = self._unwritten.get(user_id)
+        if batch is None:
+            return
+        if batch is self._batch_done:
+            self.request_flush()
+        await asyncio.shield(batch)
+
+    async def drain(self):
+        """Запись всего журнала (при остановке бота)"""
+        self.flush()
+        pending = set(self._unwritten.values())
+        if pending:
+            await asyncio.wait(pending)
+
+    def get_stats(self) -> Dict:
+        return {
+            'batches': self.batches,
+            'written': self.written,
+            'largest_batch': self.largest_batch,
+            'failed_batches': self.failed_batches,
+            'dropped': self.dropped,
+            'avg_batch': self.written / self.batches if self.batches else 0.0,
+        }
+
+
+class AsyncDatabase:
+    """
+    Асинхронный доступ к Database для обработчиков Telegram
+
+    Запросы не выполняются в цикле событий: запись идет в одном выделенном
+    потоке строго по очереди (SQLite все равно допускает одного писателя, так
+    запись не ждет блокировку), чтение - в пуле из DB_READER_THREADS потоков
+    (в WAL читатели не мешают писателю и друг другу). Медленный коммит или
+    тяжелый отчет задерживают только свой запрос, остальные чаты обслуживаются.
+
+    Методы Database вызываются с await под теми же именами: await adb.add_message(...).
+    Произвольная работа с БД - через run_read/run_write (из фоновых потоков -
+    run_write_blocking). Сообщения диалогов и
+    время последнего сообщения лида пишутся через MessageJournal.
+    """
+
+    # Методы Database, которые пишут в БД
+    WRITE_METHODS = frozenset({
+        'create_or_update_user', 'add_message', 'clear_conversation_history',
+        'create_or_update_lead', 'mark_lead_notification_sent', 'update_lead_last_message_time',
+        'save_cached_embeddings', 'save_conversation_summary', 'save_lead_extraction_state',
+        'add_token_usage', 'create_notification', 'set_chat_enabled',
+    })
+    # Методы Database, которые только читают
+    READ_METHODS = frozenset({
+        'get_user_by_telegram_id', 'get_user_by_id', 'get_conversation_history', 'get_messages_after',
+        'get_lead_by_user_id', 'get_lead_by_id', 'get_all_leads', 'get_leads_ready_for_notification',
+        'get_successful_conversations', 'get_successful_conversations_by_lead_ids',
+        'get_conversations_by_category', 'get_cached_embeddings', 'get_conversation_summary',
+        'get_lead_extraction_state', 'get_lead_extraction_savings', 'get_token_usage_totals',
+        'is_chat_enabled', 'get_disabled_chats', 'get_statistics',
+    })
+    # Чтения по user_id, которые должны видеть записи пользователя из журнала
+    JOURNAL_READS = frozenset({'get_conversation_history', 'get_messages_after', 'get_lead_by_user_id'})
+
+    def __init__(self, db: Optional[Database] = None, readers: int = None):
+        # None - глобальный db этого модуля (берется при каждом вызове)
+        self._db = db
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers or config.DB_READER_THREADS, thread_name_prefix="db-reader"
+        )
+        self.journal = MessageJournal(self)
+
+    @property
+    def db(self) -> Database:
+        return self._db if self._db is not None else db
+
+    def _submit(self, executor: ThreadPoolExecutor, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """Постановка в очередь потока сразу (порядок записи = порядок вызовов)"""
+        if executor is self._writer:
+            self.journal.flush()
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    async def run_read(self, fn: Callable, *args, **kwargs):
+        """Выполнение fn(*args, **kwargs) в пуле читателей (fn не должна писать в БД)"""
+        return await self._submit(self._readers, fn, *args, **kwargs)
+
+    async def run_write(self, fn: Callable, *args, **kwargs):
+        """Выполнение fn(*args, **kwargs) в потоке записи, по очереди с остальной записью"""
+        return await self._submit(self._writer, fn, *args, **kwargs)
+
+    def run_write_blocking(self, fn: Callable, *args, **kwargs):
+        """
+        run_write для фоновых потоков вне цикла событий: fn выполняется в потоке
+        записи по очереди с остальной записью, вызывающий поток ждет результата
+
+        Не вызывать из цикла событий (блокирует его) и из потока записи (взаимная блокировка).
+        """
+        return self._writer.submit(fn, *args, **kwargs).result()
+
+    async def add_message(self, user_id: int, role: str, message: str):
+        """Сообщение в журнал (в БД - следующим групповым коммитом)"""
+        if not self.journal.enabled:
+            return await self.run_write(self.db.add_message, user_id, role, message)
+        self.journal.append(user_id, role, message)
+
+    async def update_lead_last_message_time(self, user_id: int):
+        """Время последнего сообщения лида - в журнал"""
+        if not self.journal.enabled:
+            return await self.run_write(self.db.update_lead_last_message_time, user_id)
+        self.journal.touch(user_id)
+
+    async def get_conversation_history(self, user_id: int, limit: int = None) -> List[Dict]:
+        """История диалога: из кэша истории без перехода в поток, при промахе - в пуле читателей"""
+        await self.journal.wait_for(user_id)
+        limit = limit or config.MAX_HISTORY_MESSAGES
+        cached = self.db.history_cache.get(user_id, limit)
+        if cached is not None:
+            return cached
+        return await self._submit(self._readers, self.db._load_conversation_history, user_id, limit)
+
+    def __getattr__(self, name):
+        if name in self.WRITE_METHODS:
+            executor = self._writer
+        elif name in self.READ_METHODS:
+            executor = self._readers
+        else:
+            raise AttributeError(f"{type(self).__name__} has no method {name!r}")
+
+        async def call(*args, **kwargs):
+            if name in self.JOURNAL_READS:
+                await self.journal.wait_for(kwargs['user_id'] if 'user_id' in kwargs else args[0])
+            return await self._submit(executor, getattr(self.db, name), *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    async def drain(self):
+        """Запись журнала сообщений (при остановке бота, до close)"""
+        await self.journal.drain()
+
+    def close(self):
+        """Ожидание начатых запросов и остановка потоков (при остановке бота, после drain)"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+
+# Создание глобального экземпляра базы данных
+db = Database()
+# Асинхронный доступ к ней из обработчиков
+adb = AsyncDatabase()
+
+
+if __name__ == '__main__':
+    # Инициализация логирования
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    print("Initializing database...")
+    db = Database()
+    print("Database initialized successfully!")
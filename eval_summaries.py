@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Сравнение размера запроса к OpenAI: полное окно истории против краткого содержания + последних реплик
+
+Запуск:
+    python eval_summaries.py --db data/bot.db
+    python eval_summaries.py --jsonl conversations.jsonl
+    python eval_summaries.py --db data/bot.db --llm   # настоящие содержания через OpenAI
+
+Диалог проигрывается по репликам: перед каждым ответом бота считаются
+входные токены (context_builder) для окна из MAX_HISTORY_MESSAGES сообщений и
+для содержания + сообщений после него, содержание обновляется по тому же
+правилу, что и в conversation_summary. Без --llm вместо содержания берется
+заглушка длиной CONVERSATION_SUMMARY_MAX_TOKENS токенов (оценка сверху).
+Формат JSONL - как в replay_lead_rules.py.
+"""
+import argparse
+import asyncio
+from typing import Dict, List
+
+from config import Config
+from context_builder import ContextBuilder
+from replay_lead_rules import load_from_db, load_from_jsonl
+import prompts
+
+config = Config()
+
+
+async def make_summary(builder: ContextBuilder, previous_summary: str, messages: List[Dict], use_llm: bool) -> str:
+    if use_llm:
+        from ai_brain import ai_brain
+        summary = await ai_brain.summarize_conversation_async(previous_summary, messages)
+        if summary:
+            return summary
+    return builder.truncate("содержание " * config.CONVERSATION_SUMMARY_MAX_TOKENS, config.CONVERSATION_SUMMARY_MAX_TOKENS)
+
+
+async def replay(conversation: List[Dict], builder: ContextBuilder, use_llm: bool) -> List[tuple]:
+    """Пары (токены полного окна, токены с содержанием) перед каждым ответом бота"""
+    every = config.CONVERSATION_SUMMARY_EVERY
+    recent = config.CONVERSATION_RECENT_MESSAGES
+
+    sizes = []
+    summary = ""
+    summarized = 0
+    for i, msg in enumerate(conversation):
+        if msg['role'] != 'assistant' or i == 0:
+            continue
+        history = conversation[:i]
+        window = history[-config.MAX_HISTORY_MESSAGES:]
+        full = builder.build(prompts.SYSTEM_PROMPT, window)
+
+        tail = history[summarized:] if summary else window
+        compact = builder.build(prompts.SYSTEM_PROMPT, tail, summary=summary)
+        sizes.append((builder.count_message_tokens(full), builder.count_message_tokens(compact)))
+
+        # Обновление после ответа бота (как schedule_refresh в обработчиках)
+        pending = conversation[summarized:i + 1]
+        if len(pending) >= recent + every:
+            to_fold = pending[:-recent] if recent else pending
+            summary = await make_summary(builder, summary, to_fold, use_llm)
+            summarized += len(to_fold)
+    return sizes
+
+
+def percentile(values: List[int], q: float) -> int:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def run(args):
+    builder = ContextBuilder()
+    conversations = load_from_jsonl(args.jsonl) if args.jsonl else load_from_db(args.db)
+
+    full, compact = [], []
+    count = 0
+    for conversation in conversations:
+        count += 1
+        for before, after in await replay(conversation, builder, args.llm):
+            full.append(before)
+            compact.append(after)
+
+    if not full:
+        print("No conversations to replay")
+        return
+
+    print(f"conversations={count}, requests={len(full)}, "
+          f"summary every {config.CONVERSATION_SUMMARY_EVERY}, recent {config.CONVERSATION_RECENT_MESSAGES}")
+    print(f"{'':<10} {'mean':>8} {'p50':>8} {'p95':>8} {'max':>8}")
+    for name, values in (("full", full), ("summary", compact)):
+        print(f"{name:<10} {sum(values) / len(values):>8.0f} {percentile(values, 0.5):>8} "
+              f"{percentile(values, 0.95):>8} {max(values):>8}")
+    print(f"input tokens saved: {1 - sum(compact) / sum(full):.1%}")
+
+    # Без системного промпта - экономия на самой истории диалога
+    system = builder.count_tokens(prompts.SYSTEM_PROMPT) * len(full)
+    print(f"dialogue tokens saved: {1 - (sum(compact) - system) / (sum(full) - system):.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=config.DB_PATH, help="SQLite база бота")
+    parser.add_argument("--jsonl", help="Диалоги в JSONL (вместо базы)")
+    parser.add_argument("--llm", action="store_true", help="Строить содержания через OpenAI")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,7 @@ from handlers.admin import (
     security_stats_command,
     blacklist_command,
     unblacklist_command,
+    rebuild_rag_command,
     show_admin_panel
 )
 
@@ -90,6 +91,7 @@ __all__ = [
     'security_stats_command',
     'blacklist_command',
     'unblacklist_command',
+    'rebuild_rag_command',
     'show_admin_panel',
     # Callbacks
     'handle_business_menu_callback',
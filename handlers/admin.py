@@ -10,13 +10,17 @@ from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboard
 from telegram.ext import ContextTypes
 import database
 import ai_brain
+import knowledge_engine
 import lead_qualifier
+import lead_extraction
 import admin_interface
 from config import Config
 config = Config()
 import utils
 import email_sender
 import security
+import usage_tracker
+import openai_guard
 import prompts
 from handlers.constants import *
 
@@ -32,7 +36,13 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("У вас нет доступа к этой команде")
             return
 
-        stats_message = admin_interface.admin_interface.format_statistics(30)
+        stats_message = await database.adb.run_read(admin_interface.admin_interface.format_statistics, 30)
+        stats_message += "\n\n" + knowledge_engine.knowledge_engine.format_rag_stats()
+        stats_message += "\n\n" + openai_guard.openai_guard.format_stats()
+        stats_message += "\n\n" + ai_brain.ai_brain.format_stream_stats()
+        stats_message += "\n\n" + ai_brain.ai_brain.format_prompt_cache_stats()
+        stats_message += "\n\n" + database.db.history_cache.format_stats()
+        stats_message += "\n\n" + await database.adb.run_read(lead_extraction.lead_extraction_queue.format_stats)
         await update.message.reply_text(stats_message)
 
     except Exception as e:
@@ -54,7 +64,8 @@ async def leads_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         args = context.args
         temperature = args[0] if args else None
 
-        leads_message = admin_interface.admin_interface.format_leads_list(
+        leads_message = await database.adb.run_read(
+            admin_interface.admin_interface.format_leads_list,
             temperature=temperature,
             limit=20
         )
@@ -146,6 +157,7 @@ async def security_stats_command(update: Update, context: ContextTypes.DEFAULT_T
             f"• Дневной бюджет: {stats['daily_budget']:,}\n"
             f"• Осталось: {stats['budget_remaining']:,}\n"
             f"• Использовано: {stats['budget_percentage']:.1f}%\n\n"
+            f"{usage_tracker.usage_tracker.format_stats()}\n\n"
             f"🚫 Безопасность:\n"
             f"• Заблокированных пользователей: {stats['blacklisted_users']}\n"
             f"• Подозрительных пользователей: {stats['suspicious_users']}\n\n"
@@ -244,6 +256,29 @@ async def unblacklist_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 
+async def rebuild_rag_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /rebuild_rag - полная перестройка индекса базы знаний (только для админа)"""
+    try:
+        user = update.effective_user
+
+        if user.id != config.ADMIN_TELEGRAM_ID:
+            await update.message.reply_text("У вас нет доступа к этой команде")
+            return
+
+        await update.message.reply_text("🔄 Перестраиваю индекс базы знаний...")
+
+        # Перестройка читает БД и считает эмбеддинги - выполняем в отдельном потоке
+        count = await asyncio.to_thread(knowledge_engine.knowledge_engine.rebuild_index)
+
+        await update.message.reply_text(f"✅ Индекс базы знаний перестроен: {count} диалогов")
+        logger.info(f"Admin {user.id} rebuilt RAG index: {count} conversations")
+
+    except Exception as e:
+        logger.error(f"Error in rebuild_rag_command: {e}")
+        await update.message.reply_text("Ошибка при перестройке индекса базы знаний")
+
+
+
 async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показ админ-панели"""
     try:
@@ -11,6 +11,8 @@ from telegram.ext import ContextTypes
 import database
 import ai_brain
 import lead_qualifier
+import lead_extraction
+import conversation_summary
 import admin_interface
 from config import Config
 config = Config()
@@ -19,6 +21,7 @@ import email_sender
 import security
 import prompts
 from handlers.constants import *
+from handlers.helpers import notify_admin_new_lead
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +47,7 @@ async def handle_business_connection(update: Update, context: ContextTypes.DEFAU
 
 async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка сообщений через Business аккаунт"""
+    rag_task = None
     try:
         if not update.business_message:
             return
@@ -55,7 +59,7 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
         logger.info(f"📨 Business message from {user_id}: {text}")
         
         # Получаем пользователя
-        user = database.db.create_or_update_user(
+        user = await database.adb.create_or_update_user(
             telegram_id=user_id,
             username=message.from_user.username,
             first_name=message.from_user.first_name,
@@ -116,9 +120,9 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
         
         # Обработка команды сброса
         if text == "🔄 Начать заново":
-            user_data = database.db.get_user_by_telegram_id(user_id)
+            user_data = await database.adb.get_user_by_telegram_id(user_id)
             if user_data:
-                database.db.clear_conversation_history(user_data['id'])
+                await database.adb.clear_conversation_history(user_data['id'])
             
             await context.bot.send_message(
                 chat_id=message.chat.id,
@@ -127,11 +131,19 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
             )
             return
         
+        # RAG ищет похожие диалоги в фоне, пока сохраняем сообщение и грузим историю
+        rag_task = ai_brain.ai_brain.start_rag_search(text)
+
         # Сохраняем сообщение пользователя
-        database.db.add_message(user, 'user', text)
+        await database.adb.add_message(user, 'user', text)
         
         # Получаем историю диалога
-        conversation_history = database.db.get_conversation_history(user)
+        conversation_history = await database.adb.get_conversation_history(user)
+
+        # Ранняя часть длинного диалога идет в запрос кратким содержанием
+        summary, recent_history = await database.adb.run_read(
+            conversation_summary.conversation_summarizer.get_context, user, conversation_history
+        )
         
         # ПРОВЕРКА: если это первое сообщение клиента - показываем кнопки меню
         # (в бизнес-чатах клиент не видит /start, начинает сразу с вопроса)
@@ -158,7 +170,9 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
 
         # Собираем ответ от OpenAI и постепенно обновляем сообщение
         start_generation = time.time()
-        async for chunk in ai_brain.ai_brain.generate_response_stream(conversation_history):
+        async for chunk in ai_brain.ai_brain.generate_response_stream(
+            recent_history, rag_task, summary, user_id=user
+        ):
             full_response += chunk
             chunk_buffer += chunk
 
@@ -262,7 +276,8 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
                 )
 
         # Сохраняем ответ
-        database.db.add_message(user, 'assistant', full_response)
+        await database.adb.add_message(user, 'assistant', full_response)
+        conversation_summary.conversation_summarizer.schedule_refresh(user)
         
         # ОТПРАВЛЯЕМ КНОПКИ МЕНЮ ОТДЕЛЬНЫМ СООБЩЕНИЕМ при первом сообщении
         if show_menu_buttons:
@@ -290,35 +305,35 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
             except Exception as e:
                 logger.warning(f"[Business] Failed to send menu buttons: {e}")
         
-        # Извлекаем и сохраняем лид данные (аналогично handle_message)
+        # Извлекаем и сохраняем лид данные (аналогично handle_message) - в фоне, по свежей истории
         if user_id != config.ADMIN_TELEGRAM_ID:
-            lead_data = ai_brain.ai_brain.extract_lead_data(conversation_history)
-            
-            if lead_data:
+            async def save_lead(lead_data: dict):
                 # Обрабатываем данные лида
-                lead_id = lead_qualifier.lead_qualifier.process_lead_data(user, lead_data)
-                
+                lead_id = await database.adb.run_write(
+                    lead_qualifier.lead_qualifier.process_lead_data, user, lead_data
+                )
+
                 if lead_id:
                     # Уведомляем админа о новом лиде
                     # ИСПРАВЛЕНИЕ: AI возвращает 'lead_temperature', приводим к 'temperature'
                     temperature = lead_data.get('temperature') or lead_data.get('lead_temperature', 'cold')
-                    
+
                     should_notify = (
                         temperature in ['hot', 'warm'] or
                         (lead_data.get('name') and
                          (lead_data.get('email') or lead_data.get('phone')) and
                          lead_data.get('pain_point'))
                     )
-                    
+
                     logger.info(f"[Business] Lead {lead_id}: temperature={temperature}, should_notify={should_notify}")
-                    
+
                     if should_notify:
                         await notify_admin_new_lead(context, lead_id, lead_data, {"id": user, "telegram_id": user_id})
-                
+
                 # Проверяем нужно ли предложить lead magnet
-                existing_lead = database.db.get_lead_by_user_id(user)
+                existing_lead = await database.adb.get_lead_by_user_id(user)
                 lead_magnet_already_offered = existing_lead and existing_lead.get('lead_magnet_type') is not None
-                
+
                 if not lead_magnet_already_offered and ai_brain.ai_brain.should_offer_lead_magnet(lead_data):
                     # Формируем сообщение с lead magnet кнопками
                     lead_magnet_msg = "🎁 Чтобы помочь вам лучше, я подготовил специальные материалы:\n\n"
@@ -330,6 +345,8 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
                         business_connection_id=message.business_connection_id
                     )
 
+            lead_extraction.lead_extraction_queue.submit(user, save_lead)
+
         logger.info(f"✅ [Business] Response sent to user {user_id}")
         
     except Exception as e:
@@ -343,5 +360,8 @@ async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_
                 )
         except:
             pass
+    finally:
+        # Ошибка до генерации ответа - поиск RAG не должен остаться висеть без ожидания
+        ai_brain.ai_brain.discard_rag_search(rag_task)
 
 
@@ -10,6 +10,7 @@ from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboard
 from telegram.ext import ContextTypes
 import database
 import ai_brain
+import knowledge_engine
 import lead_qualifier
 import admin_interface
 from config import Config
@@ -17,6 +18,7 @@ config = Config()
 import utils
 import email_sender
 import security
+import usage_tracker
 import prompts
 from handlers.constants import *
 
@@ -101,7 +103,7 @@ async def handle_lead_magnet_callback(update: Update, context: ContextTypes.DEFA
     await query.answer()
 
     user = query.from_user
-    user_data = database.db.get_user_by_telegram_id(user.id)
+    user_data = await database.adb.get_user_by_telegram_id(user.id)
 
     if not user_data:
         await query.message.reply_text("Ошибка. Попробуйте /start")
@@ -127,9 +129,9 @@ async def handle_lead_magnet_callback(update: Update, context: ContextTypes.DEFA
     }
 
     # Сохраняем выбор lead magnet
-    lead = database.db.get_lead_by_user_id(user_data['id'])
+    lead = await database.adb.get_lead_by_user_id(user_data['id'])
     if lead:
-        lead_qualifier.lead_qualifier.update_lead_magnet(lead['id'], magnet_type)
+        await database.adb.run_write(lead_qualifier.lead_qualifier.update_lead_magnet, lead['id'], magnet_type)
 
         # Уведомляем админа
         admin_interface.admin_interface.send_admin_notification(
@@ -160,7 +162,7 @@ async def handle_admin_panel_callback(update: Update, context: ContextTypes.DEFA
     try:
         if action == "admin_stats":
             # Общая статистика
-            stats_message = admin_interface.admin_interface.format_statistics(30)
+            stats_message = await database.adb.run_read(admin_interface.admin_interface.format_statistics, 30)
             await query.message.reply_text(stats_message)
 
         elif action == "admin_security":
@@ -178,6 +180,7 @@ async def handle_admin_panel_callback(update: Update, context: ContextTypes.DEFA
                 f"• Дневной бюджет: {stats['daily_budget']:,}\n"
                 f"• Осталось: {stats['budget_remaining']:,}\n"
                 f"• Использовано: {stats['budget_percentage']:.1f}%\n\n"
+                f"{usage_tracker.usage_tracker.format_stats()}\n\n"
                 f"🚫 Безопасность:\n"
                 f"• Заблокированных пользователей: {stats['blacklisted_users']}\n"
                 f"• Подозрительных пользователей: {stats['suspicious_users']}\n\n"
@@ -192,12 +195,12 @@ async def handle_admin_panel_callback(update: Update, context: ContextTypes.DEFA
 
         elif action == "admin_leads":
             # Список всех лидов
-            leads_message = admin_interface.admin_interface.format_leads_list(limit=20)
+            leads_message = await database.adb.run_read(admin_interface.admin_interface.format_leads_list, limit=20)
             await query.message.reply_text(leads_message)
 
         elif action == "admin_hot_leads":
             # Только горячие лиды
-            leads_message = admin_interface.admin_interface.format_leads_list(temperature='hot', limit=10)
+            leads_message = await database.adb.run_read(admin_interface.admin_interface.format_leads_list, temperature='hot', limit=10)
             await query.message.reply_text(leads_message)
 
         elif action == "admin_logs":
@@ -236,6 +239,13 @@ async def handle_admin_panel_callback(update: Update, context: ContextTypes.DEFA
             else:
                 await query.message.reply_text("Ошибка при экспорте данных")
 
+        elif action == "admin_rebuild_rag":
+            # Полная перестройка индекса базы знаний (БД и эмбеддинги - в отдельном потоке)
+            await query.message.reply_text("🔄 Перестраиваю индекс базы знаний...")
+            count = await asyncio.to_thread(knowledge_engine.knowledge_engine.rebuild_index)
+            await query.message.reply_text(f"✅ Индекс базы знаний перестроен: {count} диалогов")
+            logger.info(f"Admin {user.id} rebuilt RAG index: {count} conversations")
+
         elif action == "admin_cleanup":
             # Меню очистки данных
             cleanup_message = (
@@ -265,6 +275,27 @@ async def handle_admin_panel_callback(update: Update, context: ContextTypes.DEFA
 
 
 
+def _delete_all(*tables: str) -> list:
+    """Удаление всех строк таблиц одной транзакцией (выполняется в потоке записи БД)"""
+    conn = database.db.get_connection()
+    cursor = conn.cursor()
+    try:
+        counts = []
+        for table in tables:
+            cursor.execute(f"DELETE FROM {table}")
+            counts.append(cursor.rowcount)
+        conn.commit()
+        if 'conversations' in tables:
+            database.db.history_cache.clear()
+        return counts
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+
 async def handle_cleanup_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик cleanup операций"""
     query = update.callback_query
@@ -282,31 +313,20 @@ async def handle_cleanup_callback(update: Update, context: ContextTypes.DEFAULT_
     try:
         if action == "cleanup_conversations":
             # Очистка всех диалогов
-            conn = database.db.get_connection()
-            cursor = conn.cursor()
-            try:
-                cursor.execute("DELETE FROM conversations")
-                conn.commit()
-                count = cursor.rowcount
-
-                await query.message.reply_text(f"✅ Удалено {count} сообщений из диалогов")
-                logger.info(f"Admin {user.id} cleared {count} conversations")
-            finally:
-                conn.close()
+            count, = await database.adb.run_write(_delete_all, 'conversations')
+
+            await query.message.reply_text(f"✅ Удалено {count} сообщений из диалогов")
+            logger.info(f"Admin {user.id} cleared {count} conversations")
 
         elif action == "cleanup_leads":
             # Очистка всех лидов
-            conn = database.db.get_connection()
-            cursor = conn.cursor()
-            try:
-                cursor.execute("DELETE FROM leads")
-                conn.commit()
-                count = cursor.rowcount
-
-                await query.message.reply_text(f"✅ Удалено {count} лидов")
-                logger.info(f"Admin {user.id} cleared {count} leads")
-            finally:
-                conn.close()
+            count, = await database.adb.run_write(_delete_all, 'leads')
+
+            # Лиды удалены напрямую SQL - перестраиваем индекс базы знаний
+            knowledge_engine.knowledge_engine.rag_index.request_rebuild()
+
+            await query.message.reply_text(f"✅ Удалено {count} лидов")
+            logger.info(f"Admin {user.id} cleared {count} leads")
 
         elif action == "cleanup_logs":
             # Очистка логов
@@ -337,29 +357,12 @@ async def handle_cleanup_callback(update: Update, context: ContextTypes.DEFAULT_
             logger.info(f"Admin {user.id} reset security counters")
 
         elif action == "cleanup_all":
-            # Очистка всего
-            conn = database.db.get_connection()
-            cursor = conn.cursor()
-
-            try:
-                # Диалоги
-                cursor.execute("DELETE FROM conversations")
-                conv_count = cursor.rowcount
-
-                # Лиды
-                cursor.execute("DELETE FROM leads")
-                leads_count = cursor.rowcount
-
-                # Уведомления
-                cursor.execute("DELETE FROM admin_notifications")
-                notif_count = cursor.rowcount
-
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                raise
-            finally:
-                conn.close()
+            # Очистка всего: диалоги, лиды, уведомления
+            conv_count, leads_count, notif_count = await database.adb.run_write(
+                _delete_all, 'conversations', 'leads', 'admin_notifications'
+            )
+
+            knowledge_engine.knowledge_engine.rag_index.request_rebuild()
 
             # Логи
             import os
@@ -31,6 +31,7 @@ ADMIN_PANEL_MENU = [
     [InlineKeyboardButton("📋 Логи (последние)", callback_data="admin_logs")],
     [InlineKeyboardButton("🔥 Горячие лиды", callback_data="admin_hot_leads")],
     [InlineKeyboardButton("📥 Экспорт данных", callback_data="admin_export")],
+    [InlineKeyboardButton("🔄 Перестроить индекс RAG", callback_data="admin_rebuild_rag")],
     [InlineKeyboardButton("🗑️ Очистка данных", callback_data="admin_cleanup")],
     [InlineKeyboardButton("❌ Закрыть", callback_data="admin_close")]
 ]
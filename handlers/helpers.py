@@ -25,9 +25,7 @@ logger = logging.getLogger(__name__)
 
 def extract_email(text: str) -> str:
     """Извлекает email из текста"""
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    match = re.search(email_pattern, text)
-    return match.group(0) if match else None
+    return utils.extract_email(text)
 
 
 async def send_message_gradually(update: Update, text: str):
@@ -122,10 +120,10 @@ async def send_lead_magnet_email(update: Update, user_data: dict, lead: dict, em
         if success:
             # Обновляем email в lead если его там нет
             if not lead.get('email'):
-                database.db.create_or_update_lead(user_data['id'], {'email': email})
+                await database.adb.create_or_update_lead(user_data['id'], {'email': email})
 
             # Отмечаем lead magnet как доставленный
-            lead_qualifier.lead_qualifier.mark_lead_magnet_delivered(lead['id'])
+            await database.adb.run_write(lead_qualifier.lead_qualifier.mark_lead_magnet_delivered, lead['id'])
 
             # Подтверждение пользователю
             messages = {
@@ -175,7 +173,7 @@ async def notify_admin_new_lead(context, lead_id: int, lead_data: dict, user_dat
     """
     try:
         # Получаем информацию о лиде
-        lead = database.db.get_lead_by_id(lead_id)
+        lead = await database.adb.get_lead_by_id(lead_id)
         if not lead:
             return
 
@@ -253,7 +251,7 @@ async def notify_admin_new_lead(context, lead_id: int, lead_data: dict, user_dat
         )
 
         # Помечаем что уведомление отправлено
-        database.db.mark_lead_notification_sent(lead_id)
+        await database.adb.mark_lead_notification_sent(lead_id)
 
         logger.info(f"Lead notification sent to chat {target_chat_id} for lead {lead_id}")
 
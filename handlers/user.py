@@ -11,13 +11,14 @@ from telegram.ext import ContextTypes
 import database
 import ai_brain
 import lead_qualifier
+import lead_extraction
+import conversation_summary
 import admin_interface
 from config import Config
 config = Config()
 import utils
 import email_sender
 import security
-import prompts
 from handlers.constants import *
 
 logger = logging.getLogger(__name__)
@@ -35,7 +36,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"User {user.id} started bot")
 
         # Создаем или обновляем пользователя в БД
-        user_id = database.db.create_or_update_user(
+        user_id = await database.adb.create_or_update_user(
             telegram_id=user.id,
             username=user.username,
             first_name=user.first_name,
@@ -92,11 +93,11 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /reset"""
     try:
         user = update.effective_user
-        user_data = database.db.get_user_by_telegram_id(user.id)
+        user_data = await database.adb.get_user_by_telegram_id(user.id)
 
         if user_data:
             # Очищаем историю диалога
-            database.db.clear_conversation_history(user_data['id'])
+            await database.adb.clear_conversation_history(user_data['id'])
             logger.info(f"Conversation reset for user {user.id}")
 
             await update.message.reply_text(
@@ -144,6 +145,7 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
+    rag_task = None
     try:
         user = update.effective_user
         message_text = update.effective_message.text
@@ -163,18 +165,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Получаем или создаем пользователя
-        user_data = database.db.get_user_by_telegram_id(user.id)
+        user_data = await database.adb.get_user_by_telegram_id(user.id)
         if not user_data:
-            user_id = database.db.create_or_update_user(
+            user_id = await database.adb.create_or_update_user(
                 telegram_id=user.id,
                 username=user.username,
                 first_name=user.first_name,
                 last_name=user.last_name
             )
-            user_data = database.db.get_user_by_telegram_id(user.id)
+            user_data = await database.adb.get_user_by_telegram_id(user.id)
 
         # Проверяем есть ли pending lead magnet и email в сообщении
-        lead = database.db.get_lead_by_user_id(user_data['id'])
+        lead = await database.adb.get_lead_by_user_id(user_data['id'])
         if lead and lead.get('lead_magnet_type') and not lead.get('lead_magnet_delivered'):
             email = extract_email(message_text)
             if email:
@@ -211,7 +213,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # ПРОВЕРКА: если клиент повторяет одно и то же сообщение 3+ раза
         # И прошло более 30 минут с начала диалога - завершаем разговор
-        conversation_history = database.db.get_conversation_history(user_data['id'])
+        conversation_history = await database.adb.get_conversation_history(user_data['id'])
         
         if len(conversation_history) > 0:
             # Получаем последние сообщения пользователя
@@ -239,11 +241,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         )
                         return
 
+        # RAG ищет похожие диалоги в фоне, пока сохраняем сообщение и грузим историю
+        rag_task = ai_brain.ai_brain.start_rag_search(message_text)
+
         # Сохраняем сообщение пользователя
-        database.db.add_message(user_data['id'], 'user', message_text)
+        await database.adb.add_message(user_data['id'], 'user', message_text)
 
         # Получаем историю диалога
-        conversation_history = database.db.get_conversation_history(user_data['id'])
+        conversation_history = await database.adb.get_conversation_history(user_data['id'])
+
+        # Ранняя часть длинного диалога идет в запрос кратким содержанием
+        summary, recent_history = await database.adb.run_read(
+            conversation_summary.conversation_summarizer.get_context, user_data['id'], conversation_history
+        )
 
         # Генерируем ответ через AI с постепенным streaming (как в GPT)
         full_response = ""
@@ -262,7 +272,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Собираем ответ от OpenAI и постепенно обновляем сообщение
         start_generation = time.time()
-        async for chunk in ai_brain.ai_brain.generate_response_stream(conversation_history):
+        async for chunk in ai_brain.ai_brain.generate_response_stream(
+            recent_history, rag_task, summary, user_id=user_data['id']
+        ):
             full_response += chunk
             chunk_buffer += chunk
 
@@ -337,41 +349,39 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await original_message.reply_text(full_response)
 
         # Сохраняем ответ ассистента
-        database.db.add_message(user_data['id'], 'assistant', full_response)
-
-        # 🛡️ УЧЕТ ИСПОЛЬЗОВАННЫХ ТОКЕНОВ
-        # Оцениваем токены: user message + assistant response + system prompt
-        user_tokens = security.security_manager.estimate_tokens(message_text)
-        assistant_tokens = security.security_manager.estimate_tokens(full_response)
-        system_tokens = security.security_manager.estimate_tokens(prompts.SYSTEM_PROMPT)
-        total_tokens = user_tokens + assistant_tokens + system_tokens
-        security.security_manager.add_tokens_used(total_tokens)
-        logger.debug(f"Tokens used: user={user_tokens}, assistant={assistant_tokens}, system={system_tokens}, total={total_tokens}")
+        await database.adb.add_message(user_data['id'], 'assistant', full_response)
+        conversation_summary.conversation_summarizer.schedule_refresh(user_data['id'])
 
         # Извлекаем данные лида из диалога (ТОЛЬКО если это НЕ админ!)
         # Админские сообщения НЕ должны создавать лиды
         if user.id != config.ADMIN_TELEGRAM_ID:
-            lead_data = ai_brain.ai_brain.extract_lead_data(conversation_history)
-
-            if lead_data:
+            # Извлечение идет в фоне по свежей истории - ответ клиенту его не ждет
+            async def save_lead(lead_data: dict):
                 # Обрабатываем данные лида
-                lead_id = lead_qualifier.lead_qualifier.process_lead_data(user_data['id'], lead_data)
+                lead_id = await database.adb.run_write(
+                    lead_qualifier.lead_qualifier.process_lead_data, user_data['id'], lead_data
+                )
 
                 if lead_id:
                     # ОБНОВЛЯЕМ ВРЕМЯ ПОСЛЕДНЕГО СООБЩЕНИЯ
-                    database.db.update_lead_last_message_time(user_data['id'])
-                    
+                    await database.adb.update_lead_last_message_time(user_data['id'])
+
                     # НЕ ОТПРАВЛЯЕМ УВЕДОМЛЕНИЕ СРАЗУ!
                     # Уведомление отправится автоматически через 5 минут без новых сообщений
                     # (см. check_pending_leads_job)
-                    
+
                     logger.info(f"Lead {lead_id} updated, waiting for conversation to finish before notifying admin")
 
+            lead_extraction.lead_extraction_queue.submit(user_data['id'], save_lead)
+
     except Exception as e:
         # Пропускаем Peer_id_invalid - нормально для бизнес-сообщений
         if "Peer_id_invalid" not in str(e):
             logger.error(f"Error in handle_message: {e}")
             # НЕ пытаемся отправлять ошибки - может быть None или уже отправлено
+    finally:
+        # Ошибка до генерации ответа - поиск RAG не должен остаться висеть без ожидания
+        ai_brain.ai_brain.discard_rag_search(rag_task)
 
 
 
@@ -452,7 +462,7 @@ async def handle_handoff_request(update: Update, context: ContextTypes.DEFAULT_T
     """Обработка запроса на передачу админу"""
     try:
         user = update.effective_user
-        user_data = database.db.get_user_by_telegram_id(user.id)
+        user_data = await database.adb.get_user_by_telegram_id(user.id)
 
         if not user_data:
             await update.message.reply_text("Ошибка. Попробуйте /start")
@@ -468,9 +478,9 @@ async def handle_handoff_request(update: Update, context: ContextTypes.DEFAULT_T
         )
 
         # Создаем или обновляем лид
-        lead = database.db.get_lead_by_user_id(user_data['id'])
+        lead = await database.adb.get_lead_by_user_id(user_data['id'])
         if not lead:
-            lead_id = database.db.create_or_update_lead(user_data['id'], {
+            lead_id = await database.adb.create_or_update_lead(user_data['id'], {
                 'name': user.first_name
             })
         else:
@@ -0,0 +1,197 @@
+"""
+Кэш последних сообщений диалогов в памяти (перед get_conversation_history)
+
+На пользователя хранится окно из последних MAX_HISTORY_MESSAGES сообщений
+(deque) в порядке записи. Окно заполняется при первом чтении из SQLite и
+дальше обновляется при записи: новое сообщение дописывается, очистка
+истории делает окно пустым. Повторные чтения истории в диск не ходят.
+
+Вытеснение - LRU: при превышении HISTORY_CACHE_MAX_USERS пользователей или
+HISTORY_CACHE_MAX_MB оценки занятой памяти удаляются окна, которые дольше
+всех не читались и не обновлялись.
+"""
+import logging
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, Optional
+
+from config import Config
+config = Config()
+
+logger = logging.getLogger(__name__)
+
+# Оценка памяти на сообщение помимо текста: dict, ключи, id, роль, время
+MESSAGE_OVERHEAD_BYTES = 400
+
+
+class _Window:
+    __slots__ = ('messages', 'complete', 'size')
+
+    def __init__(self, messages: Iterable[Dict], maxlen: int, complete: bool):
+        self.messages = deque(messages, maxlen=maxlen)
+        # В окне вся история пользователя (сообщений меньше размера окна)
+        self.complete = complete
+        self.size = sum(_message_size(msg) for msg in self.messages)
+
+
+def _message_size(message: Dict) -> int:
+    return sys.getsizeof(message.get('message') or '') + MESSAGE_OVERHEAD_BYTES
+
+
+class ConversationCache:
+    """LRU окон последних сообщений по пользователям с ограничением по числу окон и памяти"""
+
+    def __init__(self, window: int = None, max_users: int = None, max_bytes: int = None):
+        self.window = window or config.MAX_HISTORY_MESSAGES
+        self.max_users = config.HISTORY_CACHE_MAX_USERS if max_users is None else max_users
+        self.max_bytes = int(config.HISTORY_CACHE_MAX_MB * 1024 * 1024) if max_bytes is None else max_bytes
+
+        self._lock = threading.Lock()
+        self._windows: 'OrderedDict[int, _Window]' = OrderedDict()
+        self._bytes = 0
+        # user_id -> [незавершенных загрузок из БД, записей за время загрузки]
+        self._loads: Dict[int, List[int]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0 and self.max_bytes > 0
+
+    def get(self, user_id: int, limit: int) -> Optional[List[Dict]]:
+        """
+        Последние limit сообщений из кэша (от старых к новым)
+
+        Returns:
+            Копии сообщений или None, если окна нет или в нем не хватает сообщений
+        """
+        with self._lock:
+            window = self._windows.get(user_id)
+            if window is None or (limit > len(window.messages) and not window.complete):
+                self.misses += 1
+                return None
+            self._windows.move_to_end(user_id)
+            self.hits += 1
+            messages = list(window.messages)[-limit:] if limit else []
+        return [dict(msg) for msg in messages]
+
+    def begin_load(self, user_id: int) -> int:
+        """Начало чтения окна из БД (перед запросом): токен для put"""
+        with self._lock:
+            load = self._loads.setdefault(user_id, [0, 0])
+            load[0] += 1
+            return load[1]
+
+    def put(self, user_id: int, messages: List[Dict], limit: int, token: int):
+        """
+        Окно из результата запроса к БД
+
+        Не сохраняется, если пока шел запрос, у пользователя была запись
+        (результат мог устареть), или запрос захватил меньше окна.
+        """
+        with self._lock:
+            stale = self._end_load(user_id) != token
+            if stale or not self.enabled or limit < self.window:
+                return
+            complete = len(messages) < limit and len(messages) <= self.window
+            self._store(user_id, _Window(messages[-self.window:], self.window, complete))
+
+    def abort_load(self, user_id: int):
+        """Чтение окна из БД не удалось"""
+        with self._lock:
+            self._end_load(user_id)
+
+    def _end_load(self, user_id: int) -> int:
+        load = self._loads[user_id]
+        load[0] -= 1
+        if load[0] == 0:
+            del self._loads[user_id]
+        return load[1]
+
+    def append(self, user_id: int, messages: Iterable[Dict]):
+        """
+        Новые сообщения пользователя (после коммита)
+
+        Сообщения с id не новее последнего в окне пропускаются: чтение из БД,
+        начатое между коммитом и append, уже положило их в окно.
+        """
+        with self._lock:
+            self._mark_write(user_id)
+            window = self._windows.get(user_id)
+            if window is None:
+                return
+            before = window.size
+            for msg in messages:
+                if window.messages and msg['id'] <= window.messages[-1]['id']:
+                    continue
+                if len(window.messages) == self.window:
+                    # Самое старое сообщение выпадает из окна - в нем больше не вся история
+                    window.size -= _message_size(window.messages[0])
+                    window.complete = False
+                window.messages.append(dict(msg))
+                window.size += _message_size(msg)
+            self._bytes += window.size - before
+            self._windows.move_to_end(user_id)
+            self._evict()
+
+    def reset(self, user_id: int):
+        """История пользователя очищена - окно пустое и полное"""
+        with self._lock:
+            self._mark_write(user_id)
+            if self.enabled:
+                self._store(user_id, _Window((), self.window, True))
+
+    def clear(self):
+        """Сброс всего кэша (история менялась в обход Database)"""
+        with self._lock:
+            self._windows.clear()
+            self._bytes = 0
+            for load in self._loads.values():
+                load[1] += 1
+
+    def _mark_write(self, user_id: int):
+        load = self._loads.get(user_id)
+        if load is not None:
+            load[1] += 1
+
+    def _store(self, user_id: int, window: _Window):
+        old = self._windows.pop(user_id, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._windows[user_id] = window
+        self._bytes += window.size
+        self._evict()
+
+    def _evict(self):
+        while self._windows and (len(self._windows) > self.max_users or self._bytes > self.max_bytes):
+            _, window = self._windows.popitem(last=False)
+            self._bytes -= window.size
+            self.evictions += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._windows),
+                'bytes': self._bytes,
+                'max_users': self.max_users,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def format_stats(self) -> str:
+        """Состояние кэша истории для админ-панели"""
+        stats = self.get_stats()
+        return (
+            f"🗂 Кэш истории диалогов:\n"
+            f"• Пользователей: {stats['users']:,} из {stats['max_users']:,}, "
+            f"память ~{stats['bytes'] / 1024 / 1024:.1f} из {stats['max_bytes'] / 1024 / 1024:.0f} МБ\n"
+            f"• Попаданий: {stats['hit_rate']:.0%} ({stats['hits']:,} из {stats['hits'] + stats['misses']:,}), "
+            f"вытеснено: {stats['evictions']:,}"
+        )
@@ -3,46 +3,1014 @@ RAG (Retrieval-Augmented Generation) Engine
 Извлекает релевантные примеры успешных диалогов для улучшения ответов бота
 """
 
+import argparse
+import hashlib
 import logging
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Set
 from openai import OpenAI
 from config import Config
+import database
+import usage_tracker
+import openai_guard
+from utils import normalize_query
+from vector_index import CompactMatrix, VectorIndex, create_index, normalize_rows, top_k_similar
+from vector_store import VectorStore
+from lexical_index import BM25Index
 
 config = Config()
 
 logger = logging.getLogger(__name__)
 
 
+class CorpusMatrix:
+    """Корпус диалогов в виде одной нормализованной float32 матрицы"""
+
+    def __init__(
+        self,
+        keys: Tuple[str, ...],
+        items: List[Dict],
+        matrix,
+        index: Optional[VectorIndex] = None
+    ):
+        self.keys = keys
+        self.items = items
+        self.matrix = matrix
+        # Индекс для поиска (None - точный перебор матрицы)
+        self.index = index
+        # Ключ -> номер строки (удаленные строки имеют ключ None)
+        self.positions = {key: row for row, key in enumerate(keys) if key is not None}
+
+    def search(self, query_vector: np.ndarray, top_k: int, min_similarity: float) -> List[Tuple[Dict, float]]:
+        """Поиск похожих элементов корпуса"""
+        query = normalize_rows(query_vector.reshape(1, -1))[0]
+        if self.index is not None:
+            results = self.index.search(query, top_k, min_similarity)
+        else:
+            results = top_k_similar(self.matrix, query, top_k, min_similarity)
+        return [(self.items[i], score) for i, score in results]
+
+    def rerank(
+        self,
+        query_vector: np.ndarray,
+        keys: List,
+        top_k: int,
+        min_similarity: float
+    ) -> List[Tuple[Dict, float]]:
+        """Точное переранжирование только указанных элементов корпуса"""
+        rows = np.array([self.positions[key] for key in keys if key in self.positions], dtype=np.int64)
+        if rows.size == 0:
+            return []
+        query = normalize_rows(query_vector.reshape(1, -1))[0]
+        return [
+            (self.items[rows[i]], score)
+            for i, score in top_k_similar(self.matrix[rows], query, top_k, min_similarity)
+        ]
+
+
+class RagIndex:
+    """
+    Инкрементальный индекс успешных диалогов (warm/hot лиды) для RAG
+
+    Изменения лидов и диалогов приходят от Database (add_change_listener)
+    и применяются фоновым потоком пачками, поэтому поиск не читает корпус
+    из SQLite и не считает эмбеддинги.
+
+    Векторы лежат в VectorStore (RAG_INDEX_PATH): плоский файл, открытый через
+    numpy.memmap, и сайдкар с метаданными. Новые векторы дописываются в конец
+    файла, поэтому обновление не переписывает индекс, а старт - это чтение
+    сайдкара без пересчета. Если процессов бота несколько, изменяет файлы только
+    один (писатель), остальные читают те же файлы и подхватывают новые записи.
+
+    Векторы хранятся сжатыми (RAG_VECTOR_DTYPE: int8 или float16), поиск
+    считается прямо по сжатой матрице.
+
+    Параллельно ведется лексический индекс BM25 по тем же диалогам: он
+    отбирает кандидатов для векторного переранжирования и отвечает сам,
+    если эмбеддинг запроса получить не удалось.
+    """
+
+    # Переписываем файлы, когда удаленных строк больше живых (и не меньше этого числа)
+    COMPACT_MIN_DEAD = 64
+
+    def __init__(
+        self,
+        engine: 'KnowledgeEngine',
+        max_items: int = None,
+        refresh_delay: float = None,
+        backend: str = None,
+        path: Optional[str] = None,
+        vector_dtype: str = None
+    ):
+        self.engine = engine
+        self.max_items = max_items or config.RAG_INDEX_MAX_ITEMS
+        self.refresh_delay = config.RAG_INDEX_REFRESH_DELAY if refresh_delay is None else refresh_delay
+        self.backend = backend or config.RAG_INDEX_BACKEND
+        self.vector_dtype = vector_dtype or config.RAG_VECTOR_DTYPE
+        # Префикс файлов индекса (None - только в памяти)
+        self.path = path if path is not None else (config.RAG_INDEX_PATH or None)
+        self.store: Optional[VectorStore] = None
+        self._saved_at = 0.0
+
+        # lead_id -> диалог, строка хранилища и отпечаток данных диалога
+        self._entries: Dict[int, Dict] = {}
+        self._rows: Dict[int, int] = {}
+        self._fingerprints: Dict[int, str] = {}
+        self._user_leads: Dict[int, Set[int]] = {}
+        # Лексический индекс по lead_id (обновляется сразу, без публикации снимка)
+        self.lexical = BM25Index()
+
+        # Готовый снимок для поиска (заменяется целиком)
+        self._snapshot = CorpusMatrix((), [], CompactMatrix.from_float(np.zeros((0, 0)), self.vector_dtype))
+        self._snapshot_generation = 0
+        self._size = 0
+        self.is_ready = False
+        # Номер версии индекса - меняется при каждой публикации снимка
+        self.version = 0
+
+        self._dirty_leads: Set[int] = set()
+        self._dirty_users: Set[int] = set()
+        self._rebuild_requested = False
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    # === ИЗМЕНЕНИЯ ===
+
+    def on_change(self, event: str, user_id: int, lead_id: int = None):
+        """Подписчик Database.add_change_listener"""
+        with self._lock:
+            if event == 'lead_updated' and lead_id is not None:
+                self._dirty_leads.add(lead_id)
+            elif event == 'conversation_updated' and user_id in self._user_leads:
+                self._dirty_users.add(user_id)
+            else:
+                return
+        self._schedule()
+
+    def invalidate_lead(self, lead_id: int):
+        """Пометить запись лида устаревшей (будет перечитана из БД)"""
+        with self._lock:
+            self._dirty_leads.add(lead_id)
+        self._schedule()
+
+    def request_rebuild(self):
+        """Запросить сверку индекса с БД в фоне"""
+        with self._lock:
+            self._rebuild_requested = True
+        self._schedule()
+
+    def _schedule(self):
+        """Разбудить фоновый поток (запускается при первом обращении)"""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="rag-index", daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _run(self):
+        """
+        Фоновый поток: ждет изменений и применяет их пачками
+
+        Без изменений поток все равно просыпается: читатель - чтобы подхватить
+        записи писателя, писатель - чтобы сверить индекс с БД (лиды могли
+        измениться в других процессах бота).
+        """
+        while True:
+            is_writer = self.store is None or self.store.is_writer
+            interval = config.RAG_INDEX_RECONCILE_INTERVAL if is_writer else config.RAG_INDEX_SYNC_INTERVAL
+            if not self._wakeup.wait(timeout=interval or None) and is_writer:
+                with self._lock:
+                    self._rebuild_requested = True
+            # Небольшая пауза, чтобы собрать несколько изменений в одну пачку
+            time.sleep(self.refresh_delay)
+            self._wakeup.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"RAG index refresh failed: {e}")
+
+    # === ОБНОВЛЕНИЕ ===
+
+    def refresh(self) -> int:
+        """
+        Применение накопленных изменений
+
+        При первом вызове индекс открывается с диска (или строится из БД),
+        по запросу request_rebuild сверяется с БД целиком.
+
+        Returns:
+            Количество обработанных лидов
+        """
+        with self._refresh_lock:
+            store = self._open_store()
+            if not store.is_writer:
+                # Изменения применит процесс-писатель
+                with self._lock:
+                    self._dirty_leads.clear()
+                    self._dirty_users.clear()
+                    self._rebuild_requested = False
+                return self._follow()
+
+            with self._lock:
+                full = self._rebuild_requested or not self.is_ready
+                lead_ids = set(self._dirty_leads)
+                for user_id in self._dirty_users:
+                    lead_ids |= self._user_leads.get(user_id, set())
+                self._dirty_leads.clear()
+                self._dirty_users.clear()
+                self._rebuild_requested = False
+
+            if full:
+                if not self.is_ready and self._load():
+                    # Индекс с диска уже доступен для поиска, сверяем его с БД в фоне
+                    self.request_rebuild()
+                    return self._size
+                return self._reconcile()
+
+            if not lead_ids:
+                return 0
+
+            conversations = self.engine.db.get_successful_conversations_by_lead_ids(sorted(lead_ids))
+            changed = self._apply(conversations, lead_ids - {conv['lead_id'] for conv in conversations})
+            if not changed:
+                return 0
+
+            self._trim()
+            self._compact_if_needed()
+            self._publish()
+            if time.monotonic() - self._saved_at >= config.RAG_INDEX_SAVE_INTERVAL:
+                self._save_index_state()
+            logger.info(f"RAG index refreshed: {changed} leads changed, {self._size} total")
+            return changed
+
+    def rebuild(self) -> int:
+        """
+        Полная перестройка индекса из БД с перезаписью файлов (восстановление)
+
+        Returns:
+            Количество диалогов в индексе
+        """
+        with self._refresh_lock:
+            with self._lock:
+                self._dirty_leads.clear()
+                self._dirty_users.clear()
+                self._rebuild_requested = False
+
+            store = self._open_store()
+            if not store.is_writer:
+                logger.warning("RAG index files are owned by another process, rebuild skipped")
+                return self._follow()
+
+            conversations = self.engine.db.get_successful_conversations(limit=self.max_items)
+            vectors = self.engine.embed_conversations(conversations)
+
+            self._clear_entries()
+            store.reset(store.dim)
+            self._add_many(conversations, vectors)
+            self._finish_full_update()
+            logger.info(f"RAG index rebuilt: {self._size} conversations")
+            return self._size
+
+    def _reconcile(self) -> int:
+        """
+        Сверка индекса с БД: добавляются новые и изменившиеся диалоги, удаляются пропавшие
+
+        Returns:
+            Количество диалогов в индексе
+        """
+        conversations = self.engine.db.get_successful_conversations(limit=self.max_items)
+        current = {conv['lead_id'] for conv in conversations}
+        changed = self._apply(conversations, set(self._entries) - current)
+
+        self._finish_full_update()
+        logger.info(f"RAG index reconciled: {changed} leads changed, {self._size} conversations")
+        return self._size
+
+    def _finish_full_update(self):
+        self._trim()
+        self._compact_if_needed()
+        self._publish()
+        self.is_ready = True
+        self._save_index_state()
+
+    def _apply(self, conversations: List[Dict], removed: Set[int]) -> int:
+        """
+        Применение свежих данных диалогов из БД
+
+        Args:
+            conversations: Актуальные диалоги
+            removed: Лиды, которых нет среди успешных (удаляются, если есть в индексе)
+
+        Returns:
+            Количество изменившихся лидов
+        """
+        # Неизменившиеся диалоги не дописываются в хранилище повторно
+        fresh = [
+            conv for conv in conversations
+            if self._fingerprints.get(conv['lead_id']) != self._fingerprint(conv)
+        ]
+        fresh_ids = {conv['lead_id'] for conv in fresh}
+
+        # Старые строки изменившихся и пропавших лидов удаляются
+        stale = {lead_id for lead_id in removed | fresh_ids if lead_id in self._entries}
+        self._remove_many(stale)
+        if fresh:
+            self._add_many(fresh, self.engine.embed_conversations(fresh))
+        return len(stale | fresh_ids)
+
+    @staticmethod
+    def _fingerprint(conv: Dict) -> str:
+        return hashlib.sha256(json.dumps(conv, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _add_many(self, conversations: List[Dict], vectors: List[Optional[np.ndarray]]):
+        """Дозапись диалогов с готовыми эмбеддингами в хранилище"""
+        pairs = [(conv, vector) for conv, vector in zip(conversations, vectors) if vector is not None]
+        if not pairs:
+            return
+
+        matrix = normalize_rows(np.vstack([vector for _, vector in pairs]))
+        if self.store.dim != matrix.shape[1]:
+            # Первая запись или сменилась модель эмбеддингов
+            self._clear_entries()
+            self.store.reset(matrix.shape[1])
+
+        # Диалог проходит через JSON, чтобы в памяти был тот же вид, что и после загрузки с диска
+        items = [json.loads(json.dumps(conv, default=str)) for conv, _ in pairs]
+        metas = [
+            {'lead_id': conv['lead_id'], 'user_id': conv['user_id'],
+             'fingerprint': self._fingerprint(conv), 'item': item}
+            for (conv, _), item in zip(pairs, items)
+        ]
+        rows = self.store.append(CompactMatrix.from_float(matrix, self.vector_dtype), metas)
+        for row, meta in zip(rows, metas):
+            self._index_meta(row, meta)
+
+    def _index_meta(self, row: int, meta: Dict):
+        lead_id = meta['lead_id']
+        self._entries[lead_id] = meta['item']
+        self._rows[lead_id] = row
+        self._fingerprints[lead_id] = meta['fingerprint']
+        self.lexical.add(lead_id, self.engine._format_conversation_for_search(meta['item']))
+        with self._lock:
+            self._user_leads.setdefault(meta['user_id'], set()).add(lead_id)
+
+    def _remove_many(self, lead_ids):
+        rows = []
+        for lead_id in lead_ids:
+            conv = self._entries.pop(lead_id, None)
+            if conv is None:
+                continue
+            rows.append(self._rows.pop(lead_id))
+            self._fingerprints.pop(lead_id, None)
+            self.lexical.remove(lead_id)
+            with self._lock:
+                leads = self._user_leads.get(conv['user_id'])
+                if leads:
+                    leads.discard(lead_id)
+                    if not leads:
+                        del self._user_leads[conv['user_id']]
+        self.store.delete(rows)
+
+    def _clear_entries(self):
+        self._entries = {}
+        self._rows = {}
+        self._fingerprints = {}
+        self.lexical.clear()
+        with self._lock:
+            self._user_leads = {}
+
+    def _trim(self):
+        """Ограничение размера индекса: вытесняем самые старые лиды"""
+        excess = len(self._entries) - self.max_items
+        if excess > 0:
+            self._remove_many(sorted(self._entries)[:excess])
+
+    def _compact_if_needed(self):
+        """Перезапись хранилища без удаленных строк"""
+        dead = self.store.dead_count
+        if dead < self.COMPACT_MIN_DEAD or dead <= self.store.live_count:
+            return
+        live = self.store.compact()
+        new_rows = {old: new for new, old in enumerate(live)}
+        self._rows = {lead_id: new_rows[row] for lead_id, row in self._rows.items()}
+        logger.info(f"RAG vector store compacted: {dead} deleted rows dropped")
+
+    def _publish(self, previous: Optional[VectorIndex] = None, stable_rows: int = None):
+        """
+        Сборка нового снимка для поиска
+
+        Args:
+            previous: Индекс с обученными параметрами (по умолчанию - текущий снимок)
+            stable_rows: Сколько первых строк не изменилось с момента построения previous
+        """
+        store = self.store
+        matrix = store.matrix()
+        mask = store.alive
+
+        if previous is None:
+            previous = self._snapshot.index
+            # Строки только дописываются, пока не сменилось поколение файлов
+            same_rows = self._snapshot_generation == store.generation
+            stable_rows = self._snapshot.matrix.shape[0] if same_rows else 0
+
+        # Новый объект индекса на каждый снимок: поиск по старому снимку не блокируется
+        index = create_index(self.backend, config.RAG_IVF_LISTS, config.RAG_IVF_PROBES)
+        index.build(matrix, previous=previous, mask=mask, stable_rows=stable_rows or 0)
+
+        keys = tuple(meta['lead_id'] if meta else None for meta in store.metas)
+        items = [meta['item'] if meta else None for meta in store.metas]
+        self._snapshot = CorpusMatrix(keys, items, matrix, index)
+        self._snapshot_generation = store.generation
+        self._size = store.live_count
+        self.version += 1
+
+    # === ХРАНИЛИЩЕ ===
+
+    def _open_store(self) -> VectorStore:
+        """Создание хранилища при первом обращении (писатель - первый захвативший блокировку)"""
+        if self.store is None:
+            store = VectorStore(self.path, self.vector_dtype)
+            if self.path is not None and not store.acquire_writer():
+                logger.info("RAG index is written by another process, following its files")
+            self.store = store
+        return self.store
+
+    @property
+    def _index_state_path(self) -> Optional[str]:
+        return f"{self.path}.index.npz" if self.path else None
+
+    def _save_index_state(self):
+        """Запись обученных параметров ANN индекса (центроиды и кластеры строк)"""
+        path = self._index_state_path
+        if not path:
+            return
+
+        snapshot = self._snapshot
+        arrays = {
+            'backend': np.array(snapshot.index.name),
+            'generation': np.array(self._snapshot_generation),
+            'rows': np.array(snapshot.matrix.shape[0]),
+        }
+        for name, value in snapshot.index.get_state().items():
+            arrays[f'index_{name}'] = value
+
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+            self._saved_at = time.monotonic()
+        except Exception as e:
+            logger.warning(f"RAG index state save failed: {e}")
+
+    def _load_index_state(self):
+        """
+        Обученный индекс из файла состояния (если он от того же поколения хранилища)
+
+        Returns:
+            (индекс для build как previous, количество строк с готовыми кластерами)
+        """
+        path = self._index_state_path
+        if not path or not os.path.exists(path):
+            return None, 0
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['backend']) != self.backend or int(data['generation']) != self.store.generation:
+                    return None, 0
+                index = create_index(self.backend, config.RAG_IVF_LISTS, config.RAG_IVF_PROBES)
+                index.set_state({
+                    name[len('index_'):]: data[name]
+                    for name in data.files
+                    if name.startswith('index_')
+                })
+                return index, int(data['rows'])
+        except Exception as e:
+            logger.warning(f"RAG index state load failed: {e}")
+            return None, 0
+
+    def _load(self) -> bool:
+        """
+        Открытие индекса с диска (вызывать под _refresh_lock)
+
+        Returns:
+            True если индекс загружен и опубликован
+        """
+        try:
+            if not self.store.open():
+                return False
+        except Exception as e:
+            logger.warning(f"RAG index load failed, rebuilding: {e}")
+            return False
+
+        self._load_entries()
+        self.is_ready = True
+        logger.info(f"RAG index loaded: {self._size} conversations from {self.path}")
+        return True
+
+    def _load_entries(self):
+        """Словари индекса и снимок по содержимому хранилища"""
+        self._clear_entries()
+        for row, meta in enumerate(self.store.metas):
+            if meta is not None:
+                self._index_meta(row, meta)
+        previous, stable_rows = self._load_index_state()
+        self._publish(previous, stable_rows)
+
+    def _follow(self) -> int:
+        """
+        Процесс-читатель: подхват записей писателя
+
+        Returns:
+            Количество диалогов в индексе
+        """
+        if not self.is_ready:
+            self.store.open()
+        elif not self.store.sync():
+            return self._size
+        self._load_entries()
+        self.is_ready = True
+        return self._size
+
+    # === ПОИСК ===
+
+    def ensure_started(self) -> bool:
+        """
+        Запуск первоначальной сборки индекса в фоне
+
+        Returns:
+            True если индекс уже готов к поиску
+        """
+        if not self.is_ready:
+            self._schedule()
+        return self.is_ready
+
+    def search(
+        self,
+        query_vector: np.ndarray,
+        top_k: int,
+        min_similarity: float,
+        candidates: Optional[List[int]] = None
+    ) -> List[Tuple[Dict, float]]:
+        """
+        Поиск по текущему снимку (без обращений к БД)
+
+        Args:
+            query_vector: Эмбеддинг запроса
+            top_k: Количество результатов
+            min_similarity: Минимальное сходство
+            candidates: Лиды для переранжирования (None - поиск по всему индексу)
+        """
+        self.ensure_started()
+        if candidates is not None:
+            return self._snapshot.rerank(query_vector, candidates, top_k, min_similarity)
+        return self._snapshot.search(query_vector, top_k, min_similarity)
+
+    def lexical_candidates(self, query: str, limit: int) -> List[int]:
+        """Лиды, лучше всего совпадающие со словами запроса (BM25)"""
+        return [lead_id for lead_id, _, _ in self.lexical.search(query, limit)]
+
+    def search_lexical(self, query: str, top_k: int, min_coverage: float) -> List[Tuple[Dict, float]]:
+        """
+        Поиск только по словам запроса (без эмбеддингов)
+
+        Args:
+            query: Текст запроса
+            top_k: Количество результатов
+            min_coverage: Минимальная доля слов запроса, найденных в диалоге
+
+        Returns:
+            Список (диалог, доля совпавших слов) по убыванию BM25
+        """
+        results = []
+        for lead_id, _, coverage in self.lexical.search(query, top_k):
+            conv = self._entries.get(lead_id)
+            if conv is not None and coverage >= min_coverage:
+                results.append((conv, coverage))
+        return results
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class EmbeddingCache:
+    """
+    Кэш эмбеддингов: LRU в памяти поверх таблицы embedding_cache в SQLite
+
+    Ключ - хэш текста вместе с названием модели, поэтому неизменившиеся
+    диалоги не отправляются в OpenAI повторно (в том числе после рестарта).
+    """
+
+    def __init__(self, db: database.Database, max_items: int = None):
+        self.db = db
+        self.max_items = max_items or config.EMBEDDING_CACHE_SIZE
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Счетчики для мониторинга
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        """Ключ кэша: sha256 от модели и текста"""
+        return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Получение векторов по ключам (сначала память, затем SQLite)
+
+        Returns:
+            Словарь {ключ: вектор float32} только для найденных ключей
+        """
+        found = {}
+        missing = []
+
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+                    self.memory_hits += 1
+                else:
+                    missing.append(key)
+
+        if missing:
+            try:
+                rows = self.db.get_cached_embeddings(missing)
+            except Exception as e:
+                logger.warning(f"Embedding cache read failed: {e}")
+                rows = {}
+
+            with self._lock:
+                for key in missing:
+                    blob = rows.get(key)
+                    if blob is None:
+                        self.misses += 1
+                        continue
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    found[key] = vector
+                    self.disk_hits += 1
+                    self._remember(key, vector)
+
+        return found
+
+    def put_many(self, model: str, vectors: Dict[str, np.ndarray]):
+        """Сохранение новых векторов в память и SQLite"""
+        if not vectors:
+            return
+
+        with self._lock:
+            for key, vector in vectors.items():
+                self._remember(key, vector)
+
+        try:
+            self.db.save_cached_embeddings([
+                (key, model, len(vector), vector.astype(np.float32).tobytes())
+                for key, vector in vectors.items()
+            ])
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+
+    def _remember(self, key: str, vector: np.ndarray):
+        """Добавление в LRU с вытеснением самых старых (вызывать под блокировкой)"""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def get_stats(self) -> Dict:
+        """Статистика попаданий в кэш"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / total if total else 0.0,
+                'memory_items': len(self._memory),
+            }
+
+
+class QueryCache:
+    """
+    LRU кэш с временем жизни записей для повторяющихся запросов клиентов
+
+    Ключи - нормализованные запросы (utils.normalize_query), поэтому
+    "Здравствуйте, интересует автоматизация договоров!" и
+    "здравствуйте интересует автоматизация договоров" дают одно попадание.
+    """
+
+    def __init__(self, max_items: int = None, ttl: float = None):
+        self.max_items = max_items or config.RAG_QUERY_CACHE_SIZE
+        self.ttl = config.RAG_QUERY_CACHE_TTL if ttl is None else ttl
+        # ключ -> (момент истечения, значение)
+        self._items: "OrderedDict[Tuple, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple):
+        """Значение по ключу или None (если нет или истекло)"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Tuple, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'items': len(self._items),
+            }
+
+
 class KnowledgeEngine:
     """Движок для семантического поиска похожих диалогов"""
     
-    def __init__(self):
-        self.client = OpenAI(api_key=config.OPENAI_API_KEY)
+    def __init__(self, db: Optional[database.Database] = None):
+        self.client = OpenAI(api_key=config.OPENAI_API_KEY, max_retries=0)
         self.embedding_model = "text-embedding-3-small"  # Дешёвая и быстрая модель
+        self.db = db if db is not None else database.db
+        self.embedding_cache = EmbeddingCache(self.db)
+        # Последний построенный корпус (переиспользуется, пока набор диалогов не изменился)
+        self._corpus: Optional[CorpusMatrix] = None
+        # Инкрементальный индекс успешных диалогов, обновляется при записи лидов
+        self.rag_index = RagIndex(self)
+        self.db.add_change_listener(self.rag_index.on_change)
+        # Кэши запросов клиентов: эмбеддинги и готовые результаты поиска
+        self.query_embeddings = QueryCache()
+        self.query_results = QueryCache()
+        # Версия RAG индекса, для которой собраны результаты в query_results
+        self._results_version = None
+        # Количество запросов эмбеддингов к OpenAI (для контроля эффективности кэша);
+        # запросы идут из потоков поиска RAG и индекса - счетчик под блокировкой
+        self.embedding_api_calls = 0
+        self._stats_lock = threading.Lock()
         logger.info("KnowledgeEngine initialized")
     
-    def get_embedding(self, text: str) -> List[float]:
+    def _count_api_call(self):
+        with self._stats_lock:
+            self.embedding_api_calls += 1
+
+    def get_embedding(self, text: str, timeout: Optional[float] = None) -> List[float]:
         """
         Получение эмбеддинга текста
         
         Args:
             text: Текст для эмбеддинга
+            timeout: Таймаут запроса в секундах (None - таймаут клиента по умолчанию)
             
         Returns:
             Вектор эмбеддинга
         """
         try:
-            response = self.client.embeddings.create(
+            self._count_api_call()
+            response = openai_guard.openai_guard.call(
+                self.client.embeddings.create,
                 input=text,
-                model=self.embedding_model
+                model=self.embedding_model,
+                timeout=timeout
             )
+            usage_tracker.usage_tracker.record(getattr(response, 'usage', None))
             return response.data[0].embedding
+        except openai_guard.CircuitOpenError:
+            # OpenAI недоступен - поиск RAG обойдется BM25
+            logger.debug("Embedding skipped: OpenAI circuit breaker is open")
+            return []
         except Exception as e:
             logger.error(f"Error getting embedding: {e}")
             return []
     
+    def get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Получение эмбеддингов нескольких текстов пакетными запросами
+        
+        Тексты упаковываются в запросы не больше EMBEDDING_BATCH_SIZE текстов
+        и EMBEDDING_BATCH_MAX_TOKENS токенов (оценка с запасом).
+        
+        Args:
+            texts: Тексты для эмбеддинга
+            
+        Returns:
+            Векторы в том же порядке (пустой список для текстов из неудачного запроса)
+        """
+        results: List[List[float]] = [[] for _ in texts]
+        
+        for batch in self._split_into_batches(texts):
+            try:
+                self._count_api_call()
+                response = openai_guard.openai_guard.call(
+                    self.client.embeddings.create,
+                    input=[texts[i] for i in batch],
+                    model=self.embedding_model
+                )
+                usage_tracker.usage_tracker.record(getattr(response, 'usage', None))
+                for item in response.data:
+                    results[batch[item.index]] = item.embedding
+            except Exception as e:
+                logger.error(f"Error getting embeddings batch ({len(batch)} texts): {e}")
+        
+        return results
+    
+    def _split_into_batches(self, texts: List[str]) -> List[List[int]]:
+        """
+        Разбиение текстов на пакеты с учетом лимитов
+        
+        Returns:
+            Списки индексов текстов для каждого запроса
+        """
+        batches = []
+        current = []
+        current_tokens = 0
+        
+        for i, text in enumerate(texts):
+            tokens = self._estimate_tokens(text)
+            if current and (
+                len(current) >= config.EMBEDDING_BATCH_SIZE
+                or current_tokens + tokens > config.EMBEDDING_BATCH_MAX_TOKENS
+            ):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(i)
+            current_tokens += tokens
+        
+        if current:
+            batches.append(current)
+        
+        return batches
+    
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        """
+        Оценка количества токенов с запасом
+        
+        Кириллица занимает больше токенов, чем латиница, поэтому считаем 1 токен ≈ 2 символа.
+        """
+        return len(text) // 2 + 1
+    
+    def get_cached_embedding(self, text: str) -> Optional[np.ndarray]:
+        """
+        Получение эмбеддинга через кэш (для текстов корпуса, которые редко меняются)
+        
+        Args:
+            text: Текст для эмбеддинга
+            
+        Returns:
+            Вектор float32 или None при ошибке
+        """
+        return self.get_cached_embeddings([text])[0]
+    
+    def get_cached_embeddings(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Получение эмбеддингов нескольких текстов через кэш
+        
+        Args:
+            texts: Тексты для эмбеддинга
+            
+        Returns:
+            Векторы float32 в том же порядке (None для текстов с ошибкой)
+        """
+        keys = [EmbeddingCache.make_key(text, self.embedding_model) for text in texts]
+        cached = self.embedding_cache.get_many(keys)
+        
+        # Недостающие тексты (без дублей) запрашиваем пакетами
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        
+        new_vectors = {}
+        if missing:
+            embeddings = self.get_embeddings_batch(list(missing.values()))
+            for key, embedding in zip(missing.keys(), embeddings):
+                if embedding:
+                    new_vectors[key] = np.asarray(embedding, dtype=np.float32)
+        
+        self.embedding_cache.put_many(self.embedding_model, new_vectors)
+        cached.update(new_vectors)
+        
+        return [cached.get(key) for key in keys]
+    
+    def embed_conversations(self, conversations: List[Dict]) -> List[Optional[np.ndarray]]:
+        """
+        Эмбеддинги диалогов через кэш
+        
+        Args:
+            conversations: Список диалогов
+            
+        Returns:
+            Векторы в том же порядке (None для диалогов с ошибкой)
+        """
+        texts = [self._format_conversation_for_embedding(conv) for conv in conversations]
+        return self.get_cached_embeddings(texts)
+    
+    def index_conversations(self, conversations: List[Dict]) -> int:
+        """
+        Предварительный расчет эмбеддингов корпуса (холодный старт, дозаполнение)
+        
+        Args:
+            conversations: Список диалогов
+            
+        Returns:
+            Количество диалогов с готовым эмбеддингом
+        """
+        api_calls_before = self.embedding_api_calls
+        
+        vectors = self.embed_conversations(conversations)
+        indexed = sum(1 for vector in vectors if vector is not None)
+        
+        logger.info(
+            f"Indexed {indexed}/{len(conversations)} conversations "
+            f"(embedding API calls: {self.embedding_api_calls - api_calls_before})"
+        )
+        return indexed
+    
+    def reindex_corpus(self, limit: int = 5000) -> int:
+        """
+        Индексация успешных диалогов из БД
+        
+        Args:
+            limit: Максимальное количество диалогов
+            
+        Returns:
+            Количество проиндексированных диалогов
+        """
+        conversations = self.db.get_successful_conversations(limit=limit)
+        return self.index_conversations(conversations)
+    
+    def get_cache_stats(self) -> Dict:
+        """Статистика кэша эмбеддингов и количество запросов к OpenAI"""
+        stats = self.embedding_cache.get_stats()
+        stats['api_calls'] = self.embedding_api_calls
+        return stats
+    
+    def get_query_cache_stats(self) -> Dict:
+        """
+        Статистика кэшей запросов клиентов
+        
+        Returns:
+            Статистика кэша эмбеддингов запросов и кэша результатов, а также
+            сколько запросов эмбеддингов удалось не делать
+        """
+        embeddings = self.query_embeddings.get_stats()
+        results = self.query_results.get_stats()
+        # Попадание в кэш результатов не доходит до кэша эмбеддингов
+        searches = results['hits'] + results['misses']
+        avoided = results['hits'] + embeddings['hits']
+        return {
+            'embeddings': embeddings,
+            'results': results,
+            'embedding_calls_avoided': avoided,
+            'avoided_rate': avoided / searches if searches else 0.0,
+        }
+    
+    def format_rag_stats(self) -> str:
+        """Статистика RAG для админ-панели"""
+        query_stats = self.get_query_cache_stats()
+        cache_stats = self.get_cache_stats()
+        return (
+            f"🧠 RAG\n"
+            f"📚 Диалогов в индексе: {len(self.rag_index)}\n"
+            f"🔁 Кэш результатов: {query_stats['results']['hit_rate']:.0%}\n"
+            f"🔤 Кэш эмбеддингов запросов: {query_stats['embeddings']['hit_rate']:.0%}\n"
+            f"💸 Запросов эмбеддингов сэкономлено: {query_stats['embedding_calls_avoided']} "
+            f"({query_stats['avoided_rate']:.0%})\n"
+            f"📡 Запросов эмбеддингов к OpenAI: {cache_stats['api_calls']}"
+        )
+    
     def cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
         """
         Вычисление косинусного сходства между двумя векторами
@@ -54,7 +1022,7 @@ class KnowledgeEngine:
         Returns:
             Косинусное сходство (0-1)
         """
-        if not vec1 or not vec2:
+        if len(vec1) == 0 or len(vec2) == 0:
             return 0.0
         
         vec1_np = np.array(vec1)
@@ -93,6 +1061,8 @@ class KnowledgeEngine:
             logger.debug("No conversations provided for similarity search")
             return []
         
+        api_calls_before = self.embedding_api_calls
+        
         # Получаем эмбеддинг запроса
         query_embedding = self.get_embedding(query)
         
@@ -100,31 +1070,131 @@ class KnowledgeEngine:
             logger.error("Failed to get query embedding")
             return []
         
-        # Вычисляем сходство с каждым диалогом
-        similarities = []
+        corpus = self._get_corpus(conversations)
+        top_results = corpus.search(np.asarray(query_embedding, dtype=np.float32), top_k, min_similarity)
         
-        for conv in conversations:
-            # Формируем текст диалога для эмбеддинга
-            conv_text = self._format_conversation_for_embedding(conv)
-            conv_embedding = self.get_embedding(conv_text)
+        logger.info(
+            f"Found {len(top_results)} similar conversations (from {len(conversations)} total, "
+            f"embedding API calls: {self.embedding_api_calls - api_calls_before})"
+        )
+        for i, (_, sim) in enumerate(top_results, 1):
+            logger.debug(f"  #{i}: similarity={sim:.3f}")
+        
+        return top_results
+    
+    def search_similar(
+        self,
+        query: str,
+        top_k: int = 3,
+        min_similarity: float = 0.5
+    ) -> List[Tuple[Dict, float]]:
+        """
+        Гибридный поиск похожих успешных диалогов по инкрементальному индексу
+        
+        Сначала BM25 отбирает до RAG_HYBRID_CANDIDATES диалогов по словам запроса,
+        затем они переранжируются по эмбеддингу. Если лексических кандидатов не
+        хватило, ищем по всему векторному индексу. Если эмбеддинг запроса не
+        получен (ошибка или таймаут RAG_EMBEDDING_TIMEOUT), возвращаем результаты
+        BM25 - в этом случае сходство равно доле найденных слов запроса.
+        
+        Эмбеддинги и результаты кэшируются по нормализованному запросу;
+        результаты сбрасываются при каждом изменении RAG индекса.
+        
+        Args:
+            query: Запрос клиента
+            top_k: Количество топ результатов
+            min_similarity: Минимальное сходство (0-1)
             
-            if conv_embedding:
-                similarity = self.cosine_similarity(query_embedding, conv_embedding)
-                
-                if similarity >= min_similarity:
-                    similarities.append((conv, similarity))
+        Returns:
+            Список кортежей (диалог, сходство) отсортированный по релевантности
+        """
+        if not self.rag_index.ensure_started():
+            # Индекс строится в фоне - пока отвечаем без примеров
+            logger.debug("RAG index is not ready yet, skipping search")
+            return []
         
-        # Сортируем по убыванию сходства
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        if len(self.rag_index) == 0:
+            return []
         
-        # Возвращаем топ-K
-        top_results = similarities[:top_k]
+        normalized = normalize_query(query)
+        version = self.rag_index.version
+        if self._results_version != version:
+            # Индекс изменился - сохраненные результаты устарели
+            self.query_results.clear()
+            self._results_version = version
         
-        logger.info(f"Found {len(top_results)} similar conversations (from {len(conversations)} total)")
-        for i, (_, sim) in enumerate(top_results, 1):
-            logger.debug(f"  #{i}: similarity={sim:.3f}")
+        results_key = (normalized, top_k, min_similarity)
+        cached = self.query_results.get(results_key)
+        if cached is not None:
+            logger.debug("RAG results served from query cache")
+            return list(cached)
         
-        return top_results
+        candidates = None
+        if config.RAG_HYBRID_CANDIDATES > 0:
+            candidates = self.rag_index.lexical_candidates(query, config.RAG_HYBRID_CANDIDATES)
+        
+        query_vector = self.query_embeddings.get((normalized,))
+        if query_vector is None:
+            query_embedding = self.get_embedding(query, timeout=config.RAG_EMBEDDING_TIMEOUT)
+            if not query_embedding:
+                # Результаты BM25 не кэшируем: эмбеддинги недоступны временно
+                results = self.rag_index.search_lexical(query, top_k, config.RAG_LEXICAL_MIN_COVERAGE)
+                logger.warning(f"Query embedding unavailable, using lexical RAG results: {len(results)}")
+                return results
+            query_vector = np.asarray(query_embedding, dtype=np.float32)
+            self.query_embeddings.put((normalized,), query_vector)
+        
+        results = []
+        if candidates and len(candidates) >= top_k:
+            results = self.rag_index.search(query_vector, top_k, min_similarity, candidates=candidates)
+        if len(results) < top_k:
+            # Лексический этап не нашел достаточно похожих - полный векторный поиск
+            results = self.rag_index.search(query_vector, top_k, min_similarity)
+        
+        if self.rag_index.version == version:
+            self.query_results.put(results_key, tuple(results))
+        
+        logger.info(f"Found {len(results)} similar conversations in RAG index ({len(self.rag_index)} total)")
+        return results
+    
+    def rebuild_index(self) -> int:
+        """Полная перестройка RAG индекса из БД (восстановление)"""
+        return self.rag_index.rebuild()
+    
+    def _get_corpus(self, conversations: List[Dict]) -> CorpusMatrix:
+        """
+        Матрица корпуса для списка диалогов (строится заново только при изменении текстов)
+        
+        Args:
+            conversations: Список диалогов
+            
+        Returns:
+            Корпус с нормализованной матрицей эмбеддингов
+        """
+        texts = [self._format_conversation_for_embedding(conv) for conv in conversations]
+        keys = tuple(EmbeddingCache.make_key(text, self.embedding_model) for text in texts)
+        
+        corpus = self._corpus
+        if corpus is not None and corpus.keys == keys:
+            # Тексты не изменились - обновляем только метаданные диалогов
+            corpus.items = conversations
+            return corpus
+        
+        vectors = self.get_cached_embeddings(texts)
+        items = [conv for conv, vector in zip(conversations, vectors) if vector is not None]
+        rows = [vector for vector in vectors if vector is not None]
+        
+        if rows:
+            matrix = normalize_rows(np.vstack(rows))
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        
+        corpus = CorpusMatrix(keys, items, matrix)
+        # Кэшируем только полностью построенный корпус
+        if len(rows) == len(conversations):
+            self._corpus = corpus
+        
+        return corpus
     
     def _format_conversation_for_embedding(self, conv: Dict) -> str:
         """
@@ -168,6 +1238,23 @@ class KnowledgeEngine:
         
         return text[:1000]  # Ограничиваем длину
     
+    def _format_conversation_for_search(self, conv: Dict) -> str:
+        """
+        Текст диалога для лексического индекса: поля лида и все сообщения
+        
+        Args:
+            conv: Словарь с данными диалога
+            
+        Returns:
+            Текст без служебных подписей
+        """
+        parts = [
+            conv.get(field) or ''
+            for field in ('service_category', 'specific_need', 'pain_point', 'industry')
+        ]
+        parts.extend(msg.get('message', '') for msg in conv.get('messages', []))
+        return "\n".join(part for part in parts if part)
+    
     def format_similar_examples_for_prompt(
         self, 
         similar_results: List[Tuple[Dict, float]]
@@ -232,12 +1319,22 @@ knowledge_engine = KnowledgeEngine()
 
 
 if __name__ == '__main__':
-    # Тестирование
+    parser = argparse.ArgumentParser(description="RAG Knowledge Engine")
+    parser.add_argument('--reindex', action='store_true', help="Рассчитать эмбеддинги успешных диалогов из БД")
+    parser.add_argument('--limit', type=int, default=5000, help="Максимум диалогов для индексации")
+    args = parser.parse_args()
+    
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.INFO if args.reindex else logging.DEBUG,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
     
+    if args.reindex:
+        indexed = knowledge_engine.reindex_corpus(limit=args.limit)
+        print(f"Indexed {indexed} conversations, cache: {knowledge_engine.get_cache_stats()}")
+        raise SystemExit(0)
+    
+    # Тестирование
     print("Testing KnowledgeEngine...")
     
     # Тест эмбеддинга
@@ -266,6 +1363,7 @@ if __name__ == '__main__':
     )
     
     print(f"\nFound {len(similar)} similar conversations")
+    print(f"Embedding cache: {knowledge_engine.get_cache_stats()}")
     formatted = knowledge_engine.format_similar_examples_for_prompt(similar)
     print("\nFormatted output:")
     print(formatted)
@@ -0,0 +1,273 @@
+"""
+Фоновое извлечение данных лида из диалогов
+
+Обработчики сообщений не ждут второй запрос к LLM после ответа клиенту:
+они ставят пользователя в очередь, а воркеры извлекают данные по последней
+истории диалога из БД. Если клиент пишет несколько сообщений подряд,
+пока его задача ждет в очереди, выполняется одно извлечение.
+
+Извлечение инкрементальное: в промпт идут ранее извлеченные данные и только
+сообщения после прошлого извлечения, каждое LEAD_EXTRACTION_FULL_EVERY-е
+извлечение - по полной истории. Если в новых сообщениях нет данных лида
+(lead_rules.pre_extract), запрос к LLM не делается. Экономия токенов промпта
+копится по каждому диалогу в таблице lead_extraction_state.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from config import Config
+config = Config()
+import database
+import ai_brain
+import context_builder
+import lead_rules
+import openai_guard
+
+logger = logging.getLogger(__name__)
+
+# Обработка результата: получает извлеченные данные лида
+ResultCallback = Callable[[Dict], Awaitable[None]]
+
+
+class LeadExtractionQueue:
+    """
+    Очередь извлечения данных лида с объединением задач по пользователю
+
+    На пользователя в очереди не больше одной задачи: повторная постановка
+    заменяет обработчик результата, а извлечение берет свежую историю.
+    Для пользователя, чья задача уже выполняется, следующая ставится в
+    очередь после ее завершения (одновременно по одному пользователю
+    работает не больше одного извлечения).
+    """
+
+    def __init__(self, max_pending: int = None, workers: int = None):
+        self.max_pending = max_pending or config.LEAD_EXTRACTION_QUEUE_SIZE
+        self.workers = workers or config.LEAD_EXTRACTION_WORKERS
+
+        # user_id -> (обработчик результата, момент первой постановки)
+        self._pending: Dict[int, Tuple[ResultCallback, float]] = {}
+        self._running: Set[int] = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._closing = False
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        # Извлечения без запроса к LLM (lead_rules: в новых сообщениях нет данных лида)
+        self.skipped = 0
+        # Извлечения, отложенные из-за недоступности OpenAI (повторятся со следующим сообщением)
+        self.deferred = 0
+        self.max_depth = 0
+        # Ожидание в очереди от постановки до начала извлечения
+        self.wait_time = ai_brain.LatencyStats()
+
+    def ensure_started(self):
+        """Запуск воркеров в текущем event loop (при первой постановке)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._closing = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Lead extraction queue started: {self.workers} workers, max {self.max_pending} pending")
+
+    def submit(self, user_id: int, on_result: ResultCallback) -> bool:
+        """
+        Постановка извлечения данных лида в очередь
+
+        Args:
+            user_id: ID пользователя в БД
+            on_result: Корутина обработки извлеченных данных
+
+        Returns:
+            False если очередь переполнена или останавливается
+        """
+        if self._closing:
+            logger.warning(f"Lead extraction queue is draining, skipping user {user_id}")
+            return False
+        self.ensure_started()
+
+        if user_id in self._pending:
+            # Задача уже ждет - она возьмет свежую историю
+            self._pending[user_id] = (on_result, self._pending[user_id][1])
+            self.coalesced += 1
+            return True
+
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Lead extraction queue is full ({len(self._pending)}), skipping user {user_id}")
+            return False
+
+        self._pending[user_id] = (on_result, time.perf_counter())
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, len(self._pending))
+        if user_id not in self._running:
+            self._queue.put_nowait(user_id)
+        return True
+
+    async def _worker(self):
+        while True:
+            user_id = await self._queue.get()
+            try:
+                on_result, enqueued_at = self._pending.pop(user_id)
+                self._running.add(user_id)
+                self.wait_time.add(time.perf_counter() - enqueued_at)
+                await self._extract(user_id, on_result)
+            finally:
+                self._running.discard(user_id)
+                if user_id in self._pending:
+                    # Пока шло извлечение, пришли новые сообщения
+                    self._queue.put_nowait(user_id)
+                self._queue.task_done()
+
+    async def _extract(self, user_id: int, on_result: ResultCallback):
+        try:
+            conversation_history = await database.adb.get_conversation_history(user_id)
+            if not conversation_history:
+                return
+
+            state = await database.adb.get_lead_extraction_state(user_id)
+            last_message_id = conversation_history[-1]['id']
+            if state and state['last_message_id'] >= last_message_id:
+                # Новых сообщений нет - прошлый результат актуален
+                return
+
+            # Оценка токенов промпта с полной историей (для учета экономии)
+            full_prompt_tokens = self._estimate_prompt_tokens(conversation_history, None)
+
+            new_messages = conversation_history
+            if state:
+                new_messages = [msg for msg in conversation_history if msg['id'] > state['last_message_id']]
+            needs_llm, rule_fields = lead_rules.pre_extract(new_messages)
+
+            if state and not needs_llm:
+                # В новых сообщениях нет данных для LLM - дополняем прошлый результат правилами
+                lead_data = {**state['lead_data'], **rule_fields}
+                await database.adb.save_lead_extraction_state(
+                    user_id, lead_data, last_message_id, state['incremental_runs'], 0, full_prompt_tokens
+                )
+                self.skipped += 1
+                await on_result(lead_data)
+                return
+
+            if not openai_guard.openai_guard.is_available():
+                # Состояние не сохраняем - сообщения попадут в следующее извлечение
+                self.deferred += 1
+                logger.info(f"Lead extraction for user {user_id} deferred: OpenAI circuit breaker is open")
+                return
+
+            previous_lead_data, incremental_runs, messages = self._plan_extraction(conversation_history, state)
+
+            prompt_tokens = full_prompt_tokens
+            if previous_lead_data is not None:
+                prompt_tokens = self._estimate_prompt_tokens(messages, previous_lead_data)
+                if prompt_tokens >= full_prompt_tokens:
+                    # Короткий диалог: прошлые данные длиннее истории - полное извлечение не дороже
+                    previous_lead_data, incremental_runs, messages = None, 0, conversation_history
+                    prompt_tokens = full_prompt_tokens
+
+            lead_data = await ai_brain.ai_brain.extract_lead_data_async(
+                messages, previous_lead_data, user_id=user_id
+            )
+            if lead_data:
+                # Контакты и числа, найденные правилами, надежнее пропущенных моделью
+                for key, value in rule_fields.items():
+                    if not lead_data.get(key):
+                        lead_data[key] = value
+                await database.adb.save_lead_extraction_state(
+                    user_id, lead_data, last_message_id, incremental_runs, prompt_tokens, full_prompt_tokens
+                )
+                await on_result(lead_data)
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error in background lead extraction for user {user_id}: {e}")
+
+    @staticmethod
+    def _plan_extraction(conversation_history, state: Optional[Dict]):
+        """
+        Выбор режима извлечения
+
+        Инкрементально (прошлые данные + новые сообщения), если есть прошлое
+        извлечение, все новые сообщения попали в окно истории и не пора делать
+        полное извлечение для коррекции накопленных ошибок.
+
+        Returns:
+            (прошлые данные или None, счетчик инкрементальных извлечений, сообщения для промпта)
+        """
+        full_every = config.LEAD_EXTRACTION_FULL_EVERY
+        if not state or full_every <= 0 or state['incremental_runs'] + 1 >= full_every:
+            return None, 0, conversation_history
+
+        new_messages = [msg for msg in conversation_history if msg['id'] > state['last_message_id']]
+        if len(new_messages) == len(conversation_history):
+            # Окно истории целиком новое - часть сообщений могла в него не попасть
+            return None, 0, conversation_history
+        return state['lead_data'], state['incremental_runs'] + 1, new_messages
+
+    @staticmethod
+    def _estimate_prompt_tokens(messages, previous_lead_data: Optional[Dict]) -> int:
+        prompt = ai_brain.ai_brain._build_extraction_messages(messages, previous_lead_data)
+        return context_builder.context_builder.count_message_tokens(prompt)
+
+    async def drain(self, timeout: float = None):
+        """
+        Остановка: новые задачи не принимаются, поставленные дорабатываются
+
+        Args:
+            timeout: Сколько ждать завершения (по умолчанию LEAD_EXTRACTION_DRAIN_TIMEOUT)
+        """
+        if not self._tasks:
+            return
+        self._closing = True
+        timeout = config.LEAD_EXTRACTION_DRAIN_TIMEOUT if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+            logger.info("Lead extraction queue drained")
+        except asyncio.TimeoutError:
+            logger.warning(f"Lead extraction drain timed out, {len(self._pending) + len(self._running)} users not processed")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get_stats(self) -> Dict:
+        """Статистика очереди"""
+        return {
+            'pending': len(self._pending),
+            'running': len(self._running),
+            'max_depth': self.max_depth,
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'deferred': self.deferred,
+            'wait': self.wait_time.get_stats(),
+        }
+
+    def format_stats(self) -> str:
+        """Статистика очереди для админ-панели"""
+        stats = self.get_stats()
+        savings = database.db.get_lead_extraction_savings()
+        saved = savings['full_prompt_tokens'] - savings['prompt_tokens']
+        saved_rate = saved / savings['full_prompt_tokens'] if savings['full_prompt_tokens'] else 0.0
+        return (
+            f"🧾 Извлечение лидов\n"
+            f"📥 В очереди: {stats['pending']} (макс. {stats['max_depth']}), выполняется: {stats['running']}\n"
+            f"🔗 Объединено повторных: {stats['coalesced']} из {stats['submitted'] + stats['coalesced']}\n"
+            f"⏳ Ожидание: p50 {stats['wait']['p50']:.2f}с, p95 {stats['wait']['p95']:.2f}с\n"
+            f"✅ Выполнено: {stats['completed']}, без LLM: {stats['skipped']}, "
+            f"ошибок: {stats['failed']}, отброшено: {stats['dropped']}, отложено (OpenAI недоступен): {stats['deferred']}\n"
+            f"💸 Токенов промпта сэкономлено: ~{saved} ({saved_rate:.0%}) на {savings['conversations']} диалогах"
+        )
+
+
+# Глобальный экземпляр
+lead_extraction_queue = LeadExtractionQueue()
@@ -0,0 +1,138 @@
+"""
+Локальный разбор сообщений клиента перед извлечением данных лида через LLM
+
+Большинство сообщений ("ок", "спасибо", "а сколько стоит?") не содержат новых
+данных лида. pre_extract по регулярным выражениям и словарям (взятым из
+prompts.EXTRACT_DATA_PROMPT) решает, нужен ли запрос к LLM, и сам заполняет
+очевидные поля: email, телефон, размер команды, число договоров, бюджет, срочность.
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+import utils
+
+# Сообщение длиннее - может содержать что угодно, отдаем LLM
+MAX_TRIVIAL_WORDS = 8
+
+# Направления услуг (как в EXTRACT_DATA_PROMPT) - выбор категории и потребности за LLM
+SERVICE_KEYWORDS = {
+    'Договорная работа': ['договор', 'контракт', 'генерац', 'документооборот', 'шаблон'],
+    'Судебная работа': ['суд', 'иск', 'апелляц', 'претензи', 'арбитраж', 'процесс'],
+    'M&A и корпоративное': ['m&a', 'слияни', 'поглощени', 'due diligence', 'корпоратив', 'реорганизац'],
+    'Земельное право': ['земл', 'земельн', 'кадастр'],
+    'Комплаенс': ['комплаенс', 'законодательств', 'мониторинг', '152-фз', 'персональн', 'gdpr'],
+    'Аналитика': ['аналитик', 'отчет', 'дашборд'],
+    'Аутсорсинг': ['аутсорс', 'внешний юрист', 'сопровожден'],
+    'Кастомная разработка': ['интеграц', '1с', '1c', 'crm', 'erp', 'под ключ', 'разработк', 'автоматиз'],
+}
+
+# Признаки данных, которые определяет только LLM: боль, имя, компания, отрасль, намерение
+LLM_KEYWORDS = [
+    # Боль
+    'проблем', 'не успева', 'теря', 'ошибк', 'долго', 'рутин', 'пропуска', 'риск', 'штраф', 'нужн', 'хотим', 'хочу',
+    # Имя, компания, отрасль
+    'меня зовут', 'зовут', 'компани', 'ооо', 'занимаемся', 'работаем в', 'отрасл',
+    'торговл', 'производств', 'строител', 'недвижим', 'банк', 'агро', 'сельск',
+    # Готовность к консультации
+    'консультац', 'созвон', 'встреч', 'свяжитесь', 'позвоните', 'перезвон', 'когда можем', 'готовы начать',
+]
+
+URGENCY_KEYWORDS = ['срочно', 'на вчера', 'как можно скорее', 'asap', 'горит', 'немедленно']
+
+_TEAM_RE = re.compile(r'(\d+)\s*(?:юрист|человек|сотрудник|специалист)')
+_CONTRACTS_RE = re.compile(r'(\d+)\s*(?:договор\w*|контракт\w*)\s*(?:в|за)\s*месяц')
+_BUDGET_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(тыс|т\.р|k\b|к\b|млн|000\b)')
+
+
+def _bucket(value: float, buckets: List[Tuple[float, str]], above: str) -> str:
+    """Значение в категорию: первая граница, не меньшая значения"""
+    for limit, label in buckets:
+        if value <= limit:
+            return label
+    return above
+
+
+def _parse_budget(text: str) -> Optional[str]:
+    """Бюджет в категориях EXTRACT_DATA_PROMPT (только если рядом слово "бюджет" или валюта)"""
+    if not any(word in text for word in ('бюджет', 'руб', '₽', 'готовы потратить', 'заплатить')):
+        return None
+    match = _BUDGET_RE.search(text)
+    if not match:
+        return None
+    value = float(match.group(1).replace(',', '.'))
+    unit = match.group(2)
+    thousands = value * 1000 if unit == 'млн' else value
+    return _bucket(thousands, [(100, 'до 100K'), (300, '100-300K'), (500, '300-500K')], '500K+')
+
+
+def _parse_fields(text: str) -> Dict:
+    """Поля, которые надежно извлекаются без LLM"""
+    fields = {}
+
+    email = utils.extract_email(text)
+    if email and utils.validate_email(email):
+        fields['email'] = email
+
+    phone = utils.extract_phone(text)
+    if phone and utils.validate_phone(phone):
+        fields['phone'] = utils.format_phone(phone)
+
+    lowered = text.lower().replace('ё', 'е')
+
+    match = _TEAM_RE.search(lowered)
+    if match:
+        fields['team_size'] = _bucket(int(match.group(1)), [(3, '1-3'), (10, '4-10')], '10+')
+
+    match = _CONTRACTS_RE.search(lowered)
+    if match:
+        fields['contracts_per_month'] = _bucket(
+            int(match.group(1)), [(9, 'до 10'), (30, '10-30'), (50, '30-50')], '50+'
+        )
+
+    budget = _parse_budget(lowered)
+    if budget:
+        fields['budget'] = budget
+
+    if any(word in lowered for word in URGENCY_KEYWORDS):
+        fields['urgency'] = 'high'
+
+    return fields
+
+
+def _needs_llm(text: str) -> bool:
+    """Есть ли в сообщении данные, которые может разобрать только LLM"""
+    # Контакты не считаем словами - "мой email ivan@company.ru" короткое сообщение
+    stripped = re.sub(utils.EMAIL_PATTERN, ' ', text)
+    stripped = re.sub(utils.PHONE_PATTERN, ' ', stripped)
+    lowered = stripped.lower().replace('ё', 'е')
+
+    if len(lowered.split()) > MAX_TRIVIAL_WORDS:
+        return True
+    if any(word in lowered for words in SERVICE_KEYWORDS.values() for word in words):
+        return True
+    return any(word in lowered for word in LLM_KEYWORDS)
+
+
+def pre_extract(messages: List[Dict[str, str]]) -> Tuple[bool, Dict]:
+    """
+    Локальный разбор новых сообщений диалога
+
+    Args:
+        messages: Новые сообщения с прошлого извлечения (учитываются только сообщения клиента)
+
+    Returns:
+        (нужен ли запрос к LLM, поля, заполненные правилами)
+    """
+    fields = {}
+    needs_llm = False
+    for msg in messages:
+        if msg['role'] != 'user':
+            continue
+        text = msg.get('content') or msg.get('message') or ''
+        fields.update(_parse_fields(text))
+        needs_llm = needs_llm or _needs_llm(text)
+
+    # Бюджет и срочность меняют lead_temperature - ее пересчитывает LLM
+    if 'budget' in fields or 'urgency' in fields:
+        needs_llm = True
+    return needs_llm, fields
@@ -0,0 +1,137 @@
+"""
+Лексический индекс BM25 для первого этапа RAG поиска
+
+Работает полностью локально: отбирает кандидатов по словам запроса до
+векторного переранжирования и отвечает сам, если эмбеддинги недоступны.
+"""
+
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Hashable, List, Tuple
+
+# Слова из букв и цифр (кириллица и латиница)
+_WORD_RE = re.compile(r"[0-9a-zа-яё]+")
+
+# Частые слова, не несущие смысла для поиска
+STOP_WORDS = {
+    'и', 'в', 'во', 'не', 'на', 'с', 'со', 'по', 'к', 'ко', 'о', 'об', 'от', 'до', 'за', 'из',
+    'у', 'для', 'что', 'как', 'а', 'но', 'или', 'же', 'ли', 'бы', 'то', 'это', 'мы', 'вы',
+    'я', 'он', 'она', 'они', 'нас', 'вас', 'нам', 'вам', 'мне', 'меня', 'наш', 'ваш', 'есть',
+    'так', 'уже', 'еще', 'ещё', 'очень', 'можно', 'нужно', 'нужен', 'нужна', 'здравствуйте',
+    'the', 'and', 'or', 'of', 'to', 'in', 'for', 'a', 'an', 'is',
+}
+
+# Длина основы слова: грубая замена стемминга для русской морфологии
+# ("договор", "договора", "договоров" -> "догово")
+STEM_LENGTH = 6
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Разбиение текста на основы слов
+
+    Args:
+        text: Исходный текст
+
+    Returns:
+        Список основ (без стоп-слов и однобуквенных слов)
+    """
+    words = _WORD_RE.findall(text.lower().replace('ё', 'е'))
+    return [word[:STEM_LENGTH] for word in words if len(word) > 1 and word not in STOP_WORDS]
+
+
+class BM25Index:
+    """
+    Инвертированный индекс с ранжированием Okapi BM25
+
+    Документы добавляются и удаляются по одному, поэтому индекс обновляется
+    вместе с RAG индексом без перестройки. Все методы потокобезопасны.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+        # термин -> {документ: частота}
+        self._postings: Dict[str, Dict[Hashable, int]] = {}
+        # документ -> частоты его терминов (нужны для удаления)
+        self._documents: Dict[Hashable, Counter] = {}
+        self._lengths: Dict[Hashable, int] = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def add(self, doc_id: Hashable, text: str):
+        """Добавление (или замена) документа"""
+        terms = Counter(tokenize(text))
+        with self._lock:
+            self._remove(doc_id)
+            self._documents[doc_id] = terms
+            length = sum(terms.values())
+            self._lengths[doc_id] = length
+            self._total_length += length
+            for term, count in terms.items():
+                self._postings.setdefault(term, {})[doc_id] = count
+
+    def remove(self, doc_id: Hashable):
+        """Удаление документа"""
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id: Hashable):
+        terms = self._documents.pop(doc_id, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(doc_id)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+
+    def clear(self):
+        with self._lock:
+            self._postings = {}
+            self._documents = {}
+            self._lengths = {}
+            self._total_length = 0
+
+    def search(self, query: str, top_k: int) -> List[Tuple[Hashable, float, float]]:
+        """
+        Поиск документов по словам запроса
+
+        Args:
+            query: Текст запроса
+            top_k: Количество результатов
+
+        Returns:
+            Список (документ, BM25, доля слов запроса в документе) по убыванию BM25
+        """
+        terms = set(tokenize(query))
+        if not terms or top_k <= 0:
+            return []
+
+        scores: Dict[Hashable, float] = {}
+        matched: Dict[Hashable, int] = {}
+        with self._lock:
+            n = len(self._documents)
+            if n == 0:
+                return []
+            avg_length = self._total_length / n
+
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, count in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+                    matched[doc_id] = matched.get(doc_id, 0) + 1
+
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+        return [(doc_id, score, matched[doc_id] / len(terms)) for doc_id, score in ranked]
+
+    def __len__(self) -> int:
+        return len(self._documents)
@@ -0,0 +1,246 @@
+"""
+Версионные миграции схемы SQLite
+
+Схема описана упорядоченным списком шагов MIGRATIONS. Номер примененного
+шага записывается в таблицу schema_version; при запуске бота
+(Database.init_database) выполняются только шаги с большим номером, каждый
+в своей транзакции. Запросы на запись схему не трогают - в них только DML.
+
+Новое изменение схемы - новый шаг в конце списка со следующим номером;
+уже выпущенные шаги не меняются.
+"""
+import logging
+import sqlite3
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _initial_schema(cursor: sqlite3.Cursor):
+    """Исходные таблицы: users, conversations, leads, admin_notifications"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations(timestamp)")
+
+    # Колонки, добавленные позже, - в шаге 2 (у старых баз таблица уже есть)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS leads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+
+            name TEXT,
+            email TEXT,
+            phone TEXT,
+            company TEXT,
+
+            team_size TEXT,
+            contracts_per_month TEXT,
+            pain_point TEXT,
+            budget TEXT,
+            urgency TEXT,
+            industry TEXT,
+
+            temperature TEXT DEFAULT 'cold',
+            status TEXT DEFAULT 'new',
+            notes TEXT,
+
+            lead_magnet_type TEXT,
+            lead_magnet_delivered BOOLEAN DEFAULT 0,
+
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_user_id ON leads(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_temperature ON leads(temperature)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_status ON leads(status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_created_at ON leads(created_at)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS admin_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER NOT NULL,
+            notification_type TEXT NOT NULL,
+            message TEXT,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            read_at TIMESTAMP,
+            FOREIGN KEY (lead_id) REFERENCES leads(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_lead_id ON admin_notifications(lead_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_sent_at ON admin_notifications(sent_at)")
+
+
+def _lead_columns(cursor: sqlite3.Cursor):
+    """Колонки лида, добавленные после первой версии (старые базы могли получить часть из них)"""
+    cursor.execute("PRAGMA table_info(leads)")
+    columns = {column[1] for column in cursor.fetchall()}
+    for name, ddl in (
+        ('service_category', "TEXT"),
+        ('specific_need', "TEXT"),
+        ('notification_sent', "BOOLEAN DEFAULT 0"),
+        ('last_message_at', "TIMESTAMP"),
+    ):
+        if name not in columns:
+            cursor.execute(f"ALTER TABLE leads ADD COLUMN {name} {ddl}")
+
+
+def _chat_states(cursor: sqlite3.Cursor):
+    """Включение/отключение бота по чатам"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_states (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE NOT NULL,
+            is_enabled BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_states_chat_id ON chat_states(chat_id)")
+
+
+def _embedding_cache(cursor: sqlite3.Cursor):
+    """Эмбеддинги для RAG, ключ - хэш текста + модели"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            content_hash TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _lead_extraction_state(cursor: sqlite3.Cursor):
+    """Последнее извлечение данных лида по диалогу"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lead_extraction_state (
+            user_id INTEGER PRIMARY KEY,
+            lead_data TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            incremental_runs INTEGER DEFAULT 0,
+            prompt_tokens INTEGER DEFAULT 0,
+            full_prompt_tokens INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+
+
+def _conversation_summaries(cursor: sqlite3.Cursor):
+    """Краткое содержание ранней части диалога"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+
+
+def _token_usage(cursor: sqlite3.Cursor):
+    """Расход токенов OpenAI по пользователю и дню (user_id 0 - системные запросы)"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS token_usage (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            requests INTEGER DEFAULT 0,
+            prompt_tokens INTEGER DEFAULT 0,
+            completion_tokens INTEGER DEFAULT 0,
+            cached_tokens INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
+    """)
+
+
+# (версия, название, шаг) - строго по возрастанию версии.
+# Шаги написаны через IF NOT EXISTS: базы, созданные до появления
+# schema_version, проходят их без ошибок и получают недостающее.
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Cursor], None]]] = [
+    (1, 'initial_schema', _initial_schema),
+    (2, 'lead_columns', _lead_columns),
+    (3, 'chat_states', _chat_states),
+    (4, 'embedding_cache', _embedding_cache),
+    (5, 'lead_extraction_state', _lead_extraction_state),
+    (6, 'conversation_summaries', _conversation_summaries),
+    (7, 'token_usage', _token_usage),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Номер последнего примененного шага (0 - новая база)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """
+    Применение недостающих шагов схемы
+
+    Каждый шаг выполняется в транзакции BEGIN IMMEDIATE вместе с записью в
+    schema_version, так что параллельно запущенный процесс не применит его
+    второй раз, а упавший шаг не оставит схему наполовину измененной.
+
+    Returns:
+        Количество примененных шагов
+    """
+    current = get_schema_version(conn)
+    conn.commit()
+    if current >= LATEST_VERSION:
+        return 0
+
+    applied = 0
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой процесс мог применить шаг, пока мы ждали блокировку
+            cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cursor.fetchone() is None:
+                step(cursor)
+                cursor.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+                applied += 1
+                logger.info(f"Schema migration {version} ({name}) applied")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return applied
@@ -0,0 +1,274 @@
+"""
+Таймауты, повторы и автомат-предохранитель для запросов к OpenAI
+
+Все запросы AIBrain и KnowledgeEngine идут через openai_guard:
+- у каждого вызова общий срок (повторы в него укладываются);
+- 429, 5xx, таймауты и обрывы соединения повторяются с экспоненциальной
+  задержкой со случайным разбросом, Retry-After от сервера важнее расчетной;
+- после OPENAI_BREAKER_THRESHOLD таких ошибок подряд предохранитель
+  размыкается: запросы сразу падают с CircuitOpenError, необязательная работа
+  (эмбеддинги RAG, извлечение лида, краткое содержание) пропускается. Через
+  OPENAI_BREAKER_RESET секунд пропускается один пробный запрос - успех
+  замыкает предохранитель, ошибка снова размыкает.
+
+Встроенные повторы клиентов OpenAI отключены (max_retries=0), чтобы не
+умножать их на повторы этого модуля.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import openai
+
+from config import Config
+config = Config()
+
+logger = logging.getLogger(__name__)
+
+# Статусы, после которых запрос имеет смысл повторить (кроме 5xx)
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут - OpenAI недоступен, запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open после серии ошибок -> half_open (пробный запрос) -> closed"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = failure_threshold or config.OPENAI_BREAKER_THRESHOLD
+        self.reset_timeout = config.OPENAI_BREAKER_RESET if reset_timeout is None else reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+        self.times_opened = 0
+        self.last_error = ""
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос (в half_open - только один пробный)"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("OpenAI circuit breaker closed")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self, error: str = ""):
+        with self._lock:
+            self._failures += 1
+            self.last_error = error
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.times_opened += 1
+                    logger.error(f"OpenAI circuit breaker opened after {self._failures} failures: {error}")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def release_probe(self):
+        """Пробный запрос завершился без вывода о здоровье OpenAI (например, 400)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+
+class OpenAIGuard:
+    """Общая обертка запросов к OpenAI: срок, повторы и предохранитель"""
+
+    def __init__(
+        self,
+        timeout: float = None,
+        max_retries: int = None,
+        backoff_base: float = None,
+        backoff_max: float = None,
+        breaker: CircuitBreaker = None
+    ):
+        self.timeout = timeout or config.OPENAI_TIMEOUT
+        self.max_retries = config.OPENAI_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = config.OPENAI_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = config.OPENAI_BACKOFF_MAX if backoff_max is None else backoff_max
+        self.breaker = breaker or CircuitBreaker()
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.fast_failed = 0
+
+    def is_available(self) -> bool:
+        """OpenAI считается доступным (по нему стоит запускать необязательную работу)"""
+        return self.breaker.state == CircuitBreaker.CLOSED
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError, TimeoutError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+        return False
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Задержка перед повтором: Retry-After сервера или экспоненциальная со случайным разбросом"""
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+            value = headers.get(header)
+            if value is None:
+                continue
+            try:
+                return max(0.0, float(value) * scale)
+            except ValueError:
+                continue  # HTTP-дата - считаем задержку сами
+        cap = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(cap / 2, cap)
+
+    def _next_delay(self, error: Exception, attempt: int, deadline: float) -> Optional[float]:
+        """
+        Учет ошибки попытки
+
+        Returns:
+            Задержка перед следующей попыткой или None, если повторять нельзя
+        """
+        if not self._is_retryable(error):
+            self.breaker.release_probe()
+            return None
+
+        self.breaker.record_failure(f"{type(error).__name__}: {error}")
+        if attempt >= self.max_retries:
+            return None
+        delay = self._retry_delay(error, attempt)
+        if time.monotonic() + delay >= deadline:
+            return None
+        self.retries += 1
+        logger.warning(f"OpenAI request failed ({type(error).__name__}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def _acquire(self):
+        if not self.breaker.allow():
+            self.fast_failed += 1
+            raise CircuitOpenError("OpenAI circuit breaker is open")
+
+    async def call_async(self, fn: Callable, *args, timeout: float = None, **kwargs) -> Any:
+        """
+        Вызов асинхронного метода клиента OpenAI
+
+        Args:
+            fn: Метод клиента (например async_client.chat.completions.create)
+            timeout: Общий срок вызова с повторами (по умолчанию OPENAI_TIMEOUT)
+
+        Срок ограничивает только сам вызов fn: при stream=True это открытие
+        потока, срок до первого токена соблюдает вызывающий (AIBrain._open_stream).
+
+        Raises:
+            CircuitOpenError: Предохранитель разомкнут
+        """
+        self.calls += 1
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            self._acquire()
+            remaining = deadline - time.monotonic()
+            try:
+                result = await asyncio.wait_for(fn(*args, timeout=remaining, **kwargs), remaining)
+            except Exception as e:
+                delay = self._next_delay(e, attempt, deadline)
+                if delay is None:
+                    self.failures += 1
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Отмена (CancelledError - не Exception): о здоровье OpenAI ничего не известно,
+                # пробный запрос освобождается, иначе предохранитель навсегда останется в half_open
+                self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def call(self, fn: Callable, *args, timeout: float = None, **kwargs) -> Any:
+        """Вызов синхронного метода клиента OpenAI (скрипты, поиск RAG в потоке) - как call_async"""
+        self.calls += 1
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                result = fn(*args, timeout=deadline - time.monotonic(), **kwargs)
+            except Exception as e:
+                delay = self._next_delay(e, attempt, deadline)
+                if delay is None:
+                    self.failures += 1
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def get_stats(self) -> Dict:
+        return {
+            'state': self.breaker.state,
+            'times_opened': self.breaker.times_opened,
+            'last_error': self.breaker.last_error,
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+            'fast_failed': self.fast_failed,
+        }
+
+    def format_stats(self) -> str:
+        """Состояние предохранителя OpenAI для админ-панели"""
+        stats = self.get_stats()
+        titles = {
+            CircuitBreaker.CLOSED: '🟢 работает',
+            CircuitBreaker.OPEN: '🔴 отключен (запросы не отправляются)',
+            CircuitBreaker.HALF_OPEN: '🟡 пробный запрос',
+        }
+        lines = [
+            f"🔌 OpenAI: {titles[stats['state']]}",
+            f"Запросов: {stats['calls']}, повторов: {stats['retries']}, ошибок: {stats['failures']}, "
+            f"отклонено предохранителем: {stats['fast_failed']}",
+            f"Размыканий: {stats['times_opened']}",
+        ]
+        if stats['last_error']:
+            lines.append(f"Последняя ошибка: {stats['last_error'][:200]}")
+        return "\n".join(lines)
+
+
+# Глобальный экземпляр
+openai_guard = OpenAIGuard()
@@ -372,6 +372,27 @@ COLD (холодный лид):
 
 Верни ТОЛЬКО валидный JSON без markdown, без дополнительного текста."""
 
+# Инструкция для инкрементального извлечения (второе системное сообщение
+# после EXTRACT_DATA_PROMPT - начало запроса общее с полным извлечением)
+EXTRACT_DATA_INCREMENTAL_PROMPT = """🔄 ОБНОВИ ДАННЫЕ ЛИДА:
+Ниже - данные, уже извлеченные из начала диалога, и только НОВЫЕ сообщения.
+- Поля, о которых в новых сообщениях ничего нет, оставь как в ранее извлеченных данных
+- Поле меняй только если клиент ЯВНО сообщил новое или уточнил старое
+- lead_temperature определи по всей известной информации (старые данные + новые сообщения)
+
+Верни ПОЛНЫЙ JSON в том же формате."""
+
+# Промпт для краткого содержания ранней части диалога
+SUMMARY_PROMPT = """Составь краткое содержание диалога юридической компании с клиентом.
+Оно заменит ранние сообщения в контексте консультанта, поэтому сохрани всё, что нужно для продолжения разговора:
+- кто клиент (имя, компания, отрасль, размер команды) - только то, что он сказал сам
+- задача и боль клиента, упомянутые цифры, сроки, бюджет
+- какие услуги и решения уже обсуждали, что предложили, о чем договорились
+- вопросы клиента, на которые еще нет ответа
+
+Если передано предыдущее краткое содержание - дополни его новыми сообщениями, ничего важного не теряя.
+Пиши сжато, по пунктам, без вступлений. Не додумывай."""
+
 # Промпт для определения готовности лида к уведомлению
 CHECK_LEAD_READINESS_PROMPT = """Проанализируй диалог и определи - готов ли лид к отправке уведомления админу?
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Прогон записанных диалогов через lead_rules: сколько извлечений лида обходятся без LLM
+
+Запуск:
+    python replay_lead_rules.py --db data/bot.db
+    python replay_lead_rules.py --jsonl conversations.jsonl
+
+Извлечение запускается после каждого ответа бота (как в обработчиках), в
+разбор идут сообщения с прошлого извлечения. Первое извлечение диалога
+всегда идет в LLM. В JSONL одна строка - один диалог:
+{"messages": [{"role": "user", "message": "..."}, ...]}
+"""
+import argparse
+import json
+import sqlite3
+from collections import Counter
+from typing import Dict, Iterable, List
+
+from config import Config
+from lead_rules import pre_extract
+
+
+def load_from_db(db_path: str) -> Iterable[List[Dict]]:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        user_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM conversations")]
+        for user_id in user_ids:
+            rows = conn.execute(
+                "SELECT role, message FROM conversations WHERE user_id = ? ORDER BY timestamp, id",
+                (user_id,)
+            )
+            yield [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def load_from_jsonl(path: str) -> Iterable[List[Dict]]:
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)['messages']
+
+
+def replay(conversation: List[Dict], totals: Counter, filled: Counter):
+    """Извлечения по одному диалогу: после каждого ответа бота и в конце"""
+    pending = []
+    has_state = False
+    for msg in conversation + [None]:
+        if msg is not None:
+            pending.append(msg)
+            if msg['role'] != 'assistant':
+                continue
+        if not any(m['role'] == 'user' for m in pending):
+            continue
+
+        needs_llm, fields = pre_extract(pending)
+        totals['extractions'] += 1
+        if has_state and not needs_llm:
+            totals['skipped'] += 1
+        filled.update(fields.keys())
+        has_state = True
+        pending = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=Config().DB_PATH, help="SQLite база бота")
+    parser.add_argument("--jsonl", help="Диалоги в JSONL (вместо базы)")
+    args = parser.parse_args()
+
+    conversations = load_from_jsonl(args.jsonl) if args.jsonl else load_from_db(args.db)
+
+    totals = Counter()
+    filled = Counter()
+    for conversation in conversations:
+        totals['conversations'] += 1
+        replay(conversation, totals, filled)
+
+    if not totals['extractions']:
+        print("No conversations to replay")
+        return
+
+    print(f"conversations={totals['conversations']}, extractions={totals['extractions']}")
+    print(f"skipped without LLM: {totals['skipped']} ({totals['skipped'] / totals['extractions']:.1%})")
+    for field, count in filled.most_common():
+        print(f"  filled by rules: {field:<20} {count}")
+
+
+if __name__ == '__main__':
+    main()
@@ -49,8 +49,9 @@ class SecurityManager:
         self.MAX_MESSAGE_LENGTH = 4000  # Макс длина сообщения (увеличено с 2000 до 4000)
 
         self.TOTAL_DAILY_BUDGET = 100000  # Общий дневной бюджет токенов для всех
+        # Точный расход по usage ответов OpenAI передает usage_tracker
         self.total_tokens_today = 0
-        self.budget_reset_time = datetime.now() + timedelta(days=1)
+        self.budget_reset_time = self._next_midnight()
 
         logger.info("Security Manager initialized")
 
@@ -129,10 +130,10 @@ class SecurityManager:
         """Проверка общего дневного бюджета"""
         now = datetime.now()
 
-        # Сброс счетчика в полночь
+        # Сброс счетчика в полночь (как и дни в таблице token_usage)
         if now > self.budget_reset_time:
             self.total_tokens_today = 0
-            self.budget_reset_time = now + timedelta(days=1)
+            self.budget_reset_time = self._next_midnight()
             logger.info("Daily token budget reset")
 
         if self.total_tokens_today + estimated_tokens > self.TOTAL_DAILY_BUDGET:
@@ -141,6 +142,10 @@ class SecurityManager:
 
         return True, None
 
+    @staticmethod
+    def _next_midnight() -> datetime:
+        return datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+
     def estimate_tokens(self, text: str) -> int:
         """
         Оценка количества токенов в тексте
@@ -0,0 +1,20 @@
+"""
+Общая настройка тестов: окружение без .env, рабочие файлы бота - во временном каталоге
+
+Модули создают глобальные экземпляры (Config, Database) при импорте, поэтому
+переменные окружения задаются здесь, до импорта тестов.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+_data_dir = tempfile.mkdtemp(prefix="bot-tests-")
+atexit.register(shutil.rmtree, _data_dir, ignore_errors=True)
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:ABC-test')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ.setdefault('ADMIN_TELEGRAM_ID', '1')
+# Глобальная БД и индекс RAG тестового процесса не должны попадать в data/ репозитория
+os.environ['DB_PATH'] = os.path.join(_data_dir, 'bot.db')
+os.environ['RAG_INDEX_PATH'] = os.path.join(_data_dir, 'rag_index')
@@ -0,0 +1,289 @@
+"""
+Тесты для ai_brain.py - асинхронный путь запросов к OpenAI
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from ai_brain import AIBrain
+
+
+class FakeStream:
+    """Поток чанков с задержкой перед первым токеном"""
+
+    def __init__(self, delay: float, parts):
+        self.delay = delay
+        self.parts = parts
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await asyncio.sleep(self.delay)
+        for i, part in enumerate(self.parts):
+            finish_reason = "stop" if i == len(self.parts) - 1 else None
+            delta = SimpleNamespace(content=part)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+        # При stream_options include_usage последний чанк - только usage
+        yield SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=1200, completion_tokens=5))
+
+
+class FakeCompletions:
+    """Подмена async_client.chat.completions"""
+
+    def __init__(self, delay: float = 0.2, content: str = "{}"):
+        self.delay = delay
+        self.content = content
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def create(self, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if kwargs.get("stream"):
+                return FakeStream(self.delay, ["Здравствуйте", "!"])
+            await asyncio.sleep(self.delay)
+            message = SimpleNamespace(content=self.content)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")])
+        finally:
+            self.in_flight -= 1
+
+
+def make_brain(completions: FakeCompletions, limit: int = 20) -> AIBrain:
+    brain = AIBrain()
+    brain.async_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    brain.request_semaphore = asyncio.Semaphore(limit)
+    return brain
+
+
+async def collect(brain: AIBrain, history, rag_task=None) -> str:
+    return "".join([part async for part in brain.generate_response_stream(history, rag_task)])
+
+
+@pytest.mark.asyncio
+async def test_streams_overlap():
+    """Параллельные диалоги ждут сеть одновременно, а не по очереди"""
+    brain = make_brain(FakeCompletions(delay=0.2))
+    history = [{"role": "user", "message": "Привет"}]
+
+    started = time.perf_counter()
+    replies = await asyncio.gather(*[collect(brain, history) for _ in range(10)])
+    elapsed = time.perf_counter() - started
+
+    assert replies == ["Здравствуйте!"] * 10
+    assert elapsed < 1.0, f"Потоки выполнялись последовательно: {elapsed:.2f}s"
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit():
+    """Семафор ограничивает число одновременных запросов"""
+    completions = FakeCompletions(delay=0.05)
+    brain = make_brain(completions, limit=3)
+    history = [{"role": "user", "message": "Привет"}]
+
+    await asyncio.gather(*[brain.generate_response_async(history) for _ in range(10)])
+
+    assert completions.max_in_flight <= 3
+
+
+@pytest.mark.asyncio
+async def test_extract_lead_data_async():
+    """Извлечение данных лида через асинхронный клиент"""
+    payload = {"name": "Иван", "lead_temperature": "warm"}
+    brain = make_brain(FakeCompletions(delay=0, content=f"```json\n{json.dumps(payload)}\n```"))
+
+    lead_data = await brain.extract_lead_data_async([{"role": "user", "message": "Меня зовут Иван"}])
+
+    assert lead_data == payload
+
+
+@pytest.mark.asyncio
+async def test_stream_uses_rag_within_deadline(monkeypatch):
+    """Быстрый поиск RAG попадает в промпт потокового ответа"""
+    completions = FakeCompletions(delay=0)
+    sent = []
+    original_create = completions.create
+
+    async def create(**kwargs):
+        sent.append(kwargs["messages"])
+        return await original_create(**kwargs)
+
+    completions.create = create
+    brain = make_brain(completions)
+    monkeypatch.setattr(brain, "_search_rag_context", lambda query: "ПРИМЕРЫ")
+
+    rag_task = brain.start_rag_search("Интересует автоматизация договоров", deadline=1.0)
+    reply = await collect(brain, [{"role": "user", "message": "Привет"}], rag_task)
+
+    assert reply == "Здравствуйте!"
+    assert {"role": "system", "content": "ПРИМЕРЫ"} in sent[0]
+    assert brain.get_stream_stats()["rag"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_skips_slow_rag(monkeypatch):
+    """Медленный поиск RAG не задерживает ответ дольше срока"""
+    brain = make_brain(FakeCompletions(delay=0))
+
+    def slow_search(query):
+        time.sleep(0.5)
+        return "ПРИМЕРЫ"
+
+    monkeypatch.setattr(brain, "_search_rag_context", slow_search)
+
+    started = time.perf_counter()
+    rag_task = brain.start_rag_search("Интересует автоматизация договоров", deadline=0.05)
+    reply = await collect(brain, [{"role": "user", "message": "Привет"}], rag_task)
+    elapsed = time.perf_counter() - started
+
+    assert reply == "Здравствуйте!"
+    assert elapsed < 0.4
+    stats = brain.get_stream_stats()
+    assert stats["rag_deadline_misses"] == 1
+    assert stats["no_rag"]["count"] == 1
+    assert stats["rag"]["count"] == 0
+
+
+def test_extraction_prefix_shared():
+    """Полное и инкрементальное извлечение начинаются с одного и того же системного промпта"""
+    brain = make_brain(FakeCompletions(delay=0))
+    history = [{"role": "user", "message": "Меня зовут Иван"}]
+
+    full = brain._build_extraction_messages(history)
+    incremental = brain._build_extraction_messages(history, {"name": "Иван"})
+
+    assert full[0] == incremental[0]
+    assert full[-1]["role"] == incremental[-1]["role"] == "user"
+    assert "Иван" not in full[0]["content"] + incremental[1]["content"]
+
+
+@pytest.mark.asyncio
+async def test_records_cached_tokens():
+    """Закэшированные токены из usage учитываются по типам запросов"""
+    completions = FakeCompletions(delay=0, content='{"name": "Иван"}')
+    original_create = completions.create
+
+    async def create(**kwargs):
+        response = await original_create(**kwargs)
+        response.usage = SimpleNamespace(
+            prompt_tokens=2000, prompt_tokens_details=SimpleNamespace(cached_tokens=1536)
+        )
+        return response
+
+    completions.create = create
+    brain = make_brain(completions)
+
+    await brain.extract_lead_data_async([{"role": "user", "message": "Меня зовут Иван"}])
+    await brain.extract_lead_data_async([{"role": "user", "message": "Меня зовут Иван"}])
+
+    stats = brain.get_prompt_cache_stats()["extraction"]
+    assert stats["requests"] == 2
+    assert stats["cached_tokens"] == 3072
+    assert stats["hit_rate"] == pytest.approx(0.768)
+
+
+@pytest.mark.asyncio
+async def test_stream_records_usage():
+    """usage последнего чанка потокового ответа учитывается"""
+    brain = make_brain(FakeCompletions(delay=0))
+
+    reply = await collect(brain, [{"role": "user", "message": "Привет"}])
+
+    assert reply == "Здравствуйте!"
+    assert brain.get_prompt_cache_stats()["chat"]["prompt_tokens"] == 1200
+
+
+class SequencedCompletions:
+    """Потоковые ответы с разной задержкой первого токена для каждого запроса"""
+
+    def __init__(self, delays, parts_per_request):
+        self.delays = list(delays)
+        self.parts = list(parts_per_request)
+        self.closed = 0
+
+    async def create(self, **kwargs):
+        stream = FakeStream(self.delays.pop(0), self.parts.pop(0))
+        completions = self
+
+        async def close():
+            completions.closed += 1
+
+        stream.close = close
+        return stream
+
+
+@pytest.mark.asyncio
+async def test_hedge_wins_on_slow_first_token(monkeypatch):
+    """Медленный первый токен - дублирующий запрос отвечает, исходный отменяется"""
+    monkeypatch.setattr("ai_brain.config.OPENAI_HEDGE_ENABLED", True)
+    monkeypatch.setattr("ai_brain.config.OPENAI_HEDGE_DELAY", 0.05)
+    completions = SequencedCompletions([1.0, 0], [["медленно"], ["быстро"]])
+    brain = make_brain(completions)
+
+    started = time.perf_counter()
+    reply = await collect(brain, [{"role": "user", "message": "Привет"}])
+
+    assert reply == "быстро"
+    assert time.perf_counter() - started < 0.5
+    stats = brain.get_stream_stats()
+    assert stats["hedges_fired"] == 1
+    assert stats["hedges_won"] == 1
+    # Отмененный поток закрывается в фоне, не задерживая ответ
+    await asyncio.sleep(0.01)
+    assert completions.closed == 2
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_when_fast(monkeypatch):
+    """Первый токен до задержки дублирования - второй запрос не отправляется"""
+    monkeypatch.setattr("ai_brain.config.OPENAI_HEDGE_ENABLED", True)
+    monkeypatch.setattr("ai_brain.config.OPENAI_HEDGE_DELAY", 0.2)
+    completions = SequencedCompletions([0], [["Здравствуйте", "!"]])
+    brain = make_brain(completions)
+
+    reply = await collect(brain, [{"role": "user", "message": "Привет"}])
+
+    assert reply == "Здравствуйте!"
+    assert brain.get_stream_stats()["hedges_fired"] == 0
+    assert brain.get_stream_stats()["first_token"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_first_token_deadline(monkeypatch):
+    """Поток открылся, но текста нет дольше OPENAI_TIMEOUT - запрос обрывается, клиент получает ошибку"""
+    monkeypatch.setattr("ai_brain.config.OPENAI_TIMEOUT", 0.1)
+    brain = make_brain(FakeCompletions(delay=5))
+
+    started = time.perf_counter()
+    reply = await collect(brain, [{"role": "user", "message": "Привет"}])
+
+    assert time.perf_counter() - started < 1
+    assert reply.startswith("Извините, произошла ошибка")
+
+
+@pytest.mark.asyncio
+async def test_async_response_usage_per_user(monkeypatch):
+    """Токены generate_response_async учитываются на пользователя, переданного в вызов"""
+    import usage_tracker
+
+    tracker = usage_tracker.UsageTracker(flush_interval=60)
+    monkeypatch.setattr(usage_tracker, "usage_tracker", tracker)
+    completions = FakeCompletions(delay=0, content="Здравствуйте!")
+    original_create = completions.create
+
+    async def create(**kwargs):
+        response = await original_create(**kwargs)
+        response.usage = SimpleNamespace(prompt_tokens=900, completion_tokens=20, prompt_tokens_details=None)
+        return response
+
+    completions.create = create
+    brain = make_brain(completions)
+
+    reply = await brain.generate_response_async([{"role": "user", "message": "Привет"}], user_id=7)
+
+    assert reply == "Здравствуйте!"
+    assert [user_id for user_id, _ in tracker._pending] == [7]
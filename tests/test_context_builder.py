@@ -0,0 +1,78 @@
+"""
+Тесты для context_builder.py - упаковка контекста в бюджет токенов
+"""
+from context_builder import ContextBuilder, TRUNCATION_MARK
+
+
+def make_builder(max_input_tokens: int) -> ContextBuilder:
+    builder = ContextBuilder(max_input_tokens=max_input_tokens)
+    # Детерминированная оценка независимо от наличия tiktoken
+    builder._encoding = None
+    return builder
+
+
+def history(count: int, text: str = "Сообщение клиента про договоры поставки") -> list:
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "message": f"{i}: {text}"}
+        for i in range(count)
+    ]
+
+
+def test_everything_fits():
+    """В большой бюджет попадает все, порядок сохраняется"""
+    builder = make_builder(10000)
+    messages = builder.build("Системный промпт", history(5), rag_context="Примеры")
+
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user", "assistant", "system", "user"]
+    assert messages[1]["content"].startswith("0:")
+    assert messages[-2]["content"] == "Примеры"
+    assert messages[-1]["content"].startswith("4:")
+
+
+def test_budget_drops_oldest_turns():
+    """Старые реплики отбрасываются, итог не превышает бюджет"""
+    builder = make_builder(150)
+    messages = builder.build("Системный промпт", history(30))
+
+    assert builder.count_message_tokens(messages) <= 150
+    assert messages[-1]["content"].startswith("29:")
+    assert len(messages) < 31
+
+
+def test_rag_skipped_when_not_fits():
+    """Длинный блок RAG не вытесняет последнее сообщение клиента"""
+    builder = make_builder(120)
+    messages = builder.build("Системный промпт", history(1), rag_context="пример " * 200)
+
+    assert all(m["content"] != "пример " * 200 for m in messages)
+    assert messages[-1]["content"].startswith("0:")
+
+
+def test_long_last_message_truncated():
+    """Огромное сообщение клиента обрезается до бюджета, конец сохраняется"""
+    builder = make_builder(300)
+    text = "начало " + "очень длинный текст " * 500 + "конец"
+    messages = builder.build("Системный промпт", [{"role": "user", "message": text}])
+
+    assert builder.count_message_tokens(messages) <= 300
+    assert messages[-1]["content"].startswith(TRUNCATION_MARK)
+    assert messages[-1]["content"].endswith("конец")
+
+
+def test_summary_before_turns():
+    """Краткое содержание идет сразу после системного промпта, RAG - перед последним сообщением"""
+    builder = make_builder(10000)
+    messages = builder.build("Системный промпт", history(2), rag_context="Примеры", summary="Клиент Иван")
+
+    assert messages[1]["content"].endswith("Клиент Иван")
+    assert messages[2]["content"].startswith("0:")
+    assert messages[3]["content"] == "Примеры"
+
+
+def test_prefix_stable_across_requests():
+    """Следующий запрос начинается с тех же сообщений - префикс кэшируется провайдером"""
+    builder = make_builder(10000)
+    first = builder.build("Системный промпт", history(3), rag_context="Примеры 1")
+    second = builder.build("Системный промпт", history(5), rag_context="Примеры 2")
+
+    assert second[:3] == first[:3]
@@ -0,0 +1,75 @@
+"""
+Тесты для conversation_summary.py - краткое содержание длинных диалогов
+"""
+import pytest
+
+import conversation_summary
+from conversation_summary import ConversationSummarizer
+from database import Database
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    monkeypatch.setattr(conversation_summary.database, "db", db)
+    return db
+
+
+@pytest.fixture
+def summarize_calls(monkeypatch):
+    calls = []
+
+    async def fake_summarize(previous_summary, messages, user_id=None):
+        calls.append((previous_summary, [msg['message'] for msg in messages]))
+        return f"содержание до: {messages[-1]['message']}"
+
+    monkeypatch.setattr(conversation_summary.ai_brain.ai_brain, "summarize_conversation_async", fake_summarize)
+    return calls
+
+
+def add_turns(db: Database, user_id: int, start: int, count: int):
+    for i in range(start, start + count):
+        db.add_message(user_id, 'user' if i % 2 == 0 else 'assistant', f"сообщение {i}")
+
+
+@pytest.mark.asyncio
+async def test_summary_refresh_and_context(db, summarize_calls):
+    """Содержание обновляется каждые N сообщений, в запрос идут только сообщения после него"""
+    user_id = db.create_or_update_user(telegram_id=1, first_name="Иван")
+    summarizer = ConversationSummarizer(every=4, recent=2)
+
+    add_turns(db, user_id, 0, 5)
+    summarizer.schedule_refresh(user_id)
+    await summarizer.drain()
+    assert summarize_calls == []
+
+    add_turns(db, user_id, 5, 1)
+    summarizer.schedule_refresh(user_id)
+    await summarizer.drain()
+    assert summarize_calls == [("", ["сообщение 0", "сообщение 1", "сообщение 2", "сообщение 3"])]
+
+    summary, recent = summarizer.get_context(user_id, db.get_conversation_history(user_id))
+    assert summary == "содержание до: сообщение 3"
+    assert [msg['message'] for msg in recent] == ["сообщение 4", "сообщение 5"]
+
+    add_turns(db, user_id, 6, 4)
+    summarizer.schedule_refresh(user_id)
+    await summarizer.drain()
+    assert summarize_calls[1] == ("содержание до: сообщение 3", ["сообщение 4", "сообщение 5", "сообщение 6", "сообщение 7"])
+
+
+@pytest.mark.asyncio
+async def test_no_summary_keeps_history(db, summarize_calls):
+    """Без содержания история передается как есть, очистка диалога удаляет содержание"""
+    user_id = db.create_or_update_user(telegram_id=1, first_name="Иван")
+    summarizer = ConversationSummarizer(every=2, recent=1)
+
+    add_turns(db, user_id, 0, 3)
+    history = db.get_conversation_history(user_id)
+    assert summarizer.get_context(user_id, history) == ("", history)
+
+    summarizer.schedule_refresh(user_id)
+    await summarizer.drain()
+    db.clear_conversation_history(user_id)
+
+    assert db.get_conversation_summary(user_id) is None
@@ -19,6 +19,7 @@ def test_db():
 
     yield db
 
+    db.close()
     # Удаляем временный файл после теста
     if os.path.exists(db_path):
         os.unlink(db_path)
@@ -121,3 +122,236 @@ def test_get_statistics(test_db):
     assert stats is not None, "Статистика не получена"
     assert stats['total_users'] >= 1, "Количество пользователей некорректно"
     assert stats['total_messages'] >= 1, "Количество сообщений некорректно"
+
+
+def test_connection_pool_reuses_connections(test_db):
+    """Подключения переиспользуются, в пуле включен WAL"""
+    for telegram_id in range(20):
+        user_id = test_db.create_or_update_user(telegram_id=telegram_id, first_name="Test")
+        test_db.add_message(user_id, 'user', 'Test message')
+        test_db.get_conversation_history(user_id)
+
+    assert test_db._pool.opened == 1
+
+    conn = test_db.get_connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    conn.close()
+
+
+def test_pool_rolls_back_uncommitted(test_db):
+    """Незакоммиченные изменения не переходят к следующему пользователю подключения"""
+    conn = test_db.get_connection()
+    conn.execute("INSERT INTO users (telegram_id, first_name) VALUES (1, 'Uncommitted')")
+    conn.close()
+
+    assert test_db.get_user_by_telegram_id(1) is None
+
+
+def test_migrations_recorded_and_idempotent(test_db):
+    """Все шаги схемы записаны в schema_version, повторный запуск ничего не применяет"""
+    import migrations
+
+    conn = test_db.get_connection()
+    versions = [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    assert versions == [version for version, _, _ in migrations.MIGRATIONS]
+    assert migrations.apply_migrations(conn) == 0
+    conn.close()
+
+
+def test_migrations_upgrade_legacy_database():
+    """База без schema_version и новых колонок лида получает их при запуске"""
+    import sqlite3
+    import migrations
+
+    fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    conn = sqlite3.connect(db_path)
+    migrations._initial_schema(conn.cursor())
+    conn.execute("ALTER TABLE leads ADD COLUMN notification_sent BOOLEAN DEFAULT 0")
+    conn.commit()
+    conn.close()
+
+    db = Database(db_path)
+    try:
+        conn = db.get_connection()
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(leads)")}
+        conn.close()
+        assert {'service_category', 'specific_need', 'last_message_at'} <= columns
+
+        db.set_chat_enabled(42, False)
+        assert not db.is_chat_enabled(42)
+        assert db.get_disabled_chats() == [42]
+    finally:
+        db.close()
+        os.unlink(db_path)
+
+
+@pytest.mark.asyncio
+async def test_async_database_slow_query_does_not_block_messages(test_db):
+    """Медленный отчет в пуле читателей не задерживает обработку сообщений других пользователей"""
+    import asyncio
+    import time
+    from database import AsyncDatabase
+
+    adb = AsyncDatabase(test_db, readers=2)
+    user_id = await adb.create_or_update_user(telegram_id=1, first_name="Test")
+
+    def slow_report():
+        conn = test_db.get_connection()
+        try:
+            conn.create_function("pause", 1, lambda seconds: time.sleep(seconds) or 0)
+            return conn.execute("SELECT pause(0.5), COUNT(*) FROM conversations").fetchone()[1]
+        finally:
+            conn.close()
+
+    report = asyncio.create_task(adb.run_read(slow_report))
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    for i in range(5):
+        await adb.add_message(user_id, 'user', f"Сообщение {i}")
+        history = await adb.get_conversation_history(user_id)
+    elapsed = time.perf_counter() - started
+
+    assert not report.done()
+    assert len(history) == 5
+    assert elapsed < 0.25
+
+    await report
+    adb.close()
+
+
+@pytest.mark.asyncio
+async def test_message_journal_group_commit(test_db):
+    """Сообщения разных пользователей пишутся одной транзакцией, свои записи видны сразу"""
+    import asyncio
+    from database import AsyncDatabase
+
+    adb = AsyncDatabase(test_db)
+    adb.journal.delay = 0.05
+    user_ids = [await adb.create_or_update_user(telegram_id=i, first_name="Test") for i in range(10)]
+    await adb.create_or_update_lead(user_ids[0], {'name': 'Lead'})
+
+    for user_id in user_ids:
+        await adb.add_message(user_id, 'user', f"Сообщение {user_id}")
+    await adb.update_lead_last_message_time(user_ids[0])
+    assert adb.journal.written == 0
+
+    # Чтение своих записей отправляет журнал в БД, не дожидаясь таймера
+    history = await asyncio.wait_for(adb.get_conversation_history(user_ids[3]), 0.04)
+    assert [msg['message'] for msg in history] == [f"Сообщение {user_ids[3]}"]
+    assert adb.journal.batches == 1 and adb.journal.largest_batch == 10
+
+    lead = await adb.get_lead_by_user_id(user_ids[0])
+    assert lead['last_message_at'] is not None
+
+    # Запись после журнала выполняется после него: очистка не теряет порядок
+    await adb.add_message(user_ids[1], 'assistant', "Ответ")
+    await adb.clear_conversation_history(user_ids[1])
+    assert await adb.get_conversation_history(user_ids[1]) == []
+
+    await adb.add_message(user_ids[2], 'assistant', "Ответ")
+    await adb.drain()
+    assert len(test_db.get_conversation_history(user_ids[2])) == 2
+    adb.close()
+
+
+@pytest.mark.asyncio
+async def test_message_journal_retry_keeps_read_your_writes(test_db, monkeypatch):
+    """Неудачный пакет повторяется, чтение своих записей ждет его коммита, а не просыпается раньше"""
+    import sqlite3
+    from database import AsyncDatabase
+
+    adb = AsyncDatabase(test_db)
+    adb.journal.max_retries = 2
+    user_id = await adb.create_or_update_user(telegram_id=1, first_name="Test")
+
+    original = test_db.add_messages
+    failures = []
+
+    def flaky_add_messages(messages, touched_user_ids=()):
+        if len(failures) < 2:
+            failures.append(len(messages))
+            raise sqlite3.OperationalError("database is locked")
+        return original(messages, touched_user_ids)
+
+    monkeypatch.setattr(test_db, "add_messages", flaky_add_messages)
+
+    await adb.add_message(user_id, 'user', "Сообщение")
+    history = await adb.get_conversation_history(user_id)
+
+    assert failures == [1, 1]
+    assert [msg['message'] for msg in history] == ["Сообщение"]
+    assert adb.journal.written == 1 and adb.journal.dropped == 0
+    adb.close()
+
+
+@pytest.mark.asyncio
+async def test_message_journal_drops_after_retries(test_db, monkeypatch):
+    """Постоянная ошибка: пакет отбрасывается после повторов, ждущее чтение получает ошибку"""
+    import sqlite3
+    from database import AsyncDatabase
+
+    adb = AsyncDatabase(test_db)
+    adb.journal.max_retries = 1
+    user_id = await adb.create_or_update_user(telegram_id=1, first_name="Test")
+
+    def broken_add_messages(messages, touched_user_ids=()):
+        raise sqlite3.IntegrityError("constraint failed")
+
+    monkeypatch.setattr(test_db, "add_messages", broken_add_messages)
+
+    await adb.add_message(user_id, 'user', "Сообщение")
+    with pytest.raises(sqlite3.IntegrityError):
+        await adb.get_conversation_history(user_id)
+
+    assert adb.journal.dropped == 1
+    # Журнал не завис: следующие сообщения пишутся
+    monkeypatch.undo()
+    await adb.add_message(user_id, 'user', "Следующее")
+    assert [msg['message'] for msg in await adb.get_conversation_history(user_id)] == ["Следующее"]
+    adb.close()
+
+
+@pytest.mark.asyncio
+async def test_message_journal_retry_keeps_write_order(test_db, monkeypatch):
+    """Пакеты и запись, поставленные во время повтора, идут после повторенного пакета"""
+    import sqlite3
+    from database import AsyncDatabase
+
+    adb = AsyncDatabase(test_db)
+    user_id = await adb.create_or_update_user(telegram_id=1, first_name="Test")
+    other_id = await adb.create_or_update_user(telegram_id=2, first_name="Other")
+    await adb.get_conversation_history(user_id)  # окно пользователя в кэше
+
+    original = test_db.add_messages
+    failures = []
+
+    def fail_first(messages, touched_user_ids=()):
+        if not failures:
+            failures.append(len(messages))
+            raise sqlite3.OperationalError("database is locked")
+        return original(messages, touched_user_ids)
+
+    monkeypatch.setattr(test_db, "add_messages", fail_first)
+
+    # Первый пакет (его коммит падает): M1 и сообщение другого пользователя
+    await adb.add_message(user_id, 'user', "M1")
+    await adb.add_message(other_id, 'user', "Удалить")
+    adb.journal.flush()
+    # Во время паузы перед повтором: M2 отдельным пакетом и очистка истории другого пользователя
+    await adb.add_message(user_id, 'assistant', "M2")
+    adb.journal.flush()
+    await adb.clear_conversation_history(other_id)
+
+    history = await adb.get_conversation_history(user_id)
+    assert failures == [2]
+    assert [msg['message'] for msg in history] == ["M1", "M2"]
+    assert history[0]['id'] < history[1]['id']
+    assert await adb.get_conversation_history(other_id) == []
+
+    # Кэш совпадает с БД
+    test_db.history_cache.clear()
+    assert await adb.get_conversation_history(user_id) == history
+    assert await adb.get_conversation_history(other_id) == []
+    adb.close()
@@ -0,0 +1,151 @@
+"""
+Тесты для handlers - обработка сообщения целиком (Telegram и OpenAI подменены)
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import database
+from database import AsyncDatabase, Database
+from handlers import admin, business, callbacks
+
+
+class FakeBot:
+    """Бот Telegram: запоминает отправленные сообщения"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def send_chat_action(self, **kwargs):
+        pass
+
+    async def edit_message_text(self, **kwargs):
+        pass
+
+
+def business_update(telegram_id: int, text: str):
+    sender = SimpleNamespace(id=telegram_id, username="client", first_name="Иван", last_name=None)
+    message = SimpleNamespace(
+        from_user=sender, text=text, chat=SimpleNamespace(id=telegram_id), business_connection_id="bc-1"
+    )
+    return SimpleNamespace(business_message=message)
+
+
+@pytest.fixture
+def adb(monkeypatch, tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    adb = AsyncDatabase(db)
+    monkeypatch.setattr(database, "db", db)
+    monkeypatch.setattr(database, "adb", adb)
+    yield adb
+    adb.close()
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_business_message_end_to_end(adb, monkeypatch):
+    """Сообщение клиента: ответ модели отправлен, диалог сохранен, извлечение лида запущено для его ID"""
+    calls = {}
+
+    async def fake_stream(history, rag_task, summary, user_id=None):
+        calls['user_id'] = user_id
+        calls['rag'] = await rag_task
+        calls['history'] = [msg['message'] for msg in history]
+        yield "Здравствуйте! Расскажите о задаче."
+
+    monkeypatch.setattr(business.ai_brain.ai_brain, "_search_rag_context", lambda query: "ПРИМЕРЫ")
+    monkeypatch.setattr(business.ai_brain.ai_brain, "generate_response_stream", fake_stream)
+    monkeypatch.setattr(business.conversation_summary.conversation_summarizer, "schedule_refresh", lambda user_id: None)
+    monkeypatch.setattr(
+        business.lead_extraction.lead_extraction_queue, "submit",
+        lambda user_id, on_result: calls.setdefault('extraction_user', user_id)
+    )
+
+    bot = FakeBot()
+    await business.handle_business_message(business_update(555, "Нужна автоматизация договоров"), SimpleNamespace(bot=bot))
+
+    user = await adb.get_user_by_telegram_id(555)
+    assert calls['user_id'] == user['id']
+    assert calls['extraction_user'] == user['id']
+    assert calls['rag'] == "ПРИМЕРЫ"
+    assert calls['history'] == ["Нужна автоматизация договоров"]
+    assert bot.sent[0] == "Здравствуйте! Расскажите о задаче."
+    assert not any("ошибка" in text.lower() for text in bot.sent)
+
+    history = await adb.get_conversation_history(user['id'])
+    assert [(msg['role'], msg['message']) for msg in history] == [
+        ('user', "Нужна автоматизация договоров"),
+        ('assistant', "Здравствуйте! Расскажите о задаче."),
+    ]
+
+
+class FakeMessage:
+    """Сообщение/сообщение callback: запоминает ответы"""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("telegram_id, rebuilt", [(42, True), (7, False)])
+async def test_rebuild_rag_admin_only(monkeypatch, telegram_id, rebuilt):
+    """/rebuild_rag и кнопка админ-панели перестраивают индекс только для админа"""
+    calls = []
+    monkeypatch.setattr(admin.config, "ADMIN_TELEGRAM_ID", 42)
+    monkeypatch.setattr(callbacks.config, "ADMIN_TELEGRAM_ID", 42)
+    monkeypatch.setattr(admin.knowledge_engine.knowledge_engine, "rebuild_index", lambda: calls.append(1) or 3)
+
+    message = FakeMessage()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=telegram_id), message=message)
+    await admin.rebuild_rag_command(update, SimpleNamespace())
+
+    async def answer():
+        pass
+
+    panel_message = FakeMessage()
+    query = SimpleNamespace(
+        data="admin_rebuild_rag", from_user=SimpleNamespace(id=telegram_id), message=panel_message, answer=answer
+    )
+    await callbacks.handle_admin_panel_callback(SimpleNamespace(callback_query=query), SimpleNamespace())
+
+    assert len(calls) == (2 if rebuilt else 0)
+    if rebuilt:
+        assert message.replies[-1] == panel_message.replies[-1] == "✅ Индекс базы знаний перестроен: 3 диалогов"
+    else:
+        assert message.replies == ["У вас нет доступа к этой команде"]
+        assert panel_message.replies == ["У вас нет доступа к этой функции"]
+
+
+@pytest.mark.asyncio
+async def test_business_message_error_discards_rag_search(adb, monkeypatch):
+    """Ошибка до генерации ответа - фоновый поиск RAG отменяется, клиент получает сообщение об ошибке"""
+
+    tasks = []
+    start_rag_search = business.ai_brain.ai_brain.start_rag_search
+
+    def tracked_start(text):
+        tasks.append(start_rag_search(text))
+        return tasks[-1]
+
+    async def broken_history(user_id):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(business.ai_brain.ai_brain, "_search_rag_context", lambda query: time.sleep(0.05) or "ПРИМЕРЫ")
+    monkeypatch.setattr(business.ai_brain.ai_brain, "start_rag_search", tracked_start)
+    monkeypatch.setattr(adb, "get_conversation_history", broken_history)
+
+    bot = FakeBot()
+    await business.handle_business_message(business_update(556, "Нужна автоматизация"), SimpleNamespace(bot=bot))
+
+    assert bot.sent == ["❌ Произошла ошибка. Попробуйте позже."]
+    with pytest.raises(asyncio.CancelledError):
+        await tasks[0]
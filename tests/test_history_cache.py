@@ -0,0 +1,120 @@
+"""
+Тесты для history_cache.py - кэш последних сообщений диалогов
+"""
+from database import Database
+from history_cache import ConversationCache
+
+
+def message(msg_id: int, text: str = "Сообщение") -> dict:
+    return {'id': msg_id, 'role': 'user', 'message': text, 'timestamp': '2026-01-01 00:00:00'}
+
+
+def load(cache: ConversationCache, user_id: int, messages: list, limit: int):
+    cache.put(user_id, messages, limit, cache.begin_load(user_id))
+
+
+def test_window_follows_writes():
+    """Окно дописывается новыми сообщениями и хранит только последние window"""
+    cache = ConversationCache(window=3, max_users=10, max_bytes=10 ** 6)
+    load(cache, 1, [message(1), message(2)], 3)
+
+    assert [m['id'] for m in cache.get(1, 3)] == [1, 2]
+    # Вся история в окне - хватает и для большего limit
+    assert [m['id'] for m in cache.get(1, 50)] == [1, 2]
+
+    cache.append(1, [message(3), message(4)])
+    assert [m['id'] for m in cache.get(1, 3)] == [2, 3, 4]
+    assert cache.get(1, 50) is None
+
+    cache.reset(1)
+    assert cache.get(1, 3) == []
+
+
+def test_stale_load_is_not_cached():
+    """Запись во время чтения из БД - результат чтения в кэш не попадает"""
+    cache = ConversationCache(window=3, max_users=10, max_bytes=10 ** 6)
+    token = cache.begin_load(1)
+    cache.append(1, [message(2)])
+    cache.put(1, [message(1)], 3, token)
+
+    assert cache.get(1, 3) is None
+
+
+def test_load_between_commit_and_append_is_not_duplicated():
+    """Чтение из БД после коммита, но до append: сообщение в окне один раз"""
+    cache = ConversationCache(window=3, max_users=10, max_bytes=10 ** 6)
+    # Запись закоммитила сообщение 2, читатель успел его прочитать до append писателя
+    load(cache, 1, [message(1), message(2)], 3)
+    cache.append(1, [message(2)])
+    cache.append(1, [message(3)])
+
+    assert [m['id'] for m in cache.get(1, 3)] == [1, 2, 3]
+    fresh = ConversationCache(window=3, max_users=10, max_bytes=10 ** 6)
+    load(fresh, 1, [message(1), message(2), message(3)], 3)
+    assert cache.get_stats()['bytes'] == fresh.get_stats()['bytes']
+
+
+def test_database_read_racing_write_is_not_duplicated(tmp_path):
+    """Database: чтение истории попадает между коммитом add_message и обновлением кэша"""
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        user_id = db.create_or_update_user(telegram_id=1, first_name="Test")
+        original_append = db.history_cache.append
+
+        def append_after_concurrent_read(uid, messages):
+            # Читатель другого потока: строка уже закоммичена, окно заполняется из БД
+            db.get_conversation_history(uid)
+            original_append(uid, messages)
+
+        db.history_cache.append = append_after_concurrent_read
+        db.add_message(user_id, 'user', "Первое")
+        db.history_cache.append = original_append
+
+        assert [m['message'] for m in db.get_conversation_history(user_id)] == ["Первое"]
+        db.add_message(user_id, 'assistant', "Ответ")
+        assert [m['message'] for m in db.get_conversation_history(user_id)] == ["Первое", "Ответ"]
+    finally:
+        db.close()
+
+
+def test_lru_eviction_by_users_and_memory():
+    """Вытесняются дольше всех не использованные окна - по числу и по памяти"""
+    cache = ConversationCache(window=3, max_users=2, max_bytes=10 ** 6)
+    load(cache, 1, [message(1)], 3)
+    load(cache, 2, [message(2)], 3)
+    cache.get(1, 3)
+    load(cache, 3, [message(3)], 3)
+
+    assert cache.get(2, 3) is None
+    assert cache.get(1, 3) is not None
+    assert cache.evictions == 1
+
+    small = ConversationCache(window=3, max_users=100, max_bytes=3000)
+    for user_id in range(5):
+        load(small, user_id, [message(user_id, "x" * 500)], 3)
+    stats = small.get_stats()
+    assert stats['bytes'] <= 3000
+    assert stats['users'] < 5
+
+
+def test_database_history_served_from_cache(tmp_path):
+    """После первого чтения история не читается из БД и совпадает с ней"""
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        user_id = db.create_or_update_user(telegram_id=1, first_name="Test")
+        db.add_message(user_id, 'user', "Первое")
+        db.get_conversation_history(user_id)
+
+        db.add_message(user_id, 'assistant', "Ответ")
+        db.add_messages([(user_id, 'user', "Второе")])
+        cached = db.get_conversation_history(user_id)
+
+        assert db.history_cache.hits == 1 and db.history_cache.misses == 1
+        db.history_cache.clear()
+        assert cached == db.get_conversation_history(user_id)
+
+        db.clear_conversation_history(user_id)
+        assert db.get_conversation_history(user_id) == []
+        assert db.history_cache.hits == 2
+    finally:
+        db.close()
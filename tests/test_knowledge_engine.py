@@ -0,0 +1,562 @@
+"""
+Тесты для knowledge_engine.py - RAG поиск и кэш эмбеддингов
+"""
+import hashlib
+import os
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from database import Database
+from knowledge_engine import KnowledgeEngine, QueryCache, normalize_rows, top_k_similar
+from lexical_index import BM25Index, tokenize
+from vector_index import CompactMatrix, ExactIndex, IVFIndex, VectorIndex
+
+
+def fake_vector(text: str, dim: int = 16) -> list:
+    """Детерминированный "эмбеддинг" текста"""
+    seed = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).normal(size=dim).tolist()
+
+
+class FakeEmbeddings:
+    """Подмена client.embeddings с подсчетом запросов"""
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    def create(self, input, model, timeout=None):
+        self.calls += 1
+        if self.fail:
+            raise TimeoutError("embeddings endpoint timed out")
+        texts = input if isinstance(input, list) else [input]
+        data = [SimpleNamespace(embedding=fake_vector(text), index=i) for i, text in enumerate(texts)]
+        return SimpleNamespace(data=data)
+
+
+@pytest.fixture
+def test_db():
+    """Создание временной тестовой базы данных"""
+    fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+
+    db = Database(db_path)
+
+    yield db
+
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+
+
+def make_engine(db: Database) -> KnowledgeEngine:
+    engine = KnowledgeEngine(db)
+    engine.client = SimpleNamespace(embeddings=FakeEmbeddings())
+    # Без фонового потока и файла снимка: индекс обновляем явно через refresh()
+    engine.rag_index._schedule = lambda: None
+    engine.rag_index.path = None
+    return engine
+
+
+def add_lead(db: Database, telegram_id: int, temperature: str = 'hot', message: str = None) -> tuple:
+    """Пользователь с сообщением и лидом"""
+    user_id = db.create_or_update_user(telegram_id=telegram_id, first_name=f"User{telegram_id}")
+    db.add_message(user_id, 'user', message or f'Нужен анализ договоров поставки {telegram_id}')
+    lead_id = db.create_or_update_lead(user_id, {
+        'temperature': temperature,
+        'service_category': 'Договорная работа',
+        'pain_point': f'Долго проверяем договоры {telegram_id}',
+    })
+    return user_id, lead_id
+
+
+def sample_conversations(count: int = 5) -> list:
+    return [
+        {
+            'lead_id': i,
+            'service_category': 'Договорная работа' if i % 2 else 'Судебная работа',
+            'pain_point': f'Проблема клиента номер {i}',
+            'temperature': 'warm',
+        }
+        for i in range(count)
+    ]
+
+
+def test_corpus_embeddings_cached(test_db):
+    """Повторный поиск запрашивает у OpenAI только эмбеддинг запроса"""
+    engine = make_engine(test_db)
+    conversations = sample_conversations()
+
+    # Запрос + один пакетный запрос для всего корпуса
+    engine.find_similar_conversations("автоматизация договоров", conversations, min_similarity=-1)
+    assert engine.client.embeddings.calls == 2
+
+    engine.find_similar_conversations("судебная практика", conversations, min_similarity=-1)
+    assert engine.client.embeddings.calls == 3
+
+    assert engine.get_cache_stats()['misses'] == len(conversations)
+
+
+def test_embeddings_persist_between_instances(test_db):
+    """После рестарта векторы корпуса читаются из SQLite"""
+    conversations = sample_conversations()
+    make_engine(test_db).find_similar_conversations("договоры", conversations, min_similarity=-1)
+
+    engine = make_engine(test_db)
+    engine.find_similar_conversations("договоры", conversations, min_similarity=-1)
+
+    assert engine.client.embeddings.calls == 1
+    assert engine.get_cache_stats()['disk_hits'] == len(conversations)
+
+
+def test_embedding_api_calls_counted_across_threads(test_db):
+    """Запросы эмбеддингов из нескольких потоков (поиск RAG, индекс) считаются без потерь"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    engine = make_engine(test_db)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: engine.get_embedding(f"запрос {i % 10}"), range(400)))
+        list(pool.map(lambda i: engine.get_embeddings_batch([f"текст {i}"]), range(100)))
+
+    assert engine.embedding_api_calls == 500
+    assert engine.get_cache_stats()['api_calls'] == 500
+
+
+def test_embeddings_batch_limits(test_db, monkeypatch):
+    """Пакеты ограничены количеством текстов и оценкой токенов"""
+    import knowledge_engine
+
+    engine = make_engine(test_db)
+    monkeypatch.setattr(knowledge_engine.config, 'EMBEDDING_BATCH_SIZE', 4)
+    monkeypatch.setattr(knowledge_engine.config, 'EMBEDDING_BATCH_MAX_TOKENS', 10**6)
+
+    texts = [f"Диалог номер {i}" for i in range(10)]
+    vectors = engine.get_embeddings_batch(texts)
+
+    assert engine.client.embeddings.calls == 3
+    assert vectors == [fake_vector(text) for text in texts]
+
+    # Длинные тексты упираются в лимит токенов раньше лимита количества
+    monkeypatch.setattr(knowledge_engine.config, 'EMBEDDING_BATCH_MAX_TOKENS', 400)
+    assert len(engine._split_into_batches(["а" * 500] * 4)) == 4
+
+
+def test_reindex_corpus_uses_batches(test_db):
+    """Индексация корпуса из БД делает один запрос на пакет"""
+    for i in range(6):
+        add_lead(test_db, 1000 + i)
+
+    engine = make_engine(test_db)
+
+    assert engine.reindex_corpus() == 6
+    assert engine.client.embeddings.calls == 1
+
+    # Повторная индексация берет всё из кэша
+    assert engine.reindex_corpus() == 6
+    assert engine.client.embeddings.calls == 1
+
+
+def test_rag_index_incremental_updates(test_db):
+    """Индекс обновляется только по изменившимся лидам"""
+    engine = make_engine(test_db)
+    add_lead(test_db, 1)
+    add_lead(test_db, 2)
+
+    assert engine.rebuild_index() == 2
+    calls_after_rebuild = engine.client.embeddings.calls
+
+    # Новый горячий лид попадает в индекс после refresh
+    user_id, lead_id = add_lead(test_db, 3)
+    assert engine.rag_index.refresh() == 1
+    assert len(engine.rag_index) == 3
+    assert engine.client.embeddings.calls == calls_after_rebuild + 1
+
+    # Лид остыл - запись удаляется по lead_id
+    test_db.create_or_update_lead(user_id, {'temperature': 'cold'})
+    engine.rag_index.refresh()
+    assert len(engine.rag_index) == 2
+    assert lead_id not in engine.rag_index._entries
+    results = engine.search_similar("договоры", top_k=5, min_similarity=-1)
+    assert lead_id not in [conv['lead_id'] for conv, _ in results]
+
+
+def test_rag_index_conversation_growth(test_db):
+    """Новое сообщение в диалоге лида перечитывает только этот диалог"""
+    engine = make_engine(test_db)
+    user_id, lead_id = add_lead(test_db, 1)
+    add_lead(test_db, 2)
+    engine.rebuild_index()
+    calls_after_rebuild = engine.client.embeddings.calls
+
+    test_db.add_message(user_id, 'assistant', 'Расскажите подробнее о ваших договорах')
+    assert engine.rag_index.refresh() == 1
+    assert engine.client.embeddings.calls == calls_after_rebuild + 1
+
+    # Сообщения пользователей без лида в индексе не вызывают обновлений
+    other_user = test_db.create_or_update_user(telegram_id=99, first_name="Other")
+    test_db.add_message(other_user, 'user', 'Привет')
+    assert engine.rag_index.refresh() == 0
+
+
+def test_search_similar_uses_index(test_db):
+    """Поиск по индексу запрашивает только эмбеддинг запроса"""
+    engine = make_engine(test_db)
+    add_lead(test_db, 1)
+    add_lead(test_db, 2)
+
+    # Индекс еще не построен - поиск пропускается
+    assert engine.search_similar("договоры", min_similarity=-1) == []
+
+    engine.rebuild_index()
+    calls_after_rebuild = engine.client.embeddings.calls
+
+    results = engine.search_similar("договоры", top_k=5, min_similarity=-1)
+
+    assert len(results) == 2
+    assert engine.client.embeddings.calls == calls_after_rebuild + 1
+
+
+def test_rag_index_persisted_snapshot(test_db, tmp_path):
+    """Снимок индекса загружается при старте без запросов эмбеддингов"""
+    index_path = str(tmp_path / 'rag_index')
+    add_lead(test_db, 1)
+    add_lead(test_db, 2)
+
+    engine = make_engine(test_db)
+    engine.rag_index.path = index_path
+    engine.rag_index.backend = 'ivf'
+    engine.rebuild_index()
+    centroids = engine.rag_index._snapshot.index.centroids
+
+    restarted = make_engine(test_db)
+    restarted.rag_index.path = index_path
+    restarted.rag_index.backend = 'ivf'
+
+    assert restarted.rag_index.refresh() == 2
+    assert restarted.rag_index.is_ready
+    assert restarted.client.embeddings.calls == 0
+    # Обученные центроиды восстановлены, а не посчитаны заново
+    assert np.array_equal(restarted.rag_index._snapshot.index.centroids, centroids)
+    assert len(restarted.search_similar("договоры", top_k=5, min_similarity=-1)) == 2
+
+
+def test_rag_index_appends_without_rewrite(test_db, tmp_path):
+    """Новые векторы дописываются в конец файла, старые байты не меняются"""
+    index_path = str(tmp_path / 'rag_index')
+    add_lead(test_db, 1)
+    add_lead(test_db, 2)
+
+    engine = make_engine(test_db)
+    engine.rag_index.path = index_path
+    engine.rebuild_index()
+
+    vectors_file = engine.rag_index.store.vectors_path
+    with open(vectors_file, 'rb') as f:
+        before = f.read()
+
+    add_lead(test_db, 3)
+    engine.rag_index.refresh()
+
+    with open(vectors_file, 'rb') as f:
+        after = f.read()
+    assert len(after) == len(before) * 3 // 2
+    assert after.startswith(before)
+    assert isinstance(engine.rag_index._snapshot.matrix.data, np.memmap)
+
+
+def test_rag_index_reader_follows_writer(test_db, tmp_path):
+    """Второй процесс читает те же файлы и подхватывает новые записи писателя"""
+    index_path = str(tmp_path / 'rag_index')
+    add_lead(test_db, 1)
+
+    writer = make_engine(test_db)
+    writer.rag_index.path = index_path
+    writer.rebuild_index()
+
+    reader = make_engine(test_db)
+    reader.rag_index.path = index_path
+    assert reader.rag_index.refresh() == 1
+    assert not reader.rag_index.store.is_writer
+
+    # Изменения лидов в процессе-читателе не пишутся в файлы
+    add_lead(test_db, 2)
+    assert reader.rag_index.refresh() == 1
+
+    writer.rag_index.refresh()
+    assert reader.rag_index.refresh() == 2
+    assert reader.client.embeddings.calls == 0
+    assert len(reader.search_similar("договоры", top_k=5, min_similarity=-1)) == 2
+
+    writer.rag_index.store.close()
+
+
+def test_vector_store_rewrite_never_mixes_generations(tmp_path):
+    """Читатель со старым журналом после compact писателя читает новое поколение целиком"""
+    from vector_store import VectorStore
+
+    path = str(tmp_path / 'rag_index')
+    vectors = np.random.default_rng(0).normal(size=(4, 8)).astype(np.float32)
+
+    writer = VectorStore(path, 'int8')
+    assert writer.acquire_writer()
+    writer.reset(8)
+    writer.append(CompactMatrix.from_float(vectors, 'int8'), [{'row': i} for i in range(4)])
+    old_files = (writer.vectors_path, writer.scales_path)
+
+    reader = VectorStore(path, 'int8')
+    assert reader.open()
+    assert reader.matrix().shape == (4, 8)
+
+    writer.delete([0, 1, 2])
+    writer.compact()
+    assert not any(os.path.exists(old) for old in old_files)
+
+    # Без sync: файлы старого поколения удалены, читатель перечитывает журнал вместо memmap не тех файлов
+    matrix = reader.matrix()
+    assert reader.generation == writer.generation
+    assert reader.metas == [{'row': 3}]
+    assert np.array_equal(np.asarray(matrix.data), np.asarray(writer.matrix().data))
+    writer.close()
+
+
+def test_rag_index_compaction(test_db):
+    """Когда удаленных строк больше живых, хранилище переписывается"""
+    engine = make_engine(test_db)
+    engine.rag_index.COMPACT_MIN_DEAD = 2
+    user_id, _ = add_lead(test_db, 1)
+    add_lead(test_db, 2)
+    engine.rebuild_index()
+    generation = engine.rag_index.store.generation
+
+    for i in range(3):
+        test_db.add_message(user_id, 'user', f'Уточнение {i}')
+        engine.rag_index.refresh()
+
+    store = engine.rag_index.store
+    assert store.generation > generation
+    assert store.dead_count <= store.live_count
+    assert len(engine.search_similar("договоры", top_k=5, min_similarity=-1)) == 2
+
+
+def test_tokenize_stems_russian_forms():
+    """Разные формы слова дают одну основу, стоп-слова отбрасываются"""
+    assert tokenize("Договор поставки") == tokenize("договоров  ПОСТАВКА")
+    assert tokenize("и в на") == []
+
+
+def test_bm25_ranks_and_removes():
+    """BM25 ранжирует по редким словам запроса и поддерживает удаление"""
+    index = BM25Index()
+    index.add(1, "Судебная практика по арбитражным спорам")
+    index.add(2, "Проверка договоров поставки")
+    index.add(3, "Due diligence перед сделкой, проверка договоров")
+
+    assert [doc for doc, _, _ in index.search("due diligence", 3)] == [3]
+    assert index.search("договор поставки", 3)[0][0] == 2
+
+    index.remove(2)
+    assert [doc for doc, _, _ in index.search("договор поставки", 3)] == [3]
+    assert index.search("договор поставки", 3)[0][2] == 0.5
+
+
+def test_search_similar_lexical_fallback(test_db):
+    """Без эмбеддингов RAG отвечает по BM25"""
+    engine = make_engine(test_db)
+    add_lead(test_db, 1, message='Нужна судебная практика по арбитражу')
+    add_lead(test_db, 2, message='Нужен due diligence компании')
+    engine.rebuild_index()
+
+    engine.client.embeddings.fail = True
+    results = engine.search_similar("Интересует due diligence", top_k=2)
+
+    assert [conv['user_id'] for conv, _ in results] == [test_db.get_user_by_telegram_id(2)['id']]
+    # Сходство - доля найденных слов запроса ("интересует" в диалоге нет)
+    assert results[0][1] == pytest.approx(2 / 3)
+
+
+def test_search_similar_reranks_lexical_candidates(test_db, monkeypatch):
+    """При достаточном числе лексических кандидатов векторы считаются только для них"""
+    import knowledge_engine
+
+    engine = make_engine(test_db)
+    for i in range(4):
+        add_lead(test_db, i, message=f'Проверка договоров поставки {i}')
+    add_lead(test_db, 10, message='Судебная практика')
+    engine.rebuild_index()
+
+    scored = []
+    original = knowledge_engine.CorpusMatrix.rerank
+
+    def spy(self, query_vector, keys, top_k, min_similarity):
+        scored.append(len(keys))
+        return original(self, query_vector, keys, top_k, min_similarity)
+
+    monkeypatch.setattr(knowledge_engine.CorpusMatrix, 'rerank', spy)
+    results = engine.search_similar("поставка", top_k=2, min_similarity=-1)
+
+    assert scored == [4]
+    assert len(results) == 2
+
+
+def test_query_cache_normalized_and_invalidated(test_db):
+    """Повторные запросы не ходят за эмбеддингом, изменение индекса сбрасывает результаты"""
+    engine = make_engine(test_db)
+    add_lead(test_db, 1)
+    engine.rebuild_index()
+    calls = engine.client.embeddings.calls
+
+    first = engine.search_similar("Здравствуйте, интересует автоматизация договоров!", min_similarity=-1)
+    second = engine.search_similar("здравствуйте  интересует автоматизация договоров", min_similarity=-1)
+
+    assert second == first
+    assert engine.client.embeddings.calls == calls + 1
+    assert engine.query_results.hits == 1
+
+    # Новый лид меняет версию индекса - результаты пересчитываются, эмбеддинг берется из кэша
+    add_lead(test_db, 2)
+    engine.rag_index.refresh()
+    calls = engine.client.embeddings.calls
+    third = engine.search_similar("Здравствуйте, интересует автоматизация договоров", min_similarity=-1)
+
+    assert len(third) == 2
+    assert engine.client.embeddings.calls == calls
+    stats = engine.get_query_cache_stats()
+    assert stats['embedding_calls_avoided'] == 2
+    assert stats['embeddings']['hits'] == 1
+
+
+def test_query_cache_ttl_and_size():
+    """Записи истекают по TTL и вытесняются по LRU"""
+    cache = QueryCache(max_items=2, ttl=0)
+    cache.put(('a',), 1)
+    assert cache.get(('a',)) is None
+
+    cache = QueryCache(max_items=2, ttl=60)
+    cache.put(('a',), 1)
+    cache.put(('b',), 2)
+    cache.get(('a',))
+    cache.put(('c',), 3)
+    assert cache.get(('b',)) is None
+    assert cache.get(('a',)) == 1
+    assert cache.get_stats()['items'] == 2
+
+
+def clustered_corpus(n: int, dim: int = 32, clusters: int = 20, seed: int = 0) -> np.ndarray:
+    """Синтетический корпус из нескольких тематических кластеров"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    labels = rng.integers(0, clusters, size=n)
+    return normalize_rows(centers[labels] + 0.3 * rng.normal(size=(n, dim)))
+
+
+def test_vector_index_requires_search():
+    """Индекс без search() не создается - ошибка при построении, а не при первом поиске"""
+    class NoSearch(VectorIndex):
+        name = 'broken'
+
+    with pytest.raises(TypeError):
+        VectorIndex()
+    with pytest.raises(TypeError):
+        NoSearch()
+
+
+def test_ivf_full_probe_matches_exact():
+    """IVF с просмотром всех кластеров совпадает с точным поиском"""
+    matrix = clustered_corpus(2000)
+    query = matrix[7]
+
+    exact = ExactIndex()
+    exact.build(matrix)
+    ivf = IVFIndex(n_lists=16, n_probe=16)
+    ivf.build(matrix)
+
+    assert ivf.search(query, 10, -1) == exact.search(query, 10, -1)
+
+
+def test_ivf_recall_and_centroid_reuse():
+    """IVF находит почти все точные соседи и не переобучается на малых изменениях"""
+    matrix = clustered_corpus(2000)
+    exact = ExactIndex()
+    exact.build(matrix)
+    ivf = IVFIndex(n_lists=32, n_probe=4)
+    ivf.build(matrix)
+
+    hits = 0
+    for row in range(0, 2000, 100):
+        expected = {i for i, _ in exact.search(matrix[row], 10, -1)}
+        hits += len(expected & {i for i, _ in ivf.search(matrix[row], 10, -1)})
+    assert hits / (20 * 10) >= 0.9
+
+    grown = IVFIndex(n_lists=32, n_probe=4)
+    grown.build(matrix[:1500], previous=ivf)
+    assert grown.centroids is ivf.centroids
+
+    retrained = IVFIndex(n_lists=32, n_probe=4)
+    retrained.build(matrix[:500], previous=ivf)
+    assert retrained.centroids is not ivf.centroids
+
+
+@pytest.mark.parametrize('dtype, tolerance', [('float16', 1e-3), ('int8', 2e-2)])
+def test_compact_matrix_scores(dtype, tolerance):
+    """Сжатая матрица дает почти те же сходства и меньше памяти"""
+    matrix = clustered_corpus(3000, dim=64)
+    query = matrix[0]
+    compact = CompactMatrix.from_float(matrix, dtype)
+
+    # Блочное умножение совпадает с распакованной матрицей
+    assert np.allclose(compact @ query, compact[np.arange(3000)] @ query, atol=1e-5)
+    assert np.abs(compact @ query - matrix @ query).max() < tolerance
+    assert compact.nbytes < matrix.nbytes / (1.9 if dtype == 'float16' else 3.5)
+
+    exact = [i for i, _ in top_k_similar(matrix, query, 10, -1)]
+    approx = [i for i, _ in top_k_similar(compact, query, 10, -1)]
+    assert len(set(exact) & set(approx)) >= 9
+
+
+def test_rag_index_int8_snapshot(test_db, tmp_path):
+    """Индекс в int8 сохраняется и загружается в том же формате"""
+    index_path = str(tmp_path / 'rag_index')
+    add_lead(test_db, 1)
+    add_lead(test_db, 2)
+
+    engine = make_engine(test_db)
+    engine.rag_index.path = index_path
+    engine.rag_index.vector_dtype = 'int8'
+    engine.rebuild_index()
+    assert engine.rag_index._snapshot.matrix.dtype == 'int8'
+
+    restarted = make_engine(test_db)
+    restarted.rag_index.path = index_path
+    restarted.rag_index.vector_dtype = 'int8'
+    restarted.rag_index.refresh()
+
+    assert restarted.rag_index._snapshot.matrix.dtype == 'int8'
+    results = restarted.search_similar("договоры", top_k=5, min_similarity=-1)
+    assert [conv['lead_id'] for conv, _ in results] == [
+        conv['lead_id'] for conv, _ in engine.search_similar("договоры", top_k=5, min_similarity=-1)
+    ]
+
+
+def test_top_k_similar_matches_brute_force():
+    """Векторизованный топ-K совпадает с полной сортировкой"""
+    rng = np.random.default_rng(42)
+    matrix = normalize_rows(rng.normal(size=(500, 32)))
+    query = normalize_rows(rng.normal(size=(1, 32)))[0]
+
+    result = top_k_similar(matrix, query, top_k=5, min_similarity=-1)
+
+    expected = np.argsort(-(matrix @ query))[:5]
+    assert [i for i, _ in result] == expected.tolist()
+    assert all(a[1] >= b[1] for a, b in zip(result, result[1:]))
+
+
+def test_top_k_similar_threshold():
+    """Порог min_similarity применяется к отобранным результатам"""
+    matrix = normalize_rows(np.array([[1, 0], [0, 1], [1, 1]], dtype=np.float32))
+    query = np.array([1, 0], dtype=np.float32)
+
+    result = top_k_similar(matrix, query, top_k=3, min_similarity=0.5)
+
+    assert [i for i, _ in result] == [0, 2]
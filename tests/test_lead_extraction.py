@@ -0,0 +1,202 @@
+"""
+Тесты для lead_extraction.py - фоновая очередь извлечения данных лида
+"""
+import asyncio
+
+import pytest
+
+import lead_extraction
+from database import Database
+from lead_extraction import LeadExtractionQueue
+
+
+class FakeExtractor:
+    """Подмена ai_brain.extract_lead_data_async: запоминает историю каждого вызова"""
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.calls = []
+        self.previous = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, conversation_history, previous_lead_data=None, user_id=None):
+        self.calls.append(list(conversation_history))
+        self.previous.append(previous_lead_data)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        return {"messages": len(conversation_history)}
+
+
+@pytest.fixture
+def histories(monkeypatch, tmp_path):
+    """Временная БД вместо глобальной"""
+    db = Database(str(tmp_path / 'bot.db'))
+    monkeypatch.setattr(lead_extraction.database, "db", db)
+    return db
+
+
+@pytest.fixture
+def extractor(monkeypatch):
+    fake = FakeExtractor()
+    monkeypatch.setattr(lead_extraction.ai_brain.ai_brain, "extract_lead_data_async", fake)
+    return fake
+
+
+def add_message(db: Database, user_id: int, text: str):
+    if not db.get_user_by_id(user_id):
+        db.create_or_update_user(telegram_id=1000 + user_id, first_name=f"User{user_id}")
+    db.add_message(user_id, 'user', text)
+
+
+@pytest.mark.asyncio
+async def test_coalesces_pending_user(histories, extractor):
+    """Три быстрых сообщения - одно извлечение по последней истории"""
+    queue = LeadExtractionQueue(max_pending=10, workers=2)
+    results = []
+
+    async def on_result(lead_data):
+        results.append(lead_data)
+
+    for text in ["Здравствуйте", "Нужен аудит договоров", "Бюджет 300 тысяч"]:
+        add_message(histories, 1, text)
+        queue.submit(1, on_result)
+
+    await queue.drain(timeout=1)
+
+    assert len(extractor.calls) == 1
+    assert extractor.calls[0][-1]["message"] == "Бюджет 300 тысяч"
+    # Бюджет найден правилами и дополнил ответ модели
+    assert results == [{"messages": 3, "budget": "100-300K"}]
+    stats = queue.get_stats()
+    assert stats["coalesced"] == 2
+    assert stats["completed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_running_user_is_requeued(histories, extractor):
+    """Сообщение во время извлечения - повторный запуск после него, не параллельно"""
+    extractor.delay = 0.05
+    queue = LeadExtractionQueue(max_pending=10, workers=4)
+
+    async def on_result(lead_data):
+        pass
+
+    add_message(histories, 1, "Здравствуйте")
+    queue.submit(1, on_result)
+    await asyncio.sleep(0.01)
+
+    add_message(histories, 1, "Нас пять юристов, не успеваем проверять договоры")
+    queue.submit(1, on_result)
+    await queue.drain(timeout=1)
+
+    assert [len(call) for call in extractor.calls] == [1, 2]
+    assert extractor.max_in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_bounded_queue_drops(histories, extractor):
+    """Переполненная очередь отказывает новым пользователям"""
+    queue = LeadExtractionQueue(max_pending=2, workers=1)
+
+    async def on_result(lead_data):
+        pass
+
+    accepted = []
+    for user_id in range(1, 5):
+        add_message(histories, user_id, "Здравствуйте")
+        accepted.append(queue.submit(user_id, on_result))
+
+    await queue.drain(timeout=1)
+
+    assert accepted == [True, True, False, False]
+    assert queue.get_stats()["dropped"] == 2
+    assert len(extractor.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_drain_rejects_new_jobs(histories, extractor):
+    """После остановки очередь не принимает задачи"""
+    queue = LeadExtractionQueue(max_pending=10, workers=1)
+
+    async def on_result(lead_data):
+        pass
+
+    add_message(histories, 1, "Здравствуйте")
+    queue.submit(1, on_result)
+    await queue.drain(timeout=1)
+
+    assert queue.submit(1, on_result) is False
+    assert len(extractor.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_incremental_extraction(histories, extractor, monkeypatch):
+    """Повторное извлечение получает прошлые данные и только новые сообщения"""
+    monkeypatch.setattr(lead_extraction.config, "LEAD_EXTRACTION_FULL_EVERY", 3)
+    queue = LeadExtractionQueue(max_pending=10, workers=1)
+
+    async def on_result(lead_data):
+        pass
+
+    for turn in range(4):
+        add_message(histories, 1, f"Сообщение номер {turn}: " + "у нас пять юристов и много договоров " * 20)
+        add_message(histories, 1, f"Еще одно сообщение {turn}")
+        queue.submit(1, on_result)
+        await queue._queue.join()
+
+    await queue.drain(timeout=1)
+
+    # Полное, два инкрементальных, снова полное (коррекция)
+    assert [len(call) for call in extractor.calls] == [2, 2, 2, 8]
+    assert extractor.previous[0] is None
+    assert extractor.previous[1] == {"messages": 2}
+    assert extractor.previous[3] is None
+    assert extractor.calls[1][0]["message"].startswith("Сообщение номер 1")
+
+    state = histories.get_lead_extraction_state(1)
+    assert state["incremental_runs"] == 0
+    assert state["prompt_tokens"] < state["full_prompt_tokens"]
+
+
+@pytest.mark.asyncio
+async def test_skips_without_new_messages(histories, extractor):
+    """Без новых сообщений повторное извлечение не запускается"""
+    queue = LeadExtractionQueue(max_pending=10, workers=1)
+
+    async def on_result(lead_data):
+        pass
+
+    add_message(histories, 1, "Здравствуйте")
+    queue.submit(1, on_result)
+    await queue._queue.join()
+    queue.submit(1, on_result)
+    await queue.drain(timeout=1)
+
+    assert len(extractor.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_trivial_message_skips_llm(histories, extractor):
+    """Сообщение без данных лида не идет в LLM, контакты заполняются правилами"""
+    queue = LeadExtractionQueue(max_pending=10, workers=1)
+    results = []
+
+    async def on_result(lead_data):
+        results.append(lead_data)
+
+    add_message(histories, 1, "Интересует автоматизация договоров")
+    queue.submit(1, on_result)
+    await queue._queue.join()
+
+    add_message(histories, 1, "Спасибо, мой email ivan@company.ru")
+    queue.submit(1, on_result)
+    await queue.drain(timeout=1)
+
+    assert len(extractor.calls) == 1
+    assert results[-1] == {"messages": 1, "email": "ivan@company.ru"}
+    assert queue.get_stats()["skipped"] == 1
@@ -0,0 +1,50 @@
+"""
+Тесты для lead_rules.py - локальный разбор сообщений перед извлечением через LLM
+"""
+import pytest
+
+from lead_rules import pre_extract
+
+
+def user(text: str) -> dict:
+    return {"role": "user", "message": text}
+
+
+@pytest.mark.parametrize("text", ["ок", "спасибо!", "а сколько стоит?", "Понятно, подумаю"])
+def test_trivial_messages_skip_llm(text):
+    """Сообщения без данных лида не требуют LLM"""
+    assert pre_extract([user(text)]) == (False, {})
+
+
+@pytest.mark.parametrize("text", [
+    "Интересует автоматизация договоров",
+    "Меня зовут Иван",
+    "Не успеваем проверять документы",
+    "Можем созвониться завтра?",
+])
+def test_lead_facts_need_llm(text):
+    """Тематика, имя, боль и намерения разбирает LLM"""
+    needs_llm, _ = pre_extract([user(text)])
+    assert needs_llm
+
+
+def test_contacts_filled_without_llm():
+    """Контакты и размер команды заполняются правилами"""
+    needs_llm, fields = pre_extract([user("Нас 5 юристов, пишите ivan@company.ru или 8 (909) 233-09-09")])
+
+    assert not needs_llm
+    assert fields == {"email": "ivan@company.ru", "phone": "+79092330909", "team_size": "4-10"}
+
+
+def test_budget_and_urgency_need_llm():
+    """Бюджет и срочность заполняются, но температуру лида пересчитывает LLM"""
+    needs_llm, fields = pre_extract([user("Бюджет до 500 тысяч, надо срочно")])
+
+    assert needs_llm
+    assert fields == {"budget": "300-500K", "urgency": "high"}
+
+
+def test_assistant_messages_ignored():
+    """Ответы бота не влияют на решение"""
+    messages = [{"role": "assistant", "message": "Расскажите про вашу проблему с договорами"}, user("ок")]
+    assert pre_extract(messages) == (False, {})
@@ -0,0 +1,148 @@
+"""
+Тесты для openai_guard.py - повторы, сроки и предохранитель запросов к OpenAI
+"""
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from openai_guard import CircuitBreaker, CircuitOpenError, OpenAIGuard
+
+
+def status_error(status: int, headers: dict = None) -> openai.APIStatusError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status, request=request, headers=headers or {})
+    cls = openai.RateLimitError if status == 429 else openai.InternalServerError if status >= 500 else openai.BadRequestError
+    return cls("error", response=response, body=None)
+
+
+class FlakyCall:
+    """Метод клиента: сначала бросает ошибки из списка, потом отвечает"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+        self.timeouts = []
+
+    async def __call__(self, **kwargs):
+        self.calls += 1
+        self.timeouts.append(kwargs["timeout"])
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def make_guard(**kwargs) -> OpenAIGuard:
+    breaker = CircuitBreaker(
+        failure_threshold=kwargs.pop("threshold", 3), reset_timeout=kwargs.pop("reset", 0.1)
+    )
+    params = {"timeout": 2.0, "max_retries": 2, "backoff_base": 0.01, "backoff_max": 0.05}
+    params.update(kwargs)
+    return OpenAIGuard(breaker=breaker, **params)
+
+
+@pytest.mark.asyncio
+async def test_retries_honor_retry_after():
+    """429 повторяется через Retry-After, срок попытки - остаток общего срока"""
+    guard = make_guard()
+    call = FlakyCall([status_error(429, {"retry-after-ms": "100"}), status_error(503)])
+
+    started = time.monotonic()
+    assert await guard.call_async(call, model="m") == "ok"
+
+    assert call.calls == 3
+    assert time.monotonic() - started >= 0.1
+    assert call.timeouts[0] > call.timeouts[-1]
+    assert guard.get_stats()["retries"] == 2
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_client_error_not_retried():
+    """400 не повторяется и не размыкает предохранитель"""
+    guard = make_guard(threshold=1)
+    call = FlakyCall([status_error(400)])
+
+    with pytest.raises(openai.BadRequestError):
+        await guard.call_async(call)
+
+    assert call.calls == 1
+    assert guard.is_available()
+
+
+@pytest.mark.asyncio
+async def test_retry_stops_at_deadline():
+    """Повтор, не укладывающийся в срок, не выполняется"""
+    guard = make_guard(timeout=0.2)
+    call = FlakyCall([status_error(429, {"retry-after": "5"})])
+
+    with pytest.raises(openai.RateLimitError):
+        await guard.call_async(call)
+
+    assert call.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_call_times_out():
+    """Зависший запрос прерывается по сроку"""
+    guard = make_guard(timeout=0.1, max_retries=0)
+
+    async def hang(**kwargs):
+        await asyncio.sleep(5)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await guard.call_async(hang)
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_and_recovers():
+    """Серия ошибок размыкает предохранитель, после паузы пробный запрос его замыкает"""
+    guard = make_guard(threshold=3, max_retries=0)
+
+    for _ in range(3):
+        with pytest.raises(openai.InternalServerError):
+            await guard.call_async(FlakyCall([status_error(500)]))
+
+    call = FlakyCall([])
+    with pytest.raises(CircuitOpenError):
+        await guard.call_async(call)
+    assert call.calls == 0
+    assert not guard.is_available()
+    assert guard.get_stats()["fast_failed"] == 1
+
+    await asyncio.sleep(0.15)
+    assert await guard.call_async(call) == "ok"
+    assert guard.is_available()
+
+
+def test_half_open_allows_single_probe():
+    """В half_open пропускается только один пробный запрос, его ошибка снова размыкает"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure("boom")
+
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    breaker.record_failure("boom")
+    assert breaker.times_opened == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_probe_is_released():
+    """Отмененный пробный запрос не держит предохранитель в half_open"""
+    guard = make_guard(threshold=1, max_retries=0, reset=0)
+    with pytest.raises(openai.InternalServerError):
+        await guard.call_async(FlakyCall([status_error(500)]))
+
+    async def hang(**kwargs):
+        await asyncio.sleep(10)
+
+    probe = asyncio.create_task(guard.call_async(hang))
+    await asyncio.sleep(0.01)
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+
+    assert await guard.call_async(FlakyCall([])) == "ok"
+    assert guard.is_available()
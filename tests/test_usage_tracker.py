@@ -0,0 +1,93 @@
+"""
+Тесты для usage_tracker.py - учет токенов по usage ответов OpenAI
+"""
+import threading
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+import usage_tracker
+from database import AsyncDatabase, Database
+from usage_tracker import SYSTEM_USER_ID, UsageTracker
+
+
+def make_usage(prompt: int, completion: int, cached: int = 0):
+    return SimpleNamespace(
+        prompt_tokens=prompt,
+        completion_tokens=completion,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached),
+    )
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    adb = AsyncDatabase(db)
+    monkeypatch.setattr(usage_tracker.database, "db", db)
+    monkeypatch.setattr(usage_tracker.database, "adb", adb)
+    yield db
+    adb.close()
+    db.close()
+
+
+def test_flush_aggregates_per_user_day(db):
+    """Счетчики копятся в памяти и одним пакетом прибавляются к строкам БД"""
+    tracker = UsageTracker(flush_interval=60)
+    budget_before = usage_tracker.security.security_manager.total_tokens_today
+
+    tracker.record(make_usage(1000, 200, cached=512), user_id=1)
+    tracker.record(make_usage(800, 100), user_id=1)
+    tracker.record(make_usage(50, 0))
+    assert tracker.flush() == 2
+
+    tracker.record(make_usage(100, 10), user_id=1)
+    assert tracker.flush() == 1
+    assert tracker.flush() == 0
+
+    conn = db.get_connection()
+    rows = {row['user_id']: dict(row) for row in conn.execute("SELECT * FROM token_usage")}
+    conn.close()
+    assert rows[1]['requests'] == 3
+    assert rows[1]['prompt_tokens'] == 1900
+    assert rows[1]['completion_tokens'] == 310
+    assert rows[1]['cached_tokens'] == 512
+    assert rows[SYSTEM_USER_ID]['prompt_tokens'] == 50
+
+    totals = db.get_token_usage_totals(date.today().isoformat())
+    assert totals['prompt_tokens'] == 1950
+    assert tracker.get_stats()['prompt_tokens'] == 1950
+    assert usage_tracker.security.security_manager.total_tokens_today - budget_before == 2260
+
+
+def test_failed_flush_keeps_counters(db):
+    """Ошибка записи не теряет счетчики - они уходят следующим пакетом"""
+    tracker = UsageTracker(flush_interval=60)
+    tracker.record(make_usage(100, 10), user_id=1)
+
+    def broken(rows):
+        raise RuntimeError("database is locked")
+
+    db.add_token_usage = broken
+    assert tracker.flush() == 0
+    del db.add_token_usage
+
+    tracker.record(make_usage(100, 10), user_id=1)
+    assert tracker.flush() == 1
+    assert db.get_token_usage_totals(date.today().isoformat())['requests'] == 2
+
+
+def test_flush_goes_through_writer_thread(db):
+    """Запись счетчиков идет в потоке записи AsyncDatabase, а не в потоке фоновой записи"""
+    tracker = UsageTracker(flush_interval=60)
+    tracker.record(make_usage(100, 10), user_id=1)
+    threads = []
+    add_token_usage = db.add_token_usage
+
+    def tracked(rows):
+        threads.append(threading.current_thread().name)
+        return add_token_usage(rows)
+
+    db.add_token_usage = tracked
+    assert tracker.flush() == 1
+    assert threads[0].startswith("db-writer")
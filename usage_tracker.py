@@ -0,0 +1,164 @@
+"""
+Учет токенов OpenAI по полю usage ответов
+
+Каждый ответ OpenAI (чат, потоковый чат, извлечение лида, краткое
+содержание, эмбеддинги) учитывается точно: prompt, completion и cached
+токены. Счетчики копятся в памяти по пользователю и дню и раз в
+USAGE_FLUSH_INTERVAL секунд одним пакетом дописываются в таблицу
+token_usage (в потоке записи database.adb, как и остальная запись).
+Общий расход сразу передается в security_manager для проверки дневного
+бюджета.
+"""
+import logging
+import threading
+from datetime import date
+from typing import Dict, Optional, Tuple
+
+from config import Config
+config = Config()
+import database
+import security
+
+logger = logging.getLogger(__name__)
+
+# Запросы без пользователя (эмбеддинги RAG, скрипты) учитываются под этим ID
+SYSTEM_USER_ID = 0
+
+
+class UsageTracker:
+    """Счетчики токенов по (пользователь, день) с периодической записью в SQLite"""
+
+    def __init__(self, flush_interval: float = None):
+        self.flush_interval = config.USAGE_FLUSH_INTERVAL if flush_interval is None else flush_interval
+
+        self._lock = threading.Lock()
+        # (user_id, день) -> [запросов, prompt, completion, cached] еще не записанные в БД
+        self._pending: Dict[Tuple[int, str], list] = {}
+        # Итоги за сегодня (в БД + в памяти) для админ-панели
+        self._today = date.today().isoformat()
+        self._today_totals = [0, 0, 0, 0]
+
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+        self.flushes = 0
+
+    def record(self, usage, user_id: Optional[int] = None):
+        """
+        Учет usage одного ответа OpenAI
+
+        Args:
+            usage: usage из ответа (None - провайдер его не вернул)
+            user_id: ID пользователя в БД (None - системный запрос)
+        """
+        if usage is None:
+            return
+        prompt = getattr(usage, 'prompt_tokens', 0) or 0
+        completion = getattr(usage, 'completion_tokens', 0) or 0
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0
+
+        day = date.today().isoformat()
+        key = (SYSTEM_USER_ID if user_id is None else user_id, day)
+        with self._lock:
+            counters = self._pending.setdefault(key, [0, 0, 0, 0])
+            for i, value in enumerate((1, prompt, completion, cached)):
+                counters[i] += value
+            if day != self._today:
+                self._today = day
+                self._today_totals = [0, 0, 0, 0]
+            for i, value in enumerate((1, prompt, completion, cached)):
+                self._today_totals[i] += value
+
+        security.security_manager.add_tokens_used(prompt + completion)
+
+    def flush(self) -> int:
+        """
+        Запись накопленных счетчиков в БД одним пакетом
+
+        Returns:
+            Количество записанных строк (пользователь, день)
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        rows = [(user_id, day, *counters) for (user_id, day), counters in pending.items()]
+        try:
+            # Через поток записи AsyncDatabase - не соперничаем с ним за блокировку SQLite
+            database.adb.run_write_blocking(database.adb.db.add_token_usage, rows)
+        except Exception as e:
+            # Не теряем счетчики - вернутся в следующий пакет
+            logger.error(f"Error flushing token usage ({len(rows)} rows): {e}")
+            with self._lock:
+                for key, counters in pending.items():
+                    current = self._pending.setdefault(key, [0, 0, 0, 0])
+                    for i, value in enumerate(counters):
+                        current[i] += value
+            return 0
+
+        self.flushes += 1
+        logger.debug(f"Token usage flushed: {len(rows)} rows")
+        return len(rows)
+
+    def ensure_started(self):
+        """Запуск фоновой записи счетчиков и загрузка сегодняшнего расхода из БД"""
+        if self._worker is not None:
+            return
+        self._load_today()
+        self._worker = threading.Thread(target=self._run, name="usage-flush", daemon=True)
+        self._worker.start()
+
+    def _load_today(self):
+        """Расход за сегодня, записанный до перезапуска, - в итоги и дневной бюджет"""
+        try:
+            stored = database.db.get_token_usage_totals(date.today().isoformat())
+        except Exception as e:
+            logger.warning(f"Could not load today's token usage: {e}")
+            return
+        with self._lock:
+            for i, key in enumerate(('requests', 'prompt_tokens', 'completion_tokens', 'cached_tokens')):
+                self._today_totals[i] += stored[key]
+        security.security_manager.add_tokens_used(stored['prompt_tokens'] + stored['completion_tokens'])
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Остановка фоновой записи и запись остатка (при остановке бота)"""
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join(timeout=5)
+        self.flush()
+
+    def get_stats(self) -> Dict:
+        """Расход токенов за сегодня"""
+        with self._lock:
+            requests, prompt, completion, cached = self._today_totals
+            pending_rows = len(self._pending)
+        return {
+            'day': self._today,
+            'requests': requests,
+            'prompt_tokens': prompt,
+            'completion_tokens': completion,
+            'cached_tokens': cached,
+            'pending_rows': pending_rows,
+            'flushes': self.flushes,
+        }
+
+    def format_stats(self) -> str:
+        """Расход токенов за сегодня для админ-панели"""
+        stats = self.get_stats()
+        cached_share = stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0
+        return (
+            f"🧾 Расход OpenAI за сегодня (по usage):\n"
+            f"• Запросов: {stats['requests']:,}\n"
+            f"• Входных токенов: {stats['prompt_tokens']:,} (из кэша {cached_share:.0%})\n"
+            f"• Выходных токенов: {stats['completion_tokens']:,}"
+        )
+
+
+# Глобальный экземпляр
+usage_tracker = UsageTracker()
@@ -4,9 +4,14 @@
 import re
 import logging
 from datetime import datetime
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# Email и российский телефон в свободном тексте
+EMAIL_PATTERN = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b'
+PHONE_PATTERN = r'\+?[78][\s-]?\(?\d{3}\)?[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}'
+
 
 def validate_email(email: str) -> bool:
     """
@@ -36,6 +41,22 @@ def validate_phone(phone: str) -> bool:
     return True
 
 
+def extract_email(text: str) -> Optional[str]:
+    """
+    Поиск email в тексте
+    """
+    match = re.search(EMAIL_PATTERN, text)
+    return match.group(0) if match else None
+
+
+def extract_phone(text: str) -> Optional[str]:
+    """
+    Поиск российского номера телефона в тексте
+    """
+    match = re.search(PHONE_PATTERN, text)
+    return match.group(0) if match else None
+
+
 def format_phone(phone: str) -> str:
     """
     Форматирование телефона в красивый вид
@@ -64,11 +85,7 @@ def mask_sensitive_data(text: str) -> str:
     )
 
     # Маскируем телефон
-    text = re.sub(
-        r'\+?[78][\s-]?\(?\d{3}\)?[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}',
-        r'+7***-***-**-**',
-        text
-    )
+    text = re.sub(PHONE_PATTERN, r'+7***-***-**-**', text)
 
     return text
 
@@ -80,6 +97,19 @@ def get_formatted_timestamp() -> str:
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
+def normalize_query(text: str) -> str:
+    """
+    Нормализация текста запроса для кэширования
+
+    Регистр, ё/е, пунктуация и лишние пробелы не влияют на результат:
+    "Здравствуйте! Интересует  автоматизация договоров" ->
+    "здравствуйте интересует автоматизация договоров"
+    """
+    text = text.casefold().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]|_', ' ', text)
+    return ' '.join(text.split())
+
+
 def truncate_text(text: str, max_length: int = 100) -> str:
     """
     Обрезание текста с добавлением многоточия
@@ -0,0 +1,383 @@
+"""
+Векторные индексы для RAG поиска
+
+ExactIndex - точный перебор (одно умножение матрицы на вектор).
+IVFIndex - приближенный поиск: векторы разбиты на кластеры (сферический k-means),
+при поиске просматриваются только n_probe ближайших кластеров.
+CompactMatrix - хранение векторов в float16 или int8 (с масштабом на вектор).
+"""
+
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Нормализация строк матрицы до единичной длины (нулевые строки остаются нулевыми)
+
+    После нормализации косинусное сходство = скалярное произведение.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class CompactMatrix:
+    """
+    Матрица векторов в компактном представлении
+
+    float32 - без сжатия, float16 - в 2 раза меньше памяти, int8 - в 4 раза
+    (каждая строка хранится как int8 коды и свой масштаб float32).
+    Умножение на вектор считается блоками по CHUNK_ROWS строк, поэтому
+    полная float32 копия матрицы в памяти никогда не создается.
+
+    Распаковка float16 в NumPy заметно медленнее, чем int8, поэтому для
+    больших корпусов int8 выгоднее и по памяти, и по задержке.
+    """
+
+    DTYPES = ('float32', 'float16', 'int8')
+    CHUNK_ROWS = 1024
+
+    def __init__(self, data: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.data = data
+        # Масштабы строк (только для int8)
+        self.scales = scales
+
+    @classmethod
+    def from_float(cls, matrix: np.ndarray, dtype: str = 'float32') -> 'CompactMatrix':
+        """
+        Сжатие float матрицы
+
+        Args:
+            matrix: Матрица векторов (n x dim) или один вектор
+            dtype: 'float32', 'float16' или 'int8'
+        """
+        matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+        if dtype == 'int8':
+            scales = np.abs(matrix).max(axis=1, initial=0) / 127
+            scales[scales == 0] = 1.0
+            codes = np.round(matrix / scales[:, None]).astype(np.int8)
+            return cls(codes, scales.astype(np.float32))
+        if dtype not in cls.DTYPES:
+            raise ValueError(f"Unknown vector dtype: {dtype}")
+        return cls(matrix.astype(dtype))
+
+    @classmethod
+    def vstack(cls, parts: List['CompactMatrix']) -> 'CompactMatrix':
+        """Объединение матриц одного типа"""
+        data = np.concatenate([part.data for part in parts])
+        if parts[0].scales is None:
+            return cls(data)
+        return cls(data, np.concatenate([part.scales for part in parts]))
+
+    @property
+    def dtype(self) -> str:
+        return self.data.dtype.name
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.data.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    def __getitem__(self, rows) -> np.ndarray:
+        """Строки матрицы в float32"""
+        block = self.data[rows].astype(np.float32)
+        if self.scales is not None:
+            scales = self.scales[rows]
+            block *= scales[..., None] if block.ndim == 2 else scales
+        return block
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        """Умножение на вектор (dim,) или матрицу (dim x m) блоками строк"""
+        other = np.asarray(other, dtype=np.float32)
+        if self.data.dtype == np.float32:
+            return self.data @ other
+
+        n = self.data.shape[0]
+        result = np.empty((n,) + other.shape[1:], dtype=np.float32)
+        for start in range(0, n, self.CHUNK_ROWS):
+            end = min(start + self.CHUNK_ROWS, n)
+            block = self.data[start:end].astype(np.float32) @ other
+            if self.scales is not None:
+                block *= self.scales[start:end, None] if block.ndim == 2 else self.scales[start:end]
+            result[start:end] = block
+        return result
+
+
+def top_k_similar(
+    matrix: np.ndarray,
+    query_vector: np.ndarray,
+    top_k: int,
+    min_similarity: float,
+    mask: Optional[np.ndarray] = None
+) -> List[Tuple[int, float]]:
+    """
+    Топ-K строк нормализованной матрицы по косинусному сходству с запросом
+
+    Одно умножение матрицы на вектор + argpartition (O(n) вместо сортировки),
+    порог min_similarity применяется уже к отобранным K строкам.
+
+    Args:
+        matrix: Нормализованная матрица корпуса (n x dim, float32 или CompactMatrix)
+        query_vector: Нормализованный вектор запроса
+        top_k: Количество результатов
+        min_similarity: Минимальное сходство
+        mask: Какие строки участвуют в поиске (None - все)
+
+    Returns:
+        Список (номер строки, сходство) по убыванию сходства
+    """
+    n = matrix.shape[0]
+    if n == 0 or top_k <= 0:
+        return []
+
+    scores = matrix @ query_vector
+    if mask is not None:
+        scores = np.where(mask, scores, -np.inf)
+    k = min(top_k, n)
+
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(n)
+
+    candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+    return [
+        (int(i), float(scores[i]))
+        for i in candidates
+        if scores[i] >= min_similarity
+    ]
+
+
+class VectorIndex(ABC):
+    """
+    Интерфейс индекса над нормализованной матрицей корпуса
+
+    Индекс не владеет матрицей: build() получает ее целиком, а номера строк
+    в результатах search() совпадают с номерами строк матрицы.
+    """
+
+    name = ''
+
+    def __init__(self):
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.mask: Optional[np.ndarray] = None
+
+    def build(
+        self,
+        matrix: np.ndarray,
+        previous: Optional['VectorIndex'] = None,
+        mask: Optional[np.ndarray] = None,
+        stable_rows: int = 0
+    ):
+        """
+        Построение индекса
+
+        Args:
+            matrix: Нормализованная матрица корпуса
+            previous: Предыдущий индекс того же типа (обученные параметры можно переиспользовать)
+            mask: Живые строки матрицы (None - все)
+            stable_rows: Сколько первых строк не изменилось с момента построения previous
+        """
+        self.matrix = matrix
+        self.mask = mask
+
+    @abstractmethod
+    def search(self, query_vector: np.ndarray, top_k: int, min_similarity: float) -> List[Tuple[int, float]]:
+        """Топ-K строк по сходству с нормализованным запросом"""
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """Обученные параметры индекса для сохранения на диск"""
+        return {}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        """Восстановление обученных параметров (индекс затем передается в build как previous)"""
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+
+class ExactIndex(VectorIndex):
+    """Точный поиск перебором всех строк"""
+
+    name = 'exact'
+
+    def search(self, query_vector: np.ndarray, top_k: int, min_similarity: float) -> List[Tuple[int, float]]:
+        return top_k_similar(self.matrix, query_vector, top_k, min_similarity, self.mask)
+
+
+class IVFIndex(VectorIndex):
+    """
+    Приближенный поиск по инвертированным спискам (IVF)
+
+    Строки матрицы распределены по n_lists кластерам. Запрос сравнивается
+    с центроидами, затем точно оцениваются только строки n_probe ближайших
+    кластеров. Больше n_probe - выше полнота и медленнее поиск.
+
+    Центроиды переобучаются, только если размер корпуса изменился в
+    RETRAIN_FACTOR раз с момента обучения; иначе по центроидам распределяются
+    только новые строки (stable_rows), остальные сохраняют свои кластеры.
+    """
+
+    name = 'ivf'
+
+    RETRAIN_FACTOR = 2.0
+    # Строк обучающей выборки на один кластер
+    TRAIN_ROWS_PER_LIST = 64
+    TRAIN_ITERATIONS = 10
+
+    def __init__(self, n_lists: int = 0, n_probe: int = 8, seed: int = 0):
+        super().__init__()
+        # 0 - подобрать автоматически (~sqrt(n))
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.trained_size = 0
+        # Кластер каждой строки матрицы
+        self.labels = np.zeros(0, dtype=np.int32)
+        # Живые строки, отсортированные по кластерам, и границы кластеров (как в CSR)
+        self.order = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def build(
+        self,
+        matrix: np.ndarray,
+        previous: Optional[VectorIndex] = None,
+        mask: Optional[np.ndarray] = None,
+        stable_rows: int = 0
+    ):
+        self.matrix = matrix
+        self.mask = mask
+        rows = np.flatnonzero(mask) if mask is not None else np.arange(matrix.shape[0])
+        if rows.size == 0:
+            self.centroids = np.zeros((0, 0), dtype=np.float32)
+            self.trained_size = 0
+            self.labels = np.zeros(matrix.shape[0], dtype=np.int32)
+            self.order = np.zeros(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return
+
+        if isinstance(previous, IVFIndex) and self._can_reuse(previous, matrix, rows.size):
+            self.centroids = previous.centroids
+            self.trained_size = previous.trained_size
+            stable_rows = min(stable_rows, previous.labels.size)
+            self.labels = np.concatenate((previous.labels[:stable_rows], self._nearest(matrix, stable_rows)))
+        else:
+            self.centroids = self._train(matrix, rows)
+            self.trained_size = rows.size
+            self.labels = self._nearest(matrix, 0)
+
+        # Живые строки группируются по кластерам
+        live_labels = self.labels[rows]
+        self.order = rows[np.argsort(live_labels, kind='stable')]
+        counts = np.bincount(live_labels, minlength=self.centroids.shape[0])
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def _can_reuse(self, previous: 'IVFIndex', matrix: np.ndarray, live: int) -> bool:
+        """Подходят ли центроиды предыдущего индекса для новой матрицы"""
+        if previous.trained_size == 0 or previous.centroids.shape[1:] != matrix.shape[1:]:
+            return False
+        if self.n_lists and previous.centroids.shape[0] != min(self.n_lists, previous.trained_size):
+            return False
+        ratio = live / previous.trained_size
+        return 1 / self.RETRAIN_FACTOR <= ratio <= self.RETRAIN_FACTOR
+
+    def _train(self, matrix: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Сферический k-means на выборке живых строк"""
+        n = rows.size
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(n))), n)
+        rng = np.random.default_rng(self.seed)
+
+        sample_size = min(n, n_lists * self.TRAIN_ROWS_PER_LIST)
+        if sample_size < n:
+            rows = np.sort(rng.choice(rows, sample_size, replace=False))
+        # Выборка всегда в float32, даже если матрица сжата
+        sample = matrix[rows]
+
+        centroids = sample[rng.choice(sample.shape[0], n_lists, replace=False)].copy()
+        for _ in range(self.TRAIN_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+
+            # Пустые кластеры перезапускаем со случайных строк выборки
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()))]
+
+            centroids = normalize_rows(sums)
+
+        logger.debug(f"IVF trained: {n_lists} lists on {sample.shape[0]} rows")
+        return centroids
+
+    def _nearest(self, matrix: np.ndarray, start: int) -> np.ndarray:
+        """Ближайший центроид для строк матрицы начиная с start"""
+        if start >= matrix.shape[0]:
+            return np.zeros(0, dtype=np.int32)
+        tail = matrix[start:] if start else matrix
+        return np.argmax(tail @ self.centroids.T, axis=1).astype(np.int32)
+
+    def search(self, query_vector: np.ndarray, top_k: int, min_similarity: float) -> List[Tuple[int, float]]:
+        n_lists = self.centroids.shape[0]
+        if n_lists == 0 or top_k <= 0:
+            return []
+
+        n_probe = min(self.n_probe, n_lists)
+        centroid_scores = self.centroids @ query_vector
+        if n_probe < n_lists:
+            probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        else:
+            probes = np.arange(n_lists)
+
+        candidates = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in probes])
+        return [
+            (int(candidates[i]), score)
+            for i, score in top_k_similar(self.matrix[candidates], query_vector, top_k, min_similarity)
+        ]
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        return {
+            'centroids': self.centroids,
+            'trained_size': np.array(self.trained_size),
+            'labels': self.labels,
+        }
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        self.centroids = state['centroids']
+        self.trained_size = int(state['trained_size'])
+        self.labels = state['labels']
+
+
+def create_index(backend: str, n_lists: int = 0, n_probe: int = 8) -> VectorIndex:
+    """
+    Создание индекса по названию бэкенда
+
+    Args:
+        backend: 'exact' или 'ivf'
+        n_lists: Количество кластеров IVF (0 - автоматически)
+        n_probe: Просматриваемых кластеров IVF при поиске
+
+    Returns:
+        Пустой индекс (нужно вызвать build)
+    """
+    if backend == IVFIndex.name:
+        return IVFIndex(n_lists=n_lists, n_probe=n_probe)
+    if backend != ExactIndex.name:
+        logger.warning(f"Unknown vector index backend '{backend}', using exact search")
+    return ExactIndex()
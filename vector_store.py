@@ -0,0 +1,364 @@
+"""
+Хранилище векторов RAG на диске: плоский бинарный файл + сайдкар с метаданными
+
+Файлы (path - префикс, например data/rag_index):
+    path.N.vectors   - строки векторов поколения N подряд (int8/float16/float32), открываются через numpy.memmap
+    path.N.scales    - масштабы строк float32 (только для int8)
+    path.meta.jsonl  - заголовок (с именами файлов поколения) и журнал записей:
+                       добавление строки с метаданными или удаление
+    path.lock        - блокировка писателя
+
+Файлы только дописываются: новые векторы добавляются в конец, удаление - запись
+в журнале. Несколько процессов бота открывают одни и те же файлы: писатель -
+тот, кто взял блокировку, остальные читают через memmap (общий page cache ОС)
+и подхватывают новые записи журнала. Когда удаленных строк становится много,
+писатель переписывает файлы заново (compact) и увеличивает generation.
+Векторы нового поколения пишутся в новые файлы, журнал с указанием на них
+заменяется последним: читатель никогда не видит векторы одного поколения
+с журналом другого.
+"""
+
+import fcntl
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from vector_index import CompactMatrix
+
+logger = logging.getLogger(__name__)
+
+
+class VectorStore:
+    """Векторы с метаданными только на дозапись (path=None - только в памяти)"""
+
+    def __init__(self, path: Optional[str], dtype: str):
+        self.path = path
+        self.dtype = dtype
+        self.dim = 0
+        # Номер поколения файлов (меняется при compact/reset)
+        self.generation = 0
+
+        # Метаданные строк (None - строка удалена) и маска живых строк
+        self.metas: List[Optional[Dict]] = []
+        self._alive = np.zeros(0, dtype=bool)
+
+        # Векторы в памяти (режим без файла)
+        self._memory: Optional[CompactMatrix] = None
+
+        self.is_writer = path is None
+        self._lock_file = None
+        # Сколько байт журнала уже прочитано и его inode (для читателей)
+        self._meta_offset = 0
+        self._meta_inode = None
+        # Имена файлов векторов текущего поколения из заголовка журнала (None - path.vectors/path.scales)
+        self._vectors_file: Optional[str] = None
+        self._scales_file: Optional[str] = None
+
+    # === ФАЙЛЫ ===
+
+    @property
+    def vectors_path(self) -> str:
+        if self._vectors_file is None:
+            return f"{self.path}.vectors"
+        return os.path.join(os.path.dirname(self.path), self._vectors_file)
+
+    @property
+    def scales_path(self) -> str:
+        if self._scales_file is None:
+            return f"{self.path}.scales"
+        return os.path.join(os.path.dirname(self.path), self._scales_file)
+
+    @property
+    def meta_path(self) -> str:
+        return f"{self.path}.meta.jsonl"
+
+    def acquire_writer(self) -> bool:
+        """
+        Попытка стать писателем (неблокирующая)
+
+        Returns:
+            True если этот процесс может изменять файлы
+        """
+        if self.is_writer:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lock_file = open(f"{self.path}.lock", 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.is_writer = True
+        return True
+
+    def open(self) -> bool:
+        """
+        Загрузка существующих файлов
+
+        Returns:
+            True если файлы найдены и прочитаны
+        """
+        if self.path is None or not os.path.exists(self.meta_path):
+            return False
+
+        self.metas = []
+        self._alive = np.zeros(0, dtype=bool)
+        self._meta_offset = 0
+        self._meta_inode = os.stat(self.meta_path).st_ino
+        if not self._read_journal():
+            return False
+
+        if self.is_writer:
+            # Строки, записанные без записи в журнале (сбой между записями), отбрасываем
+            self._truncate_files(len(self.metas))
+        return True
+
+    def sync(self) -> bool:
+        """
+        Подхват изменений, сделанных писателем (для процессов-читателей)
+
+        Returns:
+            True если появились новые записи
+        """
+        if self.path is None or self.is_writer or not os.path.exists(self.meta_path):
+            return False
+
+        inode = os.stat(self.meta_path).st_ino
+        if inode != self._meta_inode:
+            # Файлы переписаны (compact/reset) - читаем заново
+            return self.open()
+        return self._read_journal()
+
+    def _read_journal(self) -> bool:
+        """Чтение новых полных строк журнала начиная с _meta_offset"""
+        with open(self.meta_path, 'rb') as f:
+            f.seek(self._meta_offset)
+            chunk = f.read()
+
+        # Последняя строка может быть дописана не полностью
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            return False
+
+        for line in chunk[:end].splitlines():
+            record = json.loads(line)
+            if 'dim' in record:
+                # Заголовок
+                if record['dtype'] != self.dtype:
+                    logger.warning(f"Vector store dtype {record['dtype']} != {self.dtype}, ignoring files")
+                    return False
+                self.dim = record['dim']
+                self.generation = record.get('generation', 0)
+                self._vectors_file = record.get('vectors')
+                self._scales_file = record.get('scales')
+            elif 'delete' in record:
+                self._mark_deleted(record['delete'])
+            else:
+                self._set_meta(record['row'], record['meta'])
+
+        self._meta_offset += end
+        return True
+
+    def _truncate_files(self, rows: int):
+        row_size = self.dim * np.dtype(self.dtype).itemsize
+        for path, size in ((self.vectors_path, rows * row_size), (self.scales_path, rows * 4)):
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _append_journal(self, records: List[Dict]):
+        with open(self.meta_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self._meta_offset = os.path.getsize(self.meta_path)
+
+    # === ИЗМЕНЕНИЯ (только писатель) ===
+
+    def reset(self, dim: int):
+        """Очистка хранилища (новое поколение файлов)"""
+        self.dim = dim
+        self.generation += 1
+        self.metas = []
+        self._alive = np.zeros(0, dtype=bool)
+        self._memory = None
+        if self.path is not None:
+            self._rewrite(CompactMatrix.from_float(np.zeros((0, dim), dtype=np.float32), self.dtype), [])
+
+    def append(self, vectors: CompactMatrix, metas: List[Dict]) -> List[int]:
+        """
+        Добавление строк в конец хранилища
+
+        Returns:
+            Номера новых строк
+        """
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Vector dimension {vectors.shape[1]} != {self.dim}")
+
+        start = len(self.metas)
+        rows = list(range(start, start + len(metas)))
+
+        if self.path is None:
+            self._memory = vectors if self._memory is None else CompactMatrix.vstack([self._memory, vectors])
+        else:
+            # Сначала векторы, затем журнал: строка без записи в журнале не видна читателям
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.data.tobytes())
+            if vectors.scales is not None:
+                with open(self.scales_path, 'ab') as f:
+                    f.write(vectors.scales.astype(np.float32).tobytes())
+            self._append_journal([{'row': row, 'meta': meta} for row, meta in zip(rows, metas)])
+
+        for row, meta in zip(rows, metas):
+            self._set_meta(row, meta)
+        return rows
+
+    def delete(self, rows: List[int]):
+        """Пометка строк удаленными"""
+        rows = [row for row in rows if self.metas[row] is not None]
+        if not rows:
+            return
+        if self.path is not None:
+            self._append_journal([{'delete': row} for row in rows])
+        for row in rows:
+            self._mark_deleted(row)
+
+    def compact(self) -> List[int]:
+        """
+        Переписать хранилище без удаленных строк
+
+        Returns:
+            Номера живых строк в старой нумерации (позиция = новый номер)
+        """
+        live = np.flatnonzero(self._alive)
+        matrix = self.matrix()
+        vectors = CompactMatrix(
+            np.ascontiguousarray(matrix.data[live]),
+            matrix.scales[live].copy() if matrix.scales is not None else None
+        )
+        metas = [self.metas[row] for row in live]
+
+        self.generation += 1
+        self.metas = []
+        self._alive = np.zeros(0, dtype=bool)
+        if self.path is None:
+            self._memory = vectors
+        else:
+            self._rewrite(vectors, metas)
+        for row, meta in enumerate(metas):
+            self._set_meta(row, meta)
+        return live.tolist()
+
+    def _rewrite(self, vectors: CompactMatrix, metas: List[Dict]):
+        """
+        Запись нового поколения файлов
+
+        Векторы - в файлы с номером поколения в имени (старые файлы не трогаются),
+        затем журнал с их именами через временный файл + os.replace. Файлы
+        прошлого поколения удаляются после замены журнала: читатели, уже
+        открывшие их через memmap, дочитывают старые данные.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        name = os.path.basename(self.path)
+        vectors_file = f"{name}.{self.generation}.vectors"
+        scales_file = f"{name}.{self.generation}.scales" if vectors.scales is not None else None
+        header = {
+            'dtype': self.dtype, 'dim': self.dim, 'generation': self.generation,
+            'vectors': vectors_file, 'scales': scales_file,
+        }
+        old_paths = {self.vectors_path, self.scales_path}
+
+        directory = os.path.dirname(self.path)
+        with open(os.path.join(directory, vectors_file), 'wb') as f:
+            f.write(vectors.data.tobytes())
+        if scales_file is not None:
+            with open(os.path.join(directory, scales_file), 'wb') as f:
+                f.write(vectors.scales.astype(np.float32).tobytes())
+        with open(f"{self.meta_path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+            for row, meta in enumerate(metas):
+                f.write(json.dumps({'row': row, 'meta': meta}, ensure_ascii=False, default=str) + '\n')
+
+        # Журнал заменяется последним - читатели по новому inode перечитывают его и берут новые файлы
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
+        self._vectors_file, self._scales_file = vectors_file, scales_file
+        self._meta_inode = os.stat(self.meta_path).st_ino
+        self._meta_offset = os.path.getsize(self.meta_path)
+
+        for path in old_paths - {self.vectors_path, self.scales_path}:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _set_meta(self, row: int, meta: Dict):
+        if row >= len(self.metas):
+            self.metas.extend([None] * (row + 1 - len(self.metas)))
+        self.metas[row] = meta
+        if row >= self._alive.size:
+            alive = np.zeros(max(row + 1, self._alive.size * 2), dtype=bool)
+            alive[:self._alive.size] = self._alive
+            self._alive = alive
+        self._alive[row] = True
+
+    def _mark_deleted(self, row: int):
+        if row < len(self.metas):
+            self.metas[row] = None
+            self._alive[row] = False
+
+    # === ЧТЕНИЕ ===
+
+    def matrix(self) -> CompactMatrix:
+        """Все строки хранилища (файл - через memmap, без чтения в память)"""
+        rows = len(self.metas)
+        if self.path is None:
+            if self._memory is None:
+                return CompactMatrix.from_float(np.zeros((0, self.dim), dtype=np.float32), self.dtype)
+            return self._memory
+
+        if rows and not self.is_writer and not self._files_cover(rows):
+            # Писатель переписал файлы после нашего sync (файлы поколения удалены) - перечитываем журнал
+            self.open()
+            rows = len(self.metas)
+
+        if rows == 0:
+            return CompactMatrix.from_float(np.zeros((0, self.dim), dtype=np.float32), self.dtype)
+
+        data = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(rows, self.dim))
+        scales = None
+        if self.dtype == 'int8':
+            scales = np.memmap(self.scales_path, dtype=np.float32, mode='r', shape=(rows,))
+        return CompactMatrix(data, scales)
+
+    def _files_cover(self, rows: int) -> bool:
+        """Файлы векторов существуют и вмещают rows строк"""
+        sizes = [(self.vectors_path, rows * self.dim * np.dtype(self.dtype).itemsize)]
+        if self.dtype == 'int8':
+            sizes.append((self.scales_path, rows * 4))
+        try:
+            return all(os.path.getsize(path) >= size for path, size in sizes)
+        except OSError:
+            return False
+
+    @property
+    def alive(self) -> np.ndarray:
+        """Маска живых строк (длина = количество строк)"""
+        return self._alive[:len(self.metas)].copy()
+
+    @property
+    def live_count(self) -> int:
+        return int(self._alive.sum())
+
+    @property
+    def dead_count(self) -> int:
+        return len(self.metas) - self.live_count
+
+    def close(self):
+        """Освобождение блокировки писателя"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            self.is_writer = False